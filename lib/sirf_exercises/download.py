@@ -0,0 +1,296 @@
+'''Downloads the data for the SIRF-Exercises, and creates the Python scripts
+such that the exercises know where the data is (as download_data.sh).
+
+Files are downloaded with concurrent ranged requests (if the server supports
+them), and partial downloads are resumed. After checking their md5, they
+are kept in a content-addressed cache (files named by their md5), which can
+be shared by several users and destinations (-d/-D). The archives are then
+extracted in parallel, e.g.
+
+    python scripts/download_data.py -p -m [-d DEST_DIR] [--cache CACHE_DIR]
+
+Use --mirror URL to download all files from URL/<filename> instead, e.g.
+from a local copy served with python -m http.server.
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking between processes
+    fcntl = None
+
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(LIB_DIR))
+
+# filename, URL of its directory (and suffix), md5, destination in the data
+# directory, and whether it is a zip archive to extract there
+DATASETS = {
+    'PET': [dict(filename='NEMA_IQ.zip', url='https://zenodo.org/record/1304454/files/',
+                 md5='ef848b8f6d5fd57b072a953b374ba4da', destination=('PET', 'mMR'), extract=True)],
+    'MR': [dict(filename='PTB_ACRPhantom_GRAPPA.zip', url='https://zenodo.org/record/2633785/files/',
+                md5='a7e0b72a964b1e84d37f9609acd77ef2', destination=('MR',), extract=True)],
+    'old': [dict(filename='meas_MID00108_FID57249_test_2D_2x.dat',
+                 url='https://www.dropbox.com/s/cazoi5l7oljtwsy/', suffix='?dl=0',
+                 md5='8f06cacf6b3f4b46435bf8e970e1fe3f', destination=('MR',), extract=False),
+            dict(filename='meas_MID00103_FID57244_test.dat',
+                 url='https://www.dropbox.com/s/tz7q02fziskq9u7/', suffix='?dl=0',
+                 md5='44d9766ddbbf2a082d07ddba74a769c9', destination=('MR',), extract=False)],
+}
+
+
+def default_cache_dir():
+    return os.environ.get('SIRF_EXERCISES_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'sirf_exercises'))
+
+
+def md5sum(filename, chunk_size=2**24):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _open(url, start=None, end=None, timeout=60):
+    request = urllib.request.Request(url, headers={'User-Agent': 'SIRF-Exercises'})
+    if start is not None:
+        request.add_header('Range', 'bytes={}-{}'.format(start, '' if end is None else end - 1))
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def _retry(fn, attempts=4):
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except OSError as e:  # includes URLError and timeouts
+            if attempt == attempts - 1:
+                raise
+            print('{}, retrying'.format(e))
+            time.sleep(2 ** attempt)
+
+
+def _copy_stream(response, f, md5=None, chunk_size=2**20):
+    for chunk in iter(lambda: response.read(chunk_size), b''):
+        f.write(chunk)
+        if md5 is not None:
+            md5.update(chunk)
+
+
+class _Partial:
+    # A partial download: the file, and the state (size and chunks done),
+    # which is saved after every chunk, such that a later run resumes
+    def __init__(self, filename, size, chunk_size):
+        self.filename = filename
+        self.state_file = filename + '.json'
+        self.lock = threading.Lock()
+        state = None
+        if os.path.exists(self.state_file) and os.path.exists(filename):
+            with open(self.state_file) as f:
+                state = json.load(f)
+        if state is None or state['size'] != size or state['chunk_size'] != chunk_size:
+            state = dict(size=size, chunk_size=chunk_size, done=[])
+            with open(filename, 'wb') as f:
+                f.truncate(size)
+        self.state = state
+
+    def todo(self):
+        n_chunks = -(-self.state['size'] // self.state['chunk_size'])
+        return [i for i in range(n_chunks) if i not in set(self.state['done'])]
+
+    def done(self, chunk):
+        with self.lock:
+            self.state['done'].append(chunk)
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.replace(self.state_file + '.tmp', self.state_file)
+
+
+def _download_chunk(url, partial, chunk):
+    chunk_size = partial.state['chunk_size']
+    start = chunk * chunk_size
+    end = min(start + chunk_size, partial.state['size'])
+
+    def get():
+        with _open(url, start, end) as response, open(partial.filename, 'r+b') as f:
+            if response.status != 206:
+                raise OSError('server ignored the range request')
+            f.seek(start)
+            _copy_stream(response, f)
+            if f.tell() != end:
+                raise OSError('incomplete chunk {}'.format(chunk))
+
+    _retry(get)
+    partial.done(chunk)
+
+
+def fetch(url, md5, cache_dir=None, n_threads=4, chunk_size=2**24):
+    '''
+    Returns the filename of the file at url with checksum md5 in the cache,
+    downloading it first if needed.
+
+    If the server supports ranged requests, the file is downloaded in chunks
+    of chunk_size bytes by n_threads threads, and an interrupted download
+    is resumed by the next call.
+    '''
+    cache_dir = cache_dir or default_cache_dir()
+    filename = os.path.join(cache_dir, 'md5', md5)
+    if os.path.exists(filename):
+        return filename
+    os.makedirs(os.path.join(cache_dir, 'md5'), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, 'partial'), exist_ok=True)
+    part = os.path.join(cache_dir, 'partial', md5)
+    with open(part + '.lock', 'w') as lock:
+        if fcntl is not None:
+            # another process (or user) might be downloading the same file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(filename):
+            return filename
+        print('Downloading {}'.format(url))
+        response = _retry(lambda: _open(url, 0, 1))
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes 0-0/(\d+)$', content_range)
+        if response.status == 206 and match:
+            response.close()
+            partial = _Partial(part, int(match.group(1)), chunk_size)
+            with ThreadPoolExecutor(n_threads) as pool:
+                for future in [pool.submit(_download_chunk, url, partial, chunk)
+                               for chunk in partial.todo()]:
+                    future.result()
+            checksum = md5sum(part)
+        else:
+            # no ranges: download it in one go (and from scratch)
+            checksum = hashlib.md5()
+            with response, open(part, 'wb') as f:
+                _copy_stream(response, f, checksum)
+            checksum = checksum.hexdigest()
+        if os.path.exists(part + '.json'):
+            os.remove(part + '.json')
+        if checksum != md5:
+            os.remove(part)
+            raise RuntimeError("md5sum of {} doesn't match. Rerun for another attempt.".format(url))
+        os.chmod(part, 0o644)
+        os.replace(part, filename)
+    return filename
+
+
+def extract(archive, destination, n_threads=4):
+    '''Extracts (overwriting) the zip archive into destination, with
+    n_threads threads, each with its own share of the members'''
+    with zipfile.ZipFile(archive) as z:
+        infos = sorted(z.infolist(), key=lambda info: -info.file_size)
+    members = [info.filename for info in infos]
+    # the largest first, spread over the threads
+    shares = [members[i::n_threads] for i in range(n_threads)]
+
+    def extract_share(share):
+        with zipfile.ZipFile(archive) as z:
+            for member in share:
+                z.extract(member, destination)
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        list(pool.map(extract_share, [share for share in shares if share]))
+
+
+def _install(item, data_path, download_dir, cache_dir, mirror, n_threads):
+    filename = item['filename']
+    # files downloaded before (e.g. by download_data.sh)
+    for directory in (download_dir, data_path):
+        candidate = os.path.join(directory, filename) if directory else None
+        if candidate and os.path.isfile(candidate) and md5sum(candidate) == item['md5']:
+            print('{} exists and its md5sum is ok'.format(candidate))
+            archive = candidate
+            break
+    else:
+        url = mirror.rstrip('/') + '/' + filename if mirror else item['url'] + filename + item.get('suffix', '')
+        archive = fetch(url, item['md5'], cache_dir, n_threads)
+    destination = os.path.join(data_path, *item['destination'])
+    os.makedirs(destination, exist_ok=True)
+    if item['extract']:
+        print('Unpacking {}'.format(filename))
+        extract(archive, destination, n_threads)
+    else:
+        shutil.copyfile(archive, os.path.join(destination, filename))
+
+
+def write_paths(data_path, working_dir=None, lib_dir=LIB_DIR):
+    '''Writes data_path.py (and working_path.py) in lib_dir'''
+    if working_dir is not None:
+        print('Creating working_path.py in {}'.format(lib_dir))
+        with open(os.path.join(lib_dir, 'working_path.py'), 'w') as f:
+            f.write("working_dir = '{}'\n".format(os.path.abspath(working_dir)))
+    print('Creating data_path.py in {}'.format(lib_dir))
+    with open(os.path.join(lib_dir, 'data_path.py'), 'w') as f:
+        f.write("data_path = '{}'\n".format(data_path))
+
+
+def download(datasets, data_path=None, download_dir=None, cache_dir=None, working_dir=None,
+             mirror=None, n_threads=4, lib_dir=LIB_DIR):
+    '''
+    Downloads and extracts datasets (keys of DATASETS: 'PET', 'MR', 'old'),
+    concurrently, into data_path (default: the data directory of the
+    repository), and writes the Python scripts with the paths.
+    '''
+    data_path = os.path.realpath(data_path or os.path.join(REPO_DIR, 'data'))
+    print('Destination is "{}"'.format(data_path))
+    # old notebooks also need MR data
+    if 'old' in datasets and 'MR' not in datasets:
+        datasets = list(datasets) + ['MR']
+    items = [item for name in datasets for item in DATASETS[name]]
+    with ThreadPoolExecutor(max(len(items), 1)) as pool:
+        for future in [pool.submit(_install, item, data_path, download_dir, cache_dir, mirror, n_threads)
+                       for item in items]:
+            future.result()
+    # make sure we created data_path, even if nothing was downloaded
+    os.makedirs(data_path, exist_ok=True)
+    write_paths(data_path, working_dir, lib_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Downloads data for the SIRF-Exercises, and creates Python scripts such that '
+                    'the exercises know where the data is. Without flags, no data are downloaded, '
+                    'but the Python scripts are created.')
+    parser.add_argument('-p', action='store_true', help='Download PET data')
+    parser.add_argument('-m', action='store_true', help='Download MR data')
+    parser.add_argument('-o', action='store_true', help='Download old notebook data')
+    parser.add_argument('-d', metavar='DEST_DIR',
+                        help='Optional destination directory (default: SIRF-Exercises/data)')
+    parser.add_argument('-D', metavar='DOWNLOAD_DIR',
+                        help='Optional directory with files downloaded before, '
+                             'and cache directory if --cache is not given')
+    parser.add_argument('-w', metavar='WORKING_DIR',
+                        help='Optional working directory (default: DEST_DIR/working_folder)')
+    parser.add_argument('--cache', help='Download cache, shared between destinations '
+                                        '(default: $SIRF_EXERCISES_CACHE or ~/.cache/sirf_exercises)')
+    parser.add_argument('--mirror', help='Download all files from MIRROR/<filename> instead')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Number of concurrent requests per file, and extraction threads')
+    args = parser.parse_args(argv)
+    datasets = [name for name, flag in (('PET', args.p), ('MR', args.m), ('old', args.o)) if flag]
+    download(datasets, args.d, args.D, args.cache or args.D, args.w, args.mirror, args.threads)
+    print('download_data.py completed.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+'''Memory-mapped access to Interfile images (.hv) and sinograms (.hs), and a
+catalog of the Interfile data in the exercises data directory.
+
+The headers are parsed in Python and the raw data are exposed as numpy.memmap
+arrays, such that e.g. displaying one slice or one segment only reads that
+part of the file, e.g.
+
+    catalog = DataCatalog()  # indexes exercises_data_path() (once, cached)
+    print(catalog.find('NEMA', kind='sinogram'))
+    sinogram = catalog.open('PET/mMR/NEMA_IQ/20170809_NEMA_60min_UCL.l.hs')
+    plt.imshow(sinogram.segment(0)[:, 100, :])  # (views, axial, tangential)
+
+The arrays are read-only views of the files; use SIRF for anything that needs
+the geometry (e.g. projecting) and numpy.array(...) to get a copy in memory.
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+HEADER_EXTENSIONS = ('.hv', '.hs')
+
+_number_formats = {'float': 'f', 'short float': 'f', 'long float': 'f',
+                   'signed integer': 'i', 'unsigned integer': 'u'}
+
+
+def _normalise_key(key):
+    # '!matrix size [1]' -> 'matrix size[1]'
+    key = ' '.join(key.strip().lstrip('!').lower().split())
+    return key.replace(' [', '[')
+
+
+def read_header(filename):
+    '''
+    Returns the keys and values of an Interfile header as a dict of strings.
+
+    Keys are lower case without '!' and without space before an index, e.g.
+    'matrix size[1]'. Lines without ':=' (and the end of sections) are skipped.
+    '''
+    header = {}
+    with open(filename, errors='replace') as f:
+        for line in f:
+            line = line.split(';', 1)[0]
+            if ':=' not in line:
+                continue
+            key, value = line.split(':=', 1)
+            key = _normalise_key(key)
+            if key:
+                header[key] = value.strip()
+    return header
+
+
+def _parse_value(value):
+    # '344' -> 344, '{ 127, 115}' -> [127, 115]
+    value = value.strip()
+    if value.startswith('{'):
+        return [_parse_value(v) for v in value.strip('{}').split(',') if v.strip()]
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+class InterfileData:
+    '''
+    The raw data of an Interfile image or sinogram, memory-mapped on access.
+
+    filename: the header (.hv or .hs).
+
+    Images have shape (z, y, x), as SIRF's as_array(). Projection data are
+    stored per segment, in the order of the header's ring differences, each
+    with its own number of axial positions, and are accessed per segment
+    (and timing position, for TOF data) in file order, see `segment`.
+    '''
+
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.header = read_header(filename) if header is None else header
+        h = self.header
+        data_file = h['name of data file']
+        self.data_file = os.path.join(os.path.dirname(os.path.abspath(filename)), data_file)
+        number_format = h.get('number format', 'float').lower()
+        if number_format not in _number_formats:
+            raise ValueError('{}: unsupported number format "{}"'.format(filename, number_format))
+        byte_order = '>' if h.get('imagedata byte order', 'LITTLEENDIAN').upper() == 'BIGENDIAN' else '<'
+        self.dtype = numpy.dtype(byte_order + _number_formats[number_format]
+                                 + str(int(h.get('number of bytes per pixel', 4))))
+        self.offset = int(h.get('data offset in bytes[1]', 0))
+        ndim = int(h.get('number of dimensions', 3))
+        # slowest axis first, as in numpy
+        self.axes = tuple(h.get('matrix axis label[{}]'.format(i), str(i)).lower()
+                          for i in range(ndim, 0, -1))
+        self.sizes = tuple(_parse_value(h['matrix size[{}]'.format(i)]) for i in range(ndim, 0, -1))
+        self.is_projection_data = 'segment' in self.axes
+        self._memmap = None
+
+    @property
+    def shape(self):
+        '''Shape of the image, or of the data of every segment'''
+        if not self.is_projection_data:
+            return self.sizes
+        return tuple(self._segment_shape(s) for s in range(self.num_segments))
+
+    @property
+    def num_segments(self):
+        return self.sizes[self.axes.index('segment')] if self.is_projection_data else 0
+
+    @property
+    def ring_differences(self):
+        '''(min, max) ring difference of every segment (in file order)'''
+        min_rd = _parse_value(self.header.get('minimum ring difference per segment', '{}'))
+        max_rd = _parse_value(self.header.get('maximum ring difference per segment', '{}'))
+        return list(zip(min_rd, max_rd))
+
+    def _segment_shape(self, segment):
+        # axes after the segment axis; sizes given per segment are lists
+        first = self.axes.index('segment') + 1
+        return tuple(size[segment] if isinstance(size, list) else size for size in self.sizes[first:])
+
+    @property
+    def array(self):
+        '''All data as a read-only numpy.memmap (for projection data only if
+        all segments have the same shape, see `segment` otherwise)'''
+        if self._memmap is None:
+            if self.is_projection_data:
+                shapes = self.shape
+                if len(set(shapes)) != 1:
+                    raise ValueError('{}: the segments have different shapes, use segment()'
+                                     .format(self.filename))
+                shape = self.sizes[:self.axes.index('segment') + 1] + shapes[0]
+            else:
+                shape = self.sizes
+            self._memmap = numpy.memmap(self.data_file, dtype=self.dtype, mode='r',
+                                        offset=self.offset, shape=shape)
+        return self._memmap
+
+    def segment(self, segment, timing_position=0):
+        '''
+        Data of a segment (its index in file order, see ring_differences) as
+        a read-only numpy.memmap with axes self.axes after 'segment', e.g.
+        (view, axial coordinate, tangential coordinate) for STIR sinograms.
+        '''
+        if not self.is_projection_data:
+            raise ValueError('{} is not projection data'.format(self.filename))
+        if not 0 <= segment < self.num_segments:
+            raise IndexError('segment {} out of range'.format(segment))
+        sizes = [int(numpy.prod(self._segment_shape(s))) for s in range(self.num_segments)]
+        offset = timing_position * sum(sizes) + sum(sizes[:segment])
+        return numpy.memmap(self.data_file, dtype=self.dtype, mode='r',
+                            offset=self.offset + offset * self.dtype.itemsize,
+                            shape=self._segment_shape(segment))
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __repr__(self):
+        return '{}({!r}, shape={}, dtype={})'.format(type(self).__name__, self.filename,
+                                                     self.shape, self.dtype)
+
+
+def checksum(filename, chunk_size=2**24):
+    '''Returns the md5 checksum of a file, read in chunks'''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DataCatalog:
+    '''
+    Index of the Interfile headers under a directory, by default the
+    exercises data (see exercises_data_path).
+
+    The parsed headers, data file sizes and checksums are cached in
+    cache_file (by default .interfile_catalog.json in root), and only
+    recomputed for files whose size or modification time changed. Headers
+    that cannot be read are skipped, with a warning (logged to the
+    'sirf_exercises.interfile' logger), and kept in errors, a dict of
+    path: exception.
+    checksums: whether to compute md5 checksums of the data files.
+    '''
+
+    def __init__(self, root=None, cache_file=None, checksums=True):
+        if root is None:
+            from . import exercises_data_path
+            root = exercises_data_path()
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file or os.path.join(self.root, '.interfile_catalog.json')
+        self.checksums = checksums
+        self.entries = {}
+        self.errors = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.entries = json.load(f)
+        self.scan()
+
+    def _stat(self, filename):
+        if not os.path.exists(filename):
+            return None
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _entry(self, path, old):
+        filename = os.path.join(self.root, path)
+        stat = self._stat(filename)
+        if old is not None and old['header_stat'] == stat and \
+                self._stat(old['data_file']) == old['data_stat'] and \
+                (old['checksum'] is not None or not self.checksums):
+            return old
+        data = InterfileData(filename)
+        data_stat = self._stat(data.data_file)
+        return dict(kind='sinogram' if data.is_projection_data else 'image',
+                    header=data.header, header_stat=stat,
+                    data_file=data.data_file, data_stat=data_stat,
+                    size=data_stat[0] if data_stat else None,
+                    checksum=checksum(data.data_file) if self.checksums and data_stat else None)
+
+    def scan(self):
+        '''(Re)indexes the headers under root, and updates the cache file'''
+        entries = {}
+        errors = {}
+        for directory, _, files in os.walk(self.root):
+            for name in sorted(files):
+                if not name.lower().endswith(HEADER_EXTENSIONS):
+                    continue
+                path = os.path.relpath(os.path.join(directory, name), self.root)
+                try:
+                    entries[path] = self._entry(path, self.entries.get(path))
+                except (KeyError, ValueError, OSError) as e:
+                    errors[path] = e
+                    logger.warning('Skipping %s: %s', path, e)
+        changed = entries != self.entries
+        self.entries = entries
+        self.errors = errors
+        if changed:
+            try:
+                with open(self.cache_file + '.tmp', 'w') as f:
+                    json.dump(entries, f, indent=1)
+                os.replace(self.cache_file + '.tmp', self.cache_file)
+            except OSError:
+                # e.g. a read-only shared data directory
+                pass
+
+    def find(self, pattern='', kind=None):
+        '''Returns the paths (relative to root) matching the regular
+        expression pattern, of kind 'image' or 'sinogram' if given'''
+        return [path for path, entry in sorted(self.entries.items())
+                if re.search(pattern, path) and (kind is None or entry['kind'] == kind)]
+
+    def open(self, path):
+        '''Returns the InterfileData of a path (relative to root)'''
+        return InterfileData(os.path.join(self.root, path), self.entries[path]['header'])
@@ -0,0 +1,276 @@
+'''Neighbourhoods, weights and the de Pierro update for MAP-EM with quadratic priors.
+
+Replaces the dense index matrices of the MAPEM_Bowsher notebook
+(compute_nhoodIndVec, dePierroReg): a neighbourhood is a stencil of
+offsets, which the update applies on the fly (with the same periodic
+boundaries as sirf.contrib.kcl.Prior), and weights only store the
+neighbours that take part, e.g.
+
+    nhood = Neighbourhood(image.shape)
+    weights = NeighbourWeights.uniform(nhood)
+    out = numpy.empty_like(image)
+    de_pierro_update(image, image_EM, beta, weights, out=out)
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import numba
+import numpy
+
+
+class Neighbourhood:
+    '''
+    The size**ndim (cubic) neighbourhood of every voxel of a 2D or 3D image.
+
+    shape: shape of the image.
+    size: odd side length of the neighbourhood.
+
+    The neighbours are numbered as in sirf.contrib.kcl.Prior (the first
+    axis varying slowest), such that the voxel itself is number
+    n_neighbours // 2, and wrap around at the image boundaries.
+    '''
+
+    def __init__(self, shape, size=3):
+        if size % 2 != 1:
+            raise ValueError("size must be odd")
+        self.shape = tuple(shape)
+        self.size = size
+        half = size // 2
+        steps = numpy.arange(-half, half + 1)
+        grids = numpy.meshgrid(*[steps] * len(self.shape), indexing='ij')
+        # (n_neighbours, ndim) offsets
+        self.offsets = numpy.stack([g.ravel() for g in grids], axis=1).astype(numpy.int32)
+        self.n_neighbours = len(self.offsets)
+        self.centre = self.n_neighbours // 2
+
+    def index_matrix(self, start=0, stop=None):
+        '''
+        Returns the dense (voxels, n_neighbours) matrix of neighbour indices
+        into the image flattened in Fortran order, i.e. what
+        compute_nhoodIndVec of the MAPEM_Bowsher notebook and
+        kcl.Prior use (before their reshape), or its rows start to stop.
+        '''
+        if stop is None:
+            stop = int(numpy.prod(self.shape))
+        coords = numpy.unravel_index(numpy.arange(start, stop), self.shape, order='F')
+        strides = numpy.cumprod((1,) + self.shape[:-1])
+        index = numpy.zeros((stop - start, self.n_neighbours), dtype=numpy.int32)
+        for l, offset in enumerate(self.offsets):
+            for c, o, n, s in zip(coords, offset, self.shape, strides):
+                index[:, l] += ((c + o) % n) * s
+        return index
+
+
+class NeighbourWeights:
+    '''
+    Weights of the neighbours of every voxel, compact: for every voxel only k
+    neighbours (numbers into neighbourhood.offsets) and their weights.
+
+    neighbourhood: a Neighbourhood.
+    neighbours: int32 array of shape image shape + (k,), or (k,) for the
+        same neighbours everywhere.
+    weights: float32 array of the same shape as neighbours.
+
+    The normalisation of the de Pierro update (one over the sum of the
+    weights of every voxel, 0 if there are none) is computed once here.
+    '''
+
+    def __init__(self, neighbourhood, neighbours, weights):
+        self.neighbourhood = neighbourhood
+        shape = neighbourhood.shape + (numpy.shape(neighbours)[-1],)
+        self.neighbours = numpy.broadcast_to(numpy.asarray(neighbours, dtype=numpy.int32), shape)
+        self.weights = numpy.broadcast_to(numpy.asarray(weights, dtype=numpy.float32), shape)
+        total = self.weights.sum(axis=-1, dtype=numpy.float64)
+        self.inv_sum = numpy.zeros(neighbourhood.shape, dtype=numpy.float32)
+        numpy.divide(1, total, out=self.inv_sum, where=total != 0, casting='unsafe')
+
+    @classmethod
+    def uniform(cls, neighbourhood, include_centre=False):
+        '''Weight 1 for all neighbours (except the voxel itself)'''
+        neighbours = numpy.arange(neighbourhood.n_neighbours, dtype=numpy.int32)
+        if not include_centre:
+            neighbours = numpy.delete(neighbours, neighbourhood.centre)
+        return cls(neighbourhood, neighbours, numpy.ones(len(neighbours), dtype=numpy.float32))
+
+    @classmethod
+    def from_dense(cls, neighbourhood, weights):
+        '''
+        From a dense (voxels, n_neighbours) weight matrix with the voxels in
+        Fortran order (as kcl.Prior.BowshserWeights returns), keeping only
+        the non-zero weights.
+        '''
+        weights = numpy.asarray(weights)
+        dense = weights.reshape(neighbourhood.shape + (neighbourhood.n_neighbours,), order='F')
+        nonzero = dense != 0
+        k = max(int(nonzero.sum(axis=-1).max()), 1)
+        # the non-zero neighbours first, in their order
+        neighbours = numpy.argsort(~nonzero, axis=-1, kind='stable')[..., :k].astype(numpy.int32)
+        return cls(neighbourhood, neighbours, numpy.take_along_axis(dense, neighbours, axis=-1))
+
+    def dense(self):
+        '''The dense (voxels, n_neighbours) weight matrix, see from_dense'''
+        n_neighbours = self.neighbourhood.n_neighbours
+        dense = numpy.zeros(self.neighbourhood.shape + (n_neighbours,), dtype=numpy.float32)
+        voxels = numpy.arange(dense.size // n_neighbours).reshape(self.neighbourhood.shape + (1,))
+        # add, as padding may repeat a neighbour (with weight 0)
+        numpy.add.at(dense.reshape(-1), (voxels * n_neighbours + self.neighbours).ravel(), self.weights.ravel())
+        return dense.reshape(-1, n_neighbours, order='F')
+
+
+@numba.njit(inline='always')
+def _wrap(i, n):
+    # periodic boundary (as index_matrix), also for offsets larger than the
+    # image, e.g. on the single plane of a (1, H, W) image
+    if 0 <= i < n:
+        return i
+    return i % n
+
+
+@numba.njit(parallel=True)
+def _de_pierro(image, image_EM, beta, offsets, neighbours, weights, inv_sum, update, out):
+    # one pass over the voxels: the regularisation image xreg and, if
+    # update, the de Pierro update of image_EM with it
+    n, m, h = image.shape
+    for i in numba.prange(n):
+        for j in range(m):
+            for l in range(h):
+                x = image[i, j, l]
+                acc = 0.
+                for k in range(neighbours.shape[3]):
+                    o = neighbours[i, j, l, k]
+                    x_nb = image[_wrap(i + offsets[o, 0], n), _wrap(j + offsets[o, 1], m),
+                                 _wrap(l + offsets[o, 2], h)]
+                    acc += weights[i, j, l, k] * (x_nb + x)
+                reg = 0.5 * acc * inv_sum[i, j, l]
+                if update:
+                    x_EM = image_EM[i, j, l]
+                    a = 1 - beta * reg
+                    out[i, j, l] = 2 * x_EM / ((a * a + 4 * beta * x_EM) ** 0.5 + a + 0.00001)
+                else:
+                    out[i, j, l] = reg
+
+
+def _run(image, image_EM, beta, weights, update, out):
+    nhood = weights.neighbourhood
+    if image.shape != nhood.shape:
+        raise ValueError("image shape {} does not match the neighbourhood {}".format(image.shape, nhood.shape))
+    if out is None:
+        out = numpy.empty(image.shape, dtype=image.dtype)
+    # 2D images as 3D ones with a single plane
+    as3d = (lambda a: a[..., None]) if image.ndim == 2 else (lambda a: a)
+    offsets = nhood.offsets if image.ndim == 3 else numpy.pad(nhood.offsets, ((0, 0), (0, 1)))
+    _de_pierro(as3d(image), as3d(image_EM), float(beta), offsets,
+               weights.neighbours[..., None, :] if image.ndim == 2 else weights.neighbours,
+               weights.weights[..., None, :] if image.ndim == 2 else weights.weights,
+               as3d(weights.inv_sum), update, as3d(out))
+    return out
+
+
+def de_pierro_regularisation(image, weights, out=None):
+    '''
+    The de Pierro regularisation image (xreg of dePierroReg in the
+    MAPEM_Bowsher notebook): for every voxel
+    0.5 * sum(w * (image[neighbour] + image[voxel])) / sum(w).
+
+    image: 2D or 3D numpy array.
+    weights: NeighbourWeights.
+    out: optional preallocated output array.
+    '''
+    return _run(image, image, 0., weights, False, out)
+
+
+def de_pierro_update(image, image_EM, beta, weights, out=None):
+    '''
+    MAP-EM image update (dePierroUpdate of the MAPEM_Bowsher notebook) with
+    the regularisation image of image, fused into one multi-threaded pass.
+
+    image: current image (before the EM update) as numpy array.
+    image_EM: image after the EM update.
+    beta: weight of the prior.
+    weights: NeighbourWeights.
+    out: optional preallocated output array, can be image_EM.
+    '''
+    if out is image:
+        raise ValueError("out cannot be image, its neighbours are still needed")
+    return _run(image, image_EM, beta, weights, True, out)
+
+
+@numba.njit(parallel=True)
+def _bowsher(image, offsets, candidates, out):
+    # for every voxel, the k candidate neighbours with the smallest absolute
+    # difference to it (the first ones on ties), by insertion into a sorted top k
+    n, m, h = image.shape
+    k = out.shape[3]
+    for i in numba.prange(n):
+        best = numpy.empty(k, dtype=image.dtype)
+        for j in range(m):
+            for l in range(h):
+                x = image[i, j, l]
+                count = 0
+                for o in candidates:
+                    d = abs(image[_wrap(i + offsets[o, 0], n), _wrap(j + offsets[o, 1], m),
+                                  _wrap(l + offsets[o, 2], h)] - x)
+                    if count < k:
+                        pos = count
+                        count += 1
+                    elif d < best[k - 1]:
+                        pos = k - 1
+                    else:
+                        continue
+                    while pos > 0 and best[pos - 1] > d:
+                        best[pos] = best[pos - 1]
+                        out[i, j, l, pos] = out[i, j, l, pos - 1]
+                        pos -= 1
+                    best[pos] = d
+                    out[i, j, l, pos] = o
+
+
+def _bowsher_kcl(image, nhood, n_neighbours, chunk_size=2**16):
+    # kcl.Prior.BowshserWeights in chunks of voxels, in Fortran order
+    flat = image.ravel(order='F')
+    neighbours = numpy.empty((flat.size, n_neighbours), dtype=numpy.int32)
+    for start in range(0, flat.size, chunk_size):
+        stop = min(start + chunk_size, flat.size)
+        differences = flat[nhood.index_matrix(start, stop)] - flat[start:stop, None]
+        neighbours[start:stop] = numpy.argsort(numpy.abs(differences), axis=1)[:, 1:n_neighbours + 1]
+    return neighbours.reshape(image.shape + (n_neighbours,), order='F')
+
+
+def bowsher_weights(image, n_neighbours, neighbourhood=None, match_kcl=False):
+    '''
+    Bowsher weights of an anatomical (side) image: for every voxel, weight 1
+    for the n_neighbours neighbours with the most similar values, 0 for the
+    others (as kcl.Prior.BowshserWeights, but as NeighbourWeights).
+
+    image: 2D or 3D numpy array.
+    n_neighbours: number of neighbours to keep.
+    neighbourhood: Neighbourhood, by default 3x3(x3) for image.
+
+    The voxel itself is never selected, and of neighbours with equal
+    differences the lower numbered ones are. kcl.Prior leaves ties to
+    numpy.argsort (and on ties with the voxel itself may select it), so
+    in constant regions the two can select different neighbours, unless
+    match_kcl, which sorts all differences as kcl.Prior does (slower).
+    '''
+    nhood = Neighbourhood(image.shape) if neighbourhood is None else neighbourhood
+    if image.shape != nhood.shape:
+        raise ValueError("image shape {} does not match the neighbourhood {}".format(image.shape, nhood.shape))
+    if n_neighbours >= nhood.n_neighbours:
+        raise ValueError("Number of most similar voxels must be smaller than number of voxels per neighbourhood")
+    candidates = numpy.delete(numpy.arange(nhood.n_neighbours, dtype=numpy.int32), nhood.centre)
+    neighbours = numpy.empty(image.shape + (n_neighbours,), dtype=numpy.int32)
+    if match_kcl:
+        neighbours = _bowsher_kcl(image, nhood, n_neighbours)
+    elif image.ndim == 2:
+        _bowsher(image[..., None], numpy.pad(nhood.offsets, ((0, 0), (0, 1))), candidates, neighbours[..., None, :])
+    else:
+        _bowsher(image, nhood.offsets, candidates, neighbours)
+    return NeighbourWeights(nhood, neighbours, numpy.ones(n_neighbours, dtype=numpy.float32))
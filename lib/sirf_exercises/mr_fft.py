@@ -0,0 +1,163 @@
+'''Batched, multi-threaded centred FFTs and coil combination for MR data.
+
+Instead of looping over coils with fftshift(ifft2(ifftshift(...))) into a
+complex128 array, the centred (inverse) FFT runs over all coils (and slices)
+in one call, e.g. for the k_array of the MR notebooks (phase encodes, coils,
+readout)
+
+    image_array = centred_ifft(k_array, axes=(0, 2))
+    image_array_sos = rss(image_array, coil_axis=1)
+
+The shifts are applied in place as phase ramps (a sign flip for even sizes),
+so apart from the result no full-size arrays are allocated, and the data stay
+complex64. The FFTs use scipy.fft (multi-threaded, with its cache of plans,
+and any backend set with scipy.fft.set_backend, e.g. pyFFTW), or numpy.fft
+if scipy is not installed.
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import functools
+
+import numpy
+
+try:
+    import scipy.fft as _fft
+except ImportError:
+    _fft = None
+
+
+@functools.lru_cache(maxsize=64)
+def _ramps(n, inverse):
+    # Input and output ramps r_in, r_out such that for a = n//2
+    #   fftshift(fft(ifftshift(x))) = r_out * fft(r_in * x)
+    # with r_in[k] = exp(s 2 pi i a k / n), r_out[m] = exp(s 2 pi i a (m - a) / n),
+    # s = 1 for the forward and -1 for the inverse transform; for even n
+    # these are (-1)^k and (-1)^(m + n/2)
+    a = n // 2
+    k = numpy.arange(n)
+    if n % 2 == 0:
+        ramp_in = (1 - 2 * (k % 2)).astype(numpy.float32)
+        ramp_out = ramp_in * (-1) ** (a % 2)
+    else:
+        s = -1 if inverse else 1
+        ramp_in = numpy.exp(s * 2j * numpy.pi * a * k / n).astype(numpy.complex64)
+        ramp_out = numpy.exp(s * 2j * numpy.pi * a * (k - a) / n).astype(numpy.complex64)
+    ramp_in.flags.writeable = False
+    ramp_out.flags.writeable = False
+    return ramp_in, ramp_out
+
+
+def _apply_ramps(x, axes, inverse, which):
+    for axis in axes:
+        shape = [1] * x.ndim
+        shape[axis] = x.shape[axis]
+        x *= _ramps(x.shape[axis], inverse)[which].reshape(shape)
+
+
+def _centred(data, axes, inverse, overwrite, workers):
+    data = numpy.asarray(data)
+    if data.dtype == numpy.complex64 and overwrite:
+        x = data
+    else:
+        # the one copy (and conversion to complex64)
+        x = numpy.array(data, dtype=numpy.complex64)
+    axes = tuple(axis % x.ndim for axis in axes)
+    _apply_ramps(x, axes, inverse, 0)
+    if _fft is not None:
+        transform = _fft.ifftn if inverse else _fft.fftn
+        y = transform(x, axes=axes, overwrite_x=True, workers=workers or -1)
+    else:
+        transform = numpy.fft.ifftn if inverse else numpy.fft.fftn
+        y = transform(x, axes=axes, out=x)
+    if y.dtype != numpy.complex64:
+        y = y.astype(numpy.complex64)
+    _apply_ramps(y, axes, inverse, 1)
+    return y
+
+
+def centred_ifft(data, axes=(0, -1), overwrite=False, workers=None):
+    '''
+    Returns fftshift(ifftn(ifftshift(data))) over axes, as complex64, for all
+    coils (and slices) at once.
+
+    data: k-space array, e.g. AcquisitionData.as_array() of fully sampled
+        Cartesian data (phase encodes, coils, readout), hence the default axes.
+    overwrite: whether data (if complex64) can be overwritten with the result.
+    workers: number of threads (default: all cores).
+    '''
+    return _centred(data, axes, True, overwrite, workers)
+
+
+def centred_fft(data, axes=(0, -1), overwrite=False, workers=None):
+    '''Returns fftshift(fftn(ifftshift(data))) over axes, see centred_ifft'''
+    return _centred(data, axes, False, overwrite, workers)
+
+
+def _coil(a, c, coil_axis):
+    # view of coil c
+    return a[(slice(None),) * coil_axis + (c,)]
+
+
+def rss(images, coil_axis=1, out=None):
+    '''
+    Returns the root sum of squares sqrt(sum_c |images_c|^2) over the coils,
+    as float32, accumulated one coil at a time into out (if given).
+    '''
+    images = numpy.asarray(images)
+    shape = images.shape[:coil_axis] + images.shape[coil_axis + 1:]
+    if out is None:
+        out = numpy.zeros(shape, dtype=numpy.float32)
+    else:
+        out[...] = 0
+    work = numpy.empty(shape, dtype=numpy.float32)
+    for c in range(images.shape[coil_axis]):
+        coil = _coil(images, c, coil_axis)
+        for part in (coil.real, coil.imag):
+            numpy.multiply(part, part, out=work, casting='unsafe')
+            out += work
+    return numpy.sqrt(out, out=out)
+
+
+def csm_combine(images, csm, coil_axis=1, normalise=True, out=None):
+    '''
+    Returns the coil combination sum_c conj(csm_c) images_c (divided by
+    sum_c |csm_c|^2 if normalise), as complex64, accumulated one coil at a
+    time into out (if given). Voxels where all csm_c are 0 are set to 0.
+
+    csm: coil sensitivity maps, with the shape of images.
+    '''
+    images = numpy.asarray(images)
+    csm = numpy.asarray(csm)
+    if images.shape != csm.shape:
+        raise ValueError('images and csm have different shapes: {} and {}'.format(images.shape, csm.shape))
+    shape = images.shape[:coil_axis] + images.shape[coil_axis + 1:]
+    if out is None:
+        out = numpy.zeros(shape, dtype=numpy.complex64)
+    else:
+        out[...] = 0
+    work = numpy.empty(shape, dtype=numpy.complex64)
+    norm = numpy.zeros(shape, dtype=numpy.float32) if normalise else None
+    norm_work = numpy.empty(shape, dtype=numpy.float32) if normalise else None
+    for c in range(images.shape[coil_axis]):
+        coil = _coil(images, c, coil_axis)
+        sensitivity = _coil(csm, c, coil_axis)
+        numpy.conjugate(sensitivity, out=work, casting='unsafe')
+        numpy.multiply(work, coil, out=work, casting='unsafe')
+        out += work
+        if normalise:
+            for part in (sensitivity.real, sensitivity.imag):
+                numpy.multiply(part, part, out=norm_work, casting='unsafe')
+                norm += norm_work
+    if normalise:
+        # out is already 0 where norm is
+        numpy.divide(out, norm, out=out, where=norm > 0)
+    return out
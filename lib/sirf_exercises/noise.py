@@ -0,0 +1,83 @@
+'''Poisson noise for simulated (PET/SPECT) data, sampled in chunks on threads.
+
+Replaces the add_noise helpers of the Synergistic notebooks, e.g.
+
+    noisy_data = poisson_noise(data, noise_factor=0.05, seed=1)
+
+The data are split in chunks of a fixed size, each with its own random
+stream (spawned from the seed), which are sampled by a pool of threads into
+a preallocated float32 array. The result hence only depends on the seed (and
+chunk_size), not on the number of threads.
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+
+def _seed_sequences(seed, n):
+    if isinstance(seed, numpy.random.Generator):
+        return seed.bit_generator.seed_seq.spawn(n)
+    if not isinstance(seed, numpy.random.SeedSequence):
+        seed = numpy.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+
+def poisson_noise(data, noise_factor=1, seed=None, rescale=True, out=None, chunk_size=2**20,
+                  n_threads=None):
+    '''
+    Returns Poisson noise realisations of |data| / noise_factor, times
+    noise_factor if rescale, as float32.
+
+    data: SIRF AcquisitionData (or any container with as_array and fill),
+        or a numpy array; the result is of the same kind.
+    noise_factor: a smaller factor means more counts, i.e. less noise.
+    seed: int, SeedSequence or Generator to spawn the streams of the chunks
+        from, None for a random seed.
+    out: optional C-contiguous float32 numpy array of the shape of data
+        for the result (e.g. a numpy.memmap), for numpy data.
+    chunk_size: number of values per chunk (and random stream).
+    n_threads: number of threads (default: the number of cores).
+    '''
+    container = None
+    if hasattr(data, 'as_array'):
+        container = data
+        data = data.as_array()
+    data = numpy.asarray(data)
+    if out is None:
+        out = numpy.empty(data.shape, dtype=numpy.float32)
+    elif out.shape != data.shape or out.dtype != numpy.float32 or not out.flags.c_contiguous:
+        # the chunks are written through a flat view of out
+        raise ValueError('out needs to be a C-contiguous float32 array of shape {}'.format(data.shape))
+    source = data.reshape(-1)
+    target = out.reshape(-1)
+    n_chunks = max(-(-source.size // chunk_size), 1)
+    seeds = _seed_sequences(seed, n_chunks)
+
+    def sample(chunk):
+        s = slice(chunk * chunk_size, (chunk + 1) * chunk_size)
+        counts = numpy.abs(source[s], dtype=numpy.float64)
+        counts /= noise_factor
+        # a chunk-sized int64 temporary, cast into the float32 output
+        target[s] = numpy.random.default_rng(seeds[chunk]).poisson(counts)
+        if rescale:
+            target[s] *= noise_factor
+
+    with ThreadPoolExecutor(min(n_threads or os.cpu_count() or 1, n_chunks)) as pool:
+        list(pool.map(sample, range(n_chunks)))
+    if container is None:
+        return out
+    noisy = container.get_uniform_copy(0)
+    noisy.fill(out)
+    return noisy
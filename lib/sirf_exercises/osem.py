@@ -0,0 +1,196 @@
+'''MLEM and OSEM with a SIRF acquisition model, with cached subset sensitivities.
+
+The (subset) sensitivity images A_s^t 1 do not change over the iterations,
+so they are computed once per acquisition model and number of subsets, and
+kept in memory (and optionally on disk). The EM updates then need one
+forward and one back projection each, and work in place on numpy arrays, e.g.
+
+    recon = EMReconstructor(acq_model, acquired_data, num_subsets=21)
+    estimated_image = recon.reconstruct(initial_image, num_iterations=2)
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import os
+import weakref
+
+import numpy
+
+# sensitivities computed in this process, by key (see sensitivity_key)
+_sensitivity_cache = {}
+# keys computed in this process, by acquisition model (id), geometry and
+# number of subsets, with a weak reference to the acquisition model
+_key_cache = {}
+
+
+def sensitivity_key(acq_model, image, acquired_data, num_subsets):
+    '''
+    Key of the subset sensitivities of acq_model: a hash of its type, the
+    image and data geometry, the number of subsets and the forward projection
+    of a uniform image (which covers attenuation and normalisation, at the
+    cost of one projection).
+    '''
+    h = hashlib.sha1()
+    h.update(type(acq_model).__name__.encode())
+    h.update(repr((tuple(image.shape), tuple(acquired_data.shape), num_subsets)).encode())
+    if hasattr(image, 'voxel_sizes'):
+        h.update(repr(_voxel_sizes(image)).encode())
+    with _subsets(acq_model, 1, 0):
+        h.update(numpy.ascontiguousarray(acq_model.forward(image.get_uniform_copy(1)).as_array(),
+                                         dtype=numpy.float32).tobytes())
+    return h.hexdigest()
+
+
+def _voxel_sizes(image):
+    return tuple(image.voxel_sizes()) if hasattr(image, 'voxel_sizes') else None
+
+
+def _cached_key(acq_model, image, acquired_data, num_subsets):
+    # sensitivity_key, computed once per acquisition model and geometry
+    geometry = (id(acq_model), tuple(image.shape), _voxel_sizes(image), tuple(acquired_data.shape),
+                num_subsets)
+    cached = _key_cache.get(geometry)
+    if cached is not None and cached[0]() is acq_model:
+        return cached[1]
+    key = sensitivity_key(acq_model, image, acquired_data, num_subsets)
+    _key_cache[geometry] = (weakref.ref(acq_model), key)
+    return key
+
+
+class _subsets:
+    # sets num_subsets and subset_num of an acquisition model, and restores them
+    def __init__(self, acq_model, num_subsets, subset_num):
+        self.acq_model = acq_model
+        self.values = (num_subsets, subset_num)
+
+    def __enter__(self):
+        self.saved = (self.acq_model.num_subsets, self.acq_model.subset_num)
+        self.acq_model.num_subsets, self.acq_model.subset_num = self.values
+
+    def __exit__(self, *args):
+        self.acq_model.num_subsets, self.acq_model.subset_num = self.saved
+
+
+def subset_sensitivities(acq_model, image, acquired_data, num_subsets, cache_dir=None, key=None):
+    '''
+    Returns the (num_subsets,) + image.shape float32 array of subset
+    sensitivity images A_s^t 1, computed once.
+
+    acq_model: set up acquisition model.
+    image: an image of the reconstruction geometry.
+    acquired_data: the measured data (only used as template).
+    num_subsets: number of subsets (1 for MLEM).
+    cache_dir: optional directory where they are stored as well, for
+        later sessions.
+    key: optional cache key. By default sensitivity_key(...), computed once
+        per acquisition model (object) and geometry, so pass a key (or
+        sensitivity_key(...)) after setting up acq_model again differently,
+        e.g. with another attenuation.
+    '''
+    if key is None:
+        key = _cached_key(acq_model, image, acquired_data, num_subsets)
+    filename = None if cache_dir is None else os.path.join(cache_dir, 'sensitivity_{}.npy'.format(key))
+    on_disk = filename is not None and os.path.exists(filename)
+    if key in _sensitivity_cache:
+        sensitivities = _sensitivity_cache[key]
+    elif on_disk:
+        sensitivities = numpy.load(filename)
+    else:
+        ones = acquired_data.get_uniform_copy(1)
+        sensitivities = numpy.empty((num_subsets,) + tuple(image.shape), dtype=numpy.float32)
+        for subset_num in range(num_subsets):
+            with _subsets(acq_model, num_subsets, subset_num):
+                sensitivities[subset_num] = acq_model.backward(ones).as_array()
+    if filename is not None and not on_disk:
+        # also when computed earlier in this process, without cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        # write and rename, such that other processes never read half a file
+        numpy.save(filename + '.tmp.npy', sensitivities)
+        os.replace(filename + '.tmp.npy', filename)
+    _sensitivity_cache[key] = sensitivities
+    return sensitivities
+
+
+class EMReconstructor:
+    '''
+    MLEM (num_subsets=1) or OSEM reconstruction with a SIRF acquisition model.
+
+    acq_model: set up acquisition model (its forward includes any additive
+        term and background). Its num_subsets and subset_num are restored
+        after every update.
+    acquired_data: the measured data.
+    num_subsets: number of subsets.
+    cache_dir: optional directory to cache the subset sensitivities in.
+    key: optional key of the subset sensitivities, see subset_sensitivities.
+
+    Voxels with zero sensitivity are set to 0, as are data bins where the
+    forward projection is 0, such that no NaNs occur.
+    '''
+
+    def __init__(self, acq_model, acquired_data, num_subsets=1, cache_dir=None, image=None, key=None):
+        self.acq_model = acq_model
+        self.acquired_data = acquired_data
+        self.num_subsets = num_subsets
+        self.cache_dir = cache_dir
+        self.key = key
+        self._data = acquired_data.as_array()
+        self._quotient = numpy.empty(self._data.shape, dtype=numpy.float32)
+        self._quotient_data = acquired_data.get_uniform_copy(0)
+        self._inv_sensitivities = None
+        if image is not None:
+            self._set_up(image)
+
+    def _set_up(self, image):
+        sensitivities = subset_sensitivities(self.acq_model, image, self.acquired_data,
+                                             self.num_subsets, self.cache_dir, self.key)
+        self._inv_sensitivities = numpy.zeros_like(sensitivities)
+        numpy.divide(1, sensitivities, out=self._inv_sensitivities, where=sensitivities > 0)
+        self._image = image.get_uniform_copy(0)
+
+    def update(self, x, subset_num=0):
+        '''One EM update of the numpy array x with subset subset_num, in place'''
+        self._image.fill(x)
+        with _subsets(self.acq_model, self.num_subsets, subset_num):
+            estimate = self.acq_model.forward(self._image).as_array()
+            # y / (A x + b), 0 outside the subset (and wherever A x + b is 0)
+            self._quotient[...] = 0
+            numpy.divide(self._data, estimate, out=self._quotient, where=estimate > 0, casting='unsafe')
+            self._quotient_data.fill(self._quotient)
+            back = self.acq_model.backward(self._quotient_data).as_array()
+        x *= back
+        x *= self._inv_sensitivities[subset_num]
+        return x
+
+    def reconstruct(self, initial_image, num_iterations, callback=None):
+        '''
+        Returns the reconstruction (an image like initial_image) after
+        num_iterations full iterations (of num_subsets updates each).
+
+        callback: optional callback(iteration, subset_num, x) called after
+            every update with the current numpy array x (do not keep it, it
+            is updated in place); the reconstruction stops if it returns True.
+        '''
+        if self._inv_sensitivities is None or self._image.shape != initial_image.shape:
+            self._set_up(initial_image)
+        x = initial_image.as_array().astype(numpy.float32)
+        stop = False
+        for iteration in range(num_iterations):
+            for subset_num in range(self.num_subsets):
+                self.update(x, subset_num)
+                if callback is not None and callback(iteration, subset_num, x):
+                    stop = True
+                    break
+            if stop:
+                break
+        image = initial_image.get_uniform_copy(0)
+        image.fill(x)
+        return image
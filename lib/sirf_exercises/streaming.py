@@ -0,0 +1,219 @@
+'''Out-of-core reconstruction: projection data streamed in chunks of views.
+
+For data that do not fit in memory (e.g. long axial FOV scanners), the
+projection data are kept in memory-mapped files (in the layout of SIRF's
+AcquisitionData.as_array(), views on the second to last axis) and processed
+a chunk of views at a time: the expectation, the ratio to the measured data,
+the back projection (accumulated into one image) and the noise. Only one
+chunk of projection data is in memory at a time, besides a few images, e.g.
+
+    def factory(template):
+        # acquisition model for the views of template (with its own
+        # subsets of normalisation, attenuation and additive term, if any)
+        acq_model = pet.AcquisitionModelUsingRayTracingMatrix()
+        acq_model.set_up(template, image)
+        return acq_model
+
+    model = SIRFViewModel(factory, acq_template, image)
+    measured = to_memmap(acquired_data, 'measured.npy')  # or open_memmap(...)
+    image_array = reconstruct(model, measured, image.as_array(), num_iterations=2, num_subsets=4)
+
+This needs a SIRF with AcquisitionData.get_subset (3.5 or later). Use
+pet.AcquisitionData.set_storage_scheme('file') (the default), not 'memory'.
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+
+import numpy
+
+from .noise import poisson_noise
+
+VIEW_AXIS = -2
+
+
+def view_chunks(n_views, chunk_views=16, subset_num=0, num_subsets=1):
+    '''
+    Returns the views of subset subset_num (every num_subsets-th view, as
+    SIRF's subsets) in chunks of at most chunk_views views: slices if
+    num_subsets is 1, index arrays otherwise.
+    '''
+    if num_subsets == 1:
+        return [slice(start, min(start + chunk_views, n_views)) for start in range(0, n_views, chunk_views)]
+    views = numpy.arange(subset_num, n_views, num_subsets)
+    return [views[start:start + chunk_views] for start in range(0, len(views), chunk_views)]
+
+
+def _index(views):
+    return (Ellipsis, views, slice(None))
+
+
+def _view_list(views):
+    # the views as a list of ints, also for a slice
+    if isinstance(views, slice):
+        return list(range(views.start, views.stop))
+    return [int(v) for v in views]
+
+
+def open_memmap(filename, shape=None, mode='r'):
+    '''
+    Opens (mode 'r' or 'r+') or creates (mode 'w+', with shape) a float32
+    .npy file as numpy.memmap.
+    '''
+    if mode == 'w+':
+        return numpy.lib.format.open_memmap(filename, mode, dtype=numpy.float32, shape=tuple(shape))
+    return numpy.lib.format.open_memmap(filename, mode)
+
+
+def to_memmap(acquisition_data, filename, chunk_views=16):
+    '''
+    Writes SIRF AcquisitionData to a .npy file, a chunk of views at a time
+    (with get_subset), and returns it as numpy.memmap.
+    '''
+    shape = acquisition_data.shape
+    out = open_memmap(filename, shape, 'w+')
+    for views in view_chunks(shape[VIEW_AXIS], chunk_views):
+        out[_index(views)] = acquisition_data.get_subset(_view_list(views)).as_array()
+    out.flush()
+    return out
+
+
+class SIRFViewModel:
+    '''
+    Forward and back projection of chunks of views with SIRF.
+
+    factory: function returning an acquisition model set up for a template
+        with a subset of the views (as returned by template.get_subset).
+    template: AcquisitionData of the full geometry (its data are not used).
+    image_template: ImageData of the reconstruction geometry.
+    max_models: number of (set up) acquisition models of chunks to keep
+        (the least recently used one is dropped), None for all of them.
+        Kept models avoid setting up the model of a chunk again in the next
+        pass, but memory grows with their number, so keep it small for
+        large data (e.g. the number of chunks per subset, if that fits).
+    '''
+
+    def __init__(self, factory, template, image_template, max_models=8):
+        self.factory = factory
+        self.template = template
+        self.image_template = image_template.get_uniform_copy(0)
+        self.max_models = max_models
+        self.n_views = template.shape[VIEW_AXIS]
+        self._models = collections.OrderedDict()
+
+    def _model(self, views):
+        key = tuple(_view_list(views))
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key]
+        sub_template = self.template.get_subset(list(key))
+        model = (self.factory(sub_template), sub_template)
+        self._models[key] = model
+        if self.max_models is not None and len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+        return model
+
+    def chunk_shape(self, views):
+        '''Returns the shape of the data of views'''
+        shape = list(self.template.shape)
+        shape[VIEW_AXIS] = len(_view_list(views))
+        return tuple(shape)
+
+    def forward(self, image, views):
+        '''Returns the projection of the image array onto views'''
+        acq_model, _ = self._model(views)
+        self.image_template.fill(image)
+        return acq_model.forward(self.image_template).as_array()
+
+    def backward(self, data, views):
+        '''Returns the back projection of the data array of views'''
+        acq_model, sub_template = self._model(views)
+        sub_template.fill(data)
+        return acq_model.backward(sub_template).as_array()
+
+
+def expectation(model, image, out, additive=None, chunk_views=16):
+    '''Writes the expectation A image (+ additive) into out, a chunk of views at a time'''
+    for views in view_chunks(model.n_views, chunk_views):
+        chunk = model.forward(image, views)
+        if additive is not None:
+            chunk += additive[_index(views)]
+        out[_index(views)] = chunk
+    return out
+
+
+def sensitivity(model, subset_num=0, num_subsets=1, chunk_views=16):
+    '''Returns the back projection of ones onto the image, for subset subset_num'''
+    total = None
+    for views in view_chunks(model.n_views, chunk_views, subset_num, num_subsets):
+        back = model.backward(numpy.ones(model.chunk_shape(views), dtype=numpy.float32), views)
+        if total is None:
+            total = back
+        else:
+            total += back
+    return total
+
+
+def em_backprojection(model, image, measured, additive=None, subset_num=0, num_subsets=1,
+                      chunk_views=16):
+    '''
+    Returns the back projection of measured / (A image + additive) for subset
+    subset_num, computed a chunk of views at a time (the ratio is 0 where
+    the expectation is 0).
+    '''
+    total = None
+    for views in view_chunks(model.n_views, chunk_views, subset_num, num_subsets):
+        estimate = model.forward(image, views)
+        if additive is not None:
+            estimate += additive[_index(views)]
+        ratio = numpy.zeros(estimate.shape, dtype=numpy.float32)
+        numpy.divide(measured[_index(views)], estimate, out=ratio, where=estimate > 0)
+        back = model.backward(ratio, views)
+        if total is None:
+            total = back
+        else:
+            total += back
+    return total
+
+
+def reconstruct(model, measured, initial_image, num_iterations, num_subsets=1, additive=None,
+                chunk_views=16, callback=None):
+    '''
+    Returns the MLEM (num_subsets=1) or OSEM reconstruction (a numpy array)
+    of measured, streaming the projection data a chunk of views at a time.
+
+    measured, additive: arrays (e.g. numpy.memmap) of the full data.
+    callback: optional callback(iteration, subset_num, image) called after
+        every update; the reconstruction stops if it returns True.
+    '''
+    image = numpy.array(initial_image, dtype=numpy.float32)
+    inv_sensitivities = []
+    for subset_num in range(num_subsets):
+        s = sensitivity(model, subset_num, num_subsets, chunk_views)
+        inv = numpy.zeros(s.shape, dtype=numpy.float32)
+        numpy.divide(1, s, out=inv, where=s > 0)
+        inv_sensitivities.append(inv)
+    for iteration in range(num_iterations):
+        for subset_num in range(num_subsets):
+            image *= em_backprojection(model, image, measured, additive, subset_num, num_subsets, chunk_views)
+            image *= inv_sensitivities[subset_num]
+            if callback is not None and callback(iteration, subset_num, image):
+                return image
+    return image
+
+
+def add_noise(data, out, noise_factor=1, seed=None, rescale=True, chunk_size=2**20, n_threads=None):
+    '''
+    Writes Poisson noise of |data| / noise_factor (see noise.poisson_noise)
+    into out, e.g. two numpy.memmap, a chunk at a time.
+    '''
+    return poisson_noise(data, noise_factor, seed, rescale, out, chunk_size, n_threads)
@@ -0,0 +1,192 @@
+'''Parallel parameter sweeps of reconstructions, with a resumable result cache.
+
+Instead of calling set_up and reconstruct for one parameter value after the
+other, e.g. for sigma_m and sigma_p of HKEM or beta of MAP-EM, the
+configurations of a parameter grid run in a pool of processes. Every worker
+calls the factory once to set up its own acquisition model and reconstructor.
+The images and metrics are stored in a cache directory under a hash of the
+parameters, such that an interrupted (or extended) sweep only runs the
+missing configurations, e.g.
+
+    def factory():
+        # set up acquisition model, objective function, reconstructor, ...
+        def reconstruct(params):
+            recon.set_sigma_m(params['sigma_m'])
+            recon.set_sigma_p(params['sigma_p'])
+            image = init_image.clone()
+            recon.set_up(image)
+            recon.reconstruct(image)
+            return image
+        return reconstruct
+
+    sweep = Sweep(factory, 'hkem_sweep', metrics={'rmse': rmse})
+    results = sweep.run(parameter_grid(sigma_m=[0.05, 0.2, 1], sigma_p=[0.05, 0.2, 2]))
+    image = sweep.image(results[0]['params'])
+
+As the reconstructions are multi-threaded themselves, use fewer threads per
+worker when running many workers (e.g. sirf.STIR.set_max_omp_threads in the
+factory). The progress is logged to the 'sirf_exercises.sweep' logger, e.g.
+logging.basicConfig(level=logging.INFO) shows it.
+'''
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# the reconstruct function and metrics of a worker process
+_worker = None
+
+
+def parameter_grid(**values):
+    '''
+    Returns all combinations of the values, as a list of dicts, e.g.
+    parameter_grid(beta=[0.1, 1], weights=['Bowsher', 'uniform']).
+    '''
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def parameter_key(params):
+    '''Returns the cache key of a dict of parameters (a hash of their values)'''
+    text = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def _write_atomic(filename, write, mode='w'):
+    # write and rename, such that the cache never holds half a file
+    with open(filename + '.tmp', mode) as f:
+        write(f)
+    os.replace(filename + '.tmp', filename)
+
+
+def _init_worker(factory, metrics):
+    global _worker
+    _worker = (factory(), metrics)
+
+
+def _run(params, key, cache_dir):
+    reconstruct, metrics = _worker
+    start = time.perf_counter()
+    try:
+        image = reconstruct(params)
+        image = numpy.asarray(image.as_array() if hasattr(image, 'as_array') else image)
+        result = dict(params=params, key=key, time=time.perf_counter() - start,
+                      metrics={name: float(metric(image)) for name, metric in metrics.items()})
+    except Exception:
+        # not cached, such that it runs again on the next run()
+        return dict(params=params, key=key, error=traceback.format_exc())
+    _write_atomic(os.path.join(cache_dir, key + '.npy'), lambda f: numpy.save(f, image), 'wb')
+    # the result last, as it marks the configuration as done
+    _write_atomic(os.path.join(cache_dir, key + '.json'), lambda f: json.dump(result, f, default=repr))
+    return result
+
+
+def _run_task(task):
+    return _run(*task)
+
+
+class Sweep:
+    '''
+    Runs a reconstruction for every configuration of a parameter grid, in
+    parallel, and caches the results.
+
+    factory: callable (picklable when using the spawn start method) returning
+        a function reconstruct(params) that returns the reconstructed image
+        (a SIRF image or numpy array) for a dict of parameters. It is called
+        once per worker process.
+    cache_dir: directory of the results, <key>.json (parameters, metrics and
+        time) and <key>.npy (image) per configuration.
+    metrics: optional dict of name: function(image array) returning a number,
+        evaluated in the workers, e.g. the RMSE to the ground truth.
+    processes: number of worker processes (default: the number of cores);
+        with 1, the configurations run in this process.
+    mp_context: multiprocessing context or start method ('fork', 'spawn', ...).
+    '''
+
+    def __init__(self, factory, cache_dir, metrics=None, processes=None, mp_context=None):
+        self.factory = factory
+        self.cache_dir = cache_dir
+        self.metrics = metrics or {}
+        self.processes = processes or os.cpu_count() or 1
+        if mp_context is None or isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        self.mp_context = mp_context
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cached(self, params):
+        '''Returns the cached result of params, None if it has not run yet'''
+        filename = os.path.join(self.cache_dir, parameter_key(params) + '.json')
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    def image(self, params, mmap_mode='r'):
+        '''Returns the cached image of params (memory-mapped by default)'''
+        return numpy.load(os.path.join(self.cache_dir, parameter_key(params) + '.npy'),
+                          mmap_mode=mmap_mode)
+
+    def run(self, grid, callback=None):
+        '''
+        Runs the configurations of grid (a list of dicts of parameters, see
+        parameter_grid) that are not cached yet, and returns the results of
+        all of them in the order of grid: dicts with 'params', 'key',
+        'metrics' and 'time' or, if the reconstruction failed, 'error'.
+
+        callback: optional callback(result) called with the result of every
+            configuration that ran, as it finishes.
+        '''
+        results = {}
+        tasks = []
+        for params in grid:
+            key = parameter_key(params)
+            result = self.cached(params)
+            if result is not None:
+                results[key] = result
+            elif key not in results:
+                results[key] = None
+                tasks.append((params, key, self.cache_dir))
+        logger.info('%d configurations cached, running %d', len(results) - len(tasks), len(tasks))
+        processes = min(self.processes, len(tasks))
+        pool = None
+        if processes <= 1:
+            if tasks:
+                _init_worker(self.factory, self.metrics)
+            done = map(_run_task, tasks)
+        else:
+            pool = self.mp_context.Pool(processes, _init_worker, (self.factory, self.metrics))
+            # one configuration at a time, as their run times differ
+            done = pool.imap_unordered(_run_task, tasks, chunksize=1)
+        try:
+            for result in done:
+                results[result['key']] = result
+                if 'error' in result:
+                    logger.warning('%s failed:\n%s', result['params'], result['error'])
+                else:
+                    logger.info('%s %s', result['params'], result['metrics'])
+                if callback is not None:
+                    callback(result)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return [results[parameter_key(params)] for params in grid]
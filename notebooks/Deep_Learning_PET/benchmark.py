@@ -0,0 +1,261 @@
+# Benchmarks the hot paths of the deep learning exercises: the sirf_torch
+# operators, the phantom generators, EllipsesDataset and LearnedPrimalDual.
+# SIRF is not needed, a (parallel beam, nearest neighbour) NumPy stand-in
+# replaces the acquisition model, so only the torch/NumPy side is measured.
+# Every case runs in a fresh process, which gives its time (median and
+# minimum of the repeats) and peak memory (the most memory allocated during
+# a run on top of what was in use before it).
+#
+# Usage:
+#   python benchmark.py [--filter SUBSTRING] [--repeat 5]
+#                       [--save BASELINE.json] [--compare BASELINE.json] [--tolerance 0.2]
+# --save stores the results as a baseline, --compare reports the cases that
+# got slower or use more memory than the baseline by more than the tolerance
+# (and exits with 1 if there are any). benchmark_baseline.json is a reference
+# baseline; the times depend on the machine (recorded in the file), so for
+# timings compare with a baseline saved on the same machine.
+
+# CCP SyneRBI Synergistic Image Reconstruction Framework (SIRF).
+
+# This is software developed for the Collaborative Computational Project in Synergistic Reconstruction for Biomedical Imaging (http://www.ccpsynerbi.ac.uk/).
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class StandInData:
+    """ Minimal stand-in for SIRF image and acquisition data (a NumPy array) """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.array = np.zeros(self.shape, dtype=np.float32)
+
+    def fill(self, values):
+        if isinstance(values, StandInData):
+            values = values.array
+        self.array[...] = np.reshape(values, self.shape) if np.ndim(values) else values
+        return self
+
+    def as_array(self):
+        return self.array.copy()
+
+    def clone(self):
+        return StandInData(self.shape).fill(self)
+
+
+class StandInAcquisitionModel:
+    """ Parallel beam projection of a (1, size, size) image into a
+    (1, 1, n_views, n_tangential) sinogram by nearest neighbour binning,
+    with backward its exact adjoint """
+    def __init__(self, size, n_views, n_tangential):
+        self.image_shape = (1, size, size)
+        self.sinogram_shape = (1, 1, n_views, n_tangential)
+        coords = np.arange(size) - (size - 1) / 2
+        x, y = np.meshgrid(coords, coords, indexing="ij")
+        angles = np.linspace(0, np.pi, n_views, endpoint=False)
+        t = np.cos(angles)[:, None] * x.ravel() + np.sin(angles)[:, None] * y.ravel()
+        bins = np.clip(np.round(t * n_tangential / (np.sqrt(2) * size) + n_tangential / 2), 0, n_tangential - 1)
+        # (n_views, size**2) index of the sinogram bin of every pixel
+        self.index = (np.arange(n_views)[:, None] * n_tangential + bins).astype(np.intp)
+
+    def forward(self, image):
+        x = np.broadcast_to(image.as_array().ravel(), self.index.shape)
+        y = np.bincount(self.index.ravel(), weights=x.ravel(), minlength=int(np.prod(self.sinogram_shape)))
+        return StandInData(self.sinogram_shape).fill(y)
+
+    def backward(self, sinogram):
+        x = sinogram.as_array().ravel()[self.index].sum(axis=0)
+        return StandInData(self.image_shape).fill(x)
+
+
+def stand_in(size):
+    # a sinogram of about the size of the image, as for thorax_single_slice
+    acq_model = StandInAcquisitionModel(size, size, size + size // 8)
+    return StandInData(acq_model.image_shape), StandInData(acq_model.sinogram_shape), acq_model
+
+
+# Every case function does its set-up and returns the function to time
+
+def ops_case(batch_size, size, direction):
+    import torch
+    from sirf_torch import primal_op, dual_op
+    image_template, sinogram_template, acq_model = stand_in(size)
+    if direction.startswith("primal"):
+        op = primal_op(image_template, sinogram_template, acq_model)
+        x = torch.rand((batch_size, 1) + image_template.shape[1:], requires_grad=True)
+    else:
+        op = dual_op(image_template, sinogram_template, acq_model)
+        x = torch.rand((batch_size, 1) + sinogram_template.shape[2:], requires_grad=True)
+    if direction.endswith("backward"):
+        out = op(x)
+        grad = torch.ones_like(out)
+        return lambda: out.backward(grad, retain_graph=True)
+    return lambda: op(x)
+
+def phantom_case(kind, size):
+    from odl_funcs.misc import random_phantom, random_shapes, ellipse_phantom, shepp_logan
+    rng = np.random.default_rng(0)
+    shape = (1, size, size)
+    if kind == "ellipse_phantom":
+        ellipses = [random_shapes(rng) for _ in range(20)]
+        return lambda: ellipse_phantom(shape[1:], ellipses)
+    if kind == "random_phantom":
+        return lambda: random_phantom(shape, rng=rng)
+    return lambda: shepp_logan(shape)
+
+def dataset_case(n_samples, size):
+    from odl_funcs.ellipses import EllipsesDataset
+    image_template, _, acq_model = stand_in(size)
+    dataset = EllipsesDataset(acq_model.forward, image_template, n_samples)
+    def run():
+        for i in range(len(dataset)):
+            dataset[i]
+    return run
+
+def lpd_case(n_iter, n_feature_channels, size, batch_size):
+    import torch
+    from lpd_net import LearnedPrimalDual
+    image_template, sinogram_template, acq_model = stand_in(size)
+    torch.manual_seed(0)
+    model = LearnedPrimalDual(image_template, sinogram_template, acq_model, n_iter=n_iter,
+                              n_feature_channels=n_feature_channels)
+    y = torch.rand((batch_size, 1) + sinogram_template.shape[2:])
+    def run():
+        model.zero_grad()
+        model(y).sum().backward()
+    return run
+
+
+def cases():
+    # name: (case function, its arguments)
+    cases = {}
+    for direction in ("primal", "primal_backward", "dual", "dual_backward"):
+        for batch_size in (1, 4, 16):
+            cases["ops/{}/batch{}".format(direction, batch_size)] = (ops_case, (batch_size, 128, direction))
+    for kind in ("ellipse_phantom", "random_phantom", "shepp_logan"):
+        for size in (128, 256, 512):
+            cases["phantoms/{}/{}".format(kind, size)] = (phantom_case, (kind, size))
+    cases["dataset/ellipses/20x128"] = (dataset_case, (20, 128))
+    for n_iter in (2, 5):
+        for n_feature_channels in (32, 64):
+            cases["lpd/iter{}/channels{}".format(n_iter, n_feature_channels)] = \
+                (lpd_case, (n_iter, n_feature_channels, 64, 2))
+    return cases
+
+def _max_rss():
+    # in bytes, ru_maxrss is in kB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def _rss():
+    # current resident set, where available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return _max_rss()
+
+def _peak_memory(run, interval=1e-3):
+    # Peak memory of run() on top of what was in use before: the largest of
+    # the peak of the Python (and NumPy) allocations, traced by tracemalloc,
+    # the peak of the resident set, sampled by a background thread (which
+    # also sees torch's CPU allocations) and, on CUDA, torch's peak
+    torch = sys.modules.get("torch")
+    cuda = torch is not None and torch.cuda.is_available()
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        cuda_before = torch.cuda.memory_allocated()
+    rss_before = _rss()
+    rss_peak = [rss_before]
+    done = threading.Event()
+    def sample():
+        while not done.wait(interval):
+            rss_peak[0] = max(rss_peak[0], _rss())
+    sampler = threading.Thread(target=sample, daemon=True)
+    tracemalloc.start()
+    sampler.start()
+    try:
+        run()
+        if cuda:
+            torch.cuda.synchronize()
+    finally:
+        done.set()
+        sampler.join()
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    peak = max(traced_peak, max(rss_peak[0], _rss()) - rss_before)
+    if cuda:
+        peak = max(peak, torch.cuda.max_memory_allocated() - cuda_before)
+    return peak
+
+def _measure(name, repeat):
+    # runs in a fresh process, the peak memory is that of the first (warm up) run
+    function, args = cases()[name]
+    run = function(*args)
+    peak_memory = _peak_memory(run)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {"time": float(np.median(times)), "min_time": float(np.min(times)),
+            "peak_memory": peak_memory}
+
+def run_benchmarks(names, repeat=5):
+    """Returns {name: {"time", "min_time", "peak_memory"}}, in seconds and bytes"""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(_measure, name, repeat).result()
+        print("{:40s} {:10.4f} s {:10.1f} MB".format(name, results[name]["time"],
+                                                      results[name]["peak_memory"] / 2**20), flush=True)
+    return results
+
+def regressions(results, baseline, tolerance=0.2, memory_slack=2**20):
+    """Returns the descriptions of the cases in results that are slower, or
+    use more memory, than in baseline by more than the (relative) tolerance"""
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result["time"] > (1 + tolerance) * old["time"]:
+            found.append("{}: time {:.4f} s, baseline {:.4f} s".format(name, result["time"], old["time"]))
+        if result["peak_memory"] > (1 + tolerance) * old["peak_memory"] + memory_slack:
+            found.append("{}: peak memory {:.1f} MB, baseline {:.1f} MB".format(
+                name, result["peak_memory"] / 2**20, old["peak_memory"] / 2**20))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the deep learning exercise code")
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="store the results as baseline in this file")
+    parser.add_argument("--compare", help="compare with the baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_benchmarks([name for name in cases() if args.filter in name], args.repeat)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"machine": platform.platform(), "results": results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        found = regressions(results, baseline, args.tolerance)
+        print("\n".join(found) if found else "No regressions")
+        sys.exit(1 if found else 0)
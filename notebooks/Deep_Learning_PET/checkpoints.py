@@ -0,0 +1,194 @@
+# Checkpoints for the training loop, written in the background. save()
+# copies the model and optimizer state into preallocated host buffers (a
+# snapshot, unlike model.state_dict(), which refers to the live weights) and
+# returns; a background thread writes the snapshot to a temporary file and
+# renames it, such that a checkpoint is either complete or absent. The last
+# keep_last and the best keep_best checkpoints are kept.
+#
+# Usage:
+#   checkpoints = CheckpointManager('checkpoints', keep_last=2, keep_best=1)
+#   state = checkpoints.load(model, optimizer)  # resume, if there is a checkpoint
+#   for epoch in range(state["epoch"] + 1 if state else 0, total_epochs):
+#       ...
+#       checkpoints.save(epoch, model, optimizer, data_log, metric=loss_valid.item())
+#   checkpoints.close()
+
+# CCP SyneRBI Synergistic Image Reconstruction Framework (SIRF).
+
+# This is software developed for the Collaborative Computational Project in Synergistic Reconstruction for Biomedical Imaging (http://www.ccpsynerbi.ac.uk/).
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import copy
+import json
+import os
+import queue
+import threading
+
+import torch
+
+
+def _snapshot(state, buffers, key=""):
+    # Copies the tensors of a (nested) state dict into the host buffers,
+    # allocated on first use, and everything else by value
+    if isinstance(state, torch.Tensor):
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != state.shape or buffer.dtype != state.dtype:
+            buffer = torch.empty(state.shape, dtype=state.dtype,
+                                 pin_memory=state.is_cuda)
+            buffers[key] = buffer
+        buffer.copy_(state.detach(), non_blocking=True)
+        return buffer
+    if isinstance(state, dict):
+        return {k: _snapshot(v, buffers, key + "/" + str(k)) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_snapshot(v, buffers, key + "/" + str(i)) for i, v in enumerate(state))
+    return copy.deepcopy(state)
+
+
+class CheckpointManager:
+    """ Writes checkpoints of the training loop asynchronously and atomically
+
+    Initialisation
+    ----------
+    directory : `str`
+        Where the checkpoints (checkpoint_<epoch>.torch_model, with the same
+        keys as trained.torch_model plus "data_log", "epoch" and "metric")
+        and their index (checkpoints.json) are written
+    keep_last : `int`
+        Number of most recent checkpoints to keep
+    keep_best : `int`
+        Number of checkpoints with the lowest metric (e.g. validation loss) to keep
+    n_buffers : `int`
+        Number of snapshots that can be in flight; save() only waits for
+        the disk if all of them are still being written
+    """
+
+    def __init__(self, directory, keep_last=3, keep_best=1, n_buffers=2):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        os.makedirs(directory, exist_ok=True)
+        self.index_file = os.path.join(directory, "checkpoints.json")
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        else:
+            # epoch and metric of the checkpoints on disk, oldest first
+            self.index = []
+        self._free = queue.Queue()
+        for _ in range(n_buffers):
+            self._free.put({})
+        self._jobs = queue.Queue()
+        self._error = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def filename(self, epoch):
+        return os.path.join(self.directory, "checkpoint_{:06d}.torch_model".format(epoch))
+
+    def save(self, epoch, model, optimizer=None, data_log=None, metric=None):
+        """Snapshots the state of the training loop at epoch and queues it for writing"""
+        self._raise()
+        buffers = self._free.get()
+        state = {"epoch": epoch, "metric": metric,
+                 "model_state_dict": _snapshot(model.state_dict(), buffers, "model")}
+        if optimizer is not None:
+            state["optimizer_state_dict"] = _snapshot(optimizer.state_dict(), buffers, "optimizer")
+        if data_log is not None:
+            # the lists grow, but their items are not changed afterwards
+            state["data_log"] = {k: list(v) if isinstance(v, list) else copy.deepcopy(v)
+                                 for k, v in data_log.items()}
+        copied = None
+        if torch.cuda.is_available() and any(b.is_pinned() for b in buffers.values()):
+            copied = torch.cuda.Event()
+            copied.record()
+        self._jobs.put((state, buffers, copied))
+
+    def _write_loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            state, buffers, copied = job
+            try:
+                if copied is not None:
+                    copied.synchronize()
+                filename = self.filename(state["epoch"])
+                torch.save(state, filename + ".tmp")
+                os.replace(filename + ".tmp", filename)
+                self._rotate(state["epoch"], state["metric"])
+            except Exception as e:
+                self._error = e
+            finally:
+                self._free.put(buffers)
+                self._jobs.task_done()
+
+    def _rotate(self, epoch, metric):
+        with self._lock:
+            removed = self._update_index(epoch, metric)
+        for entry in removed:
+            if os.path.exists(self.filename(entry["epoch"])):
+                os.remove(self.filename(entry["epoch"]))
+
+    def _update_index(self, epoch, metric):
+        self.index = [entry for entry in self.index if entry["epoch"] != epoch]
+        self.index.append({"epoch": epoch, "metric": metric})
+        keep = {entry["epoch"] for entry in self.index[-self.keep_last:]} if self.keep_last > 0 else set()
+        scored = sorted((entry for entry in self.index if entry["metric"] is not None),
+                        key=lambda entry: entry["metric"])
+        keep |= {entry["epoch"] for entry in scored[:self.keep_best]}
+        removed = [entry for entry in self.index if entry["epoch"] not in keep]
+        self.index = [entry for entry in self.index if entry["epoch"] in keep]
+        # index first, such that it never lists a removed file
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+        return removed
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def wait(self):
+        """Blocks until all queued checkpoints are written"""
+        self._jobs.join()
+        self._raise()
+
+    def close(self):
+        """Writes the queued checkpoints and stops the background thread"""
+        self._jobs.put(None)
+        self._thread.join()
+        self._raise()
+
+    def latest(self):
+        """Filename of the most recent checkpoint, None if there is none"""
+        with self._lock:
+            return self.filename(self.index[-1]["epoch"]) if self.index else None
+
+    def best(self):
+        """Filename of the checkpoint with the lowest metric, None if there is none"""
+        with self._lock:
+            scored = [entry for entry in self.index if entry["metric"] is not None]
+        if not scored:
+            return None
+        return self.filename(min(scored, key=lambda entry: entry["metric"])["epoch"])
+
+    def load(self, model, optimizer=None, filename=None, map_location=None):
+        """Restores model (and optimizer) from a checkpoint, by default the latest
+
+        Returns the checkpoint's dict (with "epoch", "metric" and "data_log"),
+        or None if there is no checkpoint.
+        """
+        self.wait()
+        filename = filename or self.latest()
+        if filename is None:
+            return None
+        # the data log holds numpy arrays, which weights_only does not allow
+        checkpoint = torch.load(filename, map_location=map_location, weights_only=False)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        if optimizer is not None and 'optimizer_state_dict' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        return checkpoint
@@ -0,0 +1,49 @@
+# Simulates an ellipses dataset once, such that training can read it with
+# odl_funcs.ellipses.EllipsesStore instead of simulating in every epoch.
+# A store that is up to date (same mode, seed, number of samples and geometry)
+# is left alone.
+#
+# Usage:
+#   python generate_ellipses.py DIRECTORY [--n_samples N] [--mode train|valid]
+#                               [--seed S] [--size_xy 128] [--num_workers 4]
+
+# CCP SyneRBI Synergistic Image Reconstruction Framework (SIRF).
+
+# This is software developed for the Collaborative Computational Project in Synergistic Reconstruction for Biomedical Imaging (http://www.ccpsynerbi.ac.uk/).
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import functools
+
+from odl_funcs.ellipses import generate_ellipses_store
+
+
+def thorax_single_slice(size_xy):
+    # same set-up as in the notebooks
+    import sirf.STIR as pet
+    from sirf.Utilities import examples_data_path
+    pet.set_verbosity(0)
+    pet.AcquisitionData.set_storage_scheme("memory")
+    sinogram_template = pet.AcquisitionData(examples_data_path('PET')
+                                            + '/thorax_single_slice/template_sinogram.hs')
+    acq_model = pet.AcquisitionModelUsingParallelproj()
+    image_template = sinogram_template.create_uniform_image(1.0, size_xy)
+    acq_model.set_up(sinogram_template, image_template)
+    return image_template, sinogram_template, acq_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate an ellipses dataset")
+    parser.add_argument("directory")
+    parser.add_argument("--n_samples", type=int, default=100)
+    parser.add_argument("--mode", default="train", choices=["train", "valid"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--size_xy", type=int, default=128)
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument("--num_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    generated = generate_ellipses_store(args.directory, functools.partial(thorax_single_slice, args.size_xy),
+                                        args.n_samples, args.mode, args.seed, args.shard_size, args.num_workers)
+    print("Generated" if generated else "Up to date:", args.directory)
@@ -29,9 +29,16 @@ Adler & Öktem (2017), https://arxiv.org/abs/1707.06474
 """
 
 
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 import torch.nn as nn
-from sirf_torch import primal_op, dual_op
+from torch.utils.checkpoint import checkpoint
+from sirf_torch import primal_op, dual_op, sparse_primal_op, sparse_dual_op
+from profiling import profiled, timed
 
 
 class ConcatenateLayer(nn.Module):
@@ -89,6 +96,21 @@ class PrimalNet(nn.Module):
         x = f + self.block(x)
         return x
     
+class SaveIntermediates:
+    """Callback for LearnedPrimalDual.forward writing intermediate values to disk
+
+    Every value ends up in ``directory/{name}_{iteration}_{first}.npy``, where
+    name is "f" or "h" and first is the index of its first sample in the
+    mini-batch. Files of the previous forward call get overwritten.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def __call__(self, name, iteration, value, first):
+        filename = "{}_{}_{}.npy".format(name, iteration, first)
+        np.save(os.path.join(self.directory, filename), value.cpu().numpy())
+
 class LearnedPrimalDual(nn.Module):
     def __init__(self,
                 image_template,
@@ -100,7 +122,13 @@ class LearnedPrimalDual(nn.Module):
                 n_primal = 5,
                 n_dual = 5,
                 n_layers = 5,
-                n_feature_channels = 128):
+                n_feature_channels = 128,
+                pool = None,
+                staging = False,
+                micro_batches = 1,
+                checkpointing = False,
+                system_matrix = None,
+                precision = None):
         
         super(LearnedPrimalDual, self).__init__()
         
@@ -115,8 +143,27 @@ class LearnedPrimalDual(nn.Module):
         self.primal_shape = (n_primal,) + image_template.shape[1:]
         self.dual_shape = (n_dual,) + sinogram_template.shape[2:] 
         
-        self.primal_op_layer = primal_op(image_template, sinogram_template, acq_model)
-        self.dual_op_layer = dual_op(image_template, sinogram_template, acq_model)
+        if system_matrix is not None:
+            # explicit sirf_torch.SystemMatrix of acq_model, projecting on the device
+            self.primal_op_layer = sparse_primal_op(system_matrix)
+            self.dual_op_layer = sparse_dual_op(system_matrix)
+        else:
+            # pool: optional sirf_torch.ProjectorPool projecting the batch items concurrently
+            # staging: move operator data through reusable sirf_torch.StagingBuffers
+            self.primal_op_layer = primal_op(image_template, sinogram_template, acq_model, pool, staging)
+            self.dual_op_layer = dual_op(image_template, sinogram_template, acq_model, pool, staging)
+        
+        # micro_batches > 1: overlap the projections of one micro-batch with
+        # the CNN blocks of the others, in forward only
+        self.micro_batches = micro_batches
+        self._micro_ops = []
+        # checkpointing: recompute the activations of the CNN blocks in backward
+        # instead of keeping those of all iterations alive
+        self.checkpointing = checkpointing
+        # precision: None (full precision), torch.bfloat16 or torch.float16.
+        # The CNN blocks then run under torch.autocast with this type, while
+        # the operators and the f/h iterates stay in float32.
+        self.precision = precision
         
         self.primal_nets = nn.ModuleList()
         self.dual_nets = nn.ModuleList()
@@ -138,35 +185,143 @@ class LearnedPrimalDual(nn.Module):
         self.primal_nets.apply(init_weights)
         self.dual_nets.apply(init_weights)
 
-    def forward(self, g, intermediate_values = False):
-        
+    def _run_block(self, net, *args):
+        # the block's output is added to a float32 iterate, so it is float32
+        # as well, whatever the autocast type
+        with torch.autocast(args[0].device.type, dtype=self.precision,
+                            enabled=self.precision is not None):
+            return net(*args)
+
+    @staticmethod
+    def _project(op, x):
+        # The operators always run in float32, also when the caller wraps
+        # forward in an autocast region
+        with torch.autocast(x.device.type, enabled=False):
+            return op(x)
+
+    def _block(self, net, x, op_x, *args):
+        # Applies one CNN block. When checkpointing, its activations are
+        # recomputed in backward, but the SIRF operators are not re-run.
+        if not (self.checkpointing and torch.is_grad_enabled()):
+            return self._run_block(net, x, op_x, *args)
+        if self.primal_op_layer.staging is not None:
+            # the recomputation needs op_x, but its staging buffer gets
+            # overwritten by the next iteration
+            op_x = op_x.clone()
+        return checkpoint(self._run_block, net, x, op_x, *args, use_reentrant=False)
+
+    def grad_scaler(self, init_scale = 1.0):
+        """Loss scaling for training with the precision of the model
+
+        Returns a torch.amp.GradScaler, which is only enabled for float16. The
+        default initial scale suits the MSELoss(reduction='sum') used for
+        training, whose gradients overflow float16 with the usual 2**16.
+        Use as scaler.scale(loss).backward(), scaler.unscale_(optimizer)
+        (before clipping), scaler.step(optimizer) and scaler.update().
+        """
+        device = next(self.parameters()).device.type
+        return torch.amp.GradScaler(device, init_scale = init_scale,
+                                    enabled = self.precision == torch.float16)
+
+    def _unrolled(self, g, ops, intermediate_values = False, first = 0):
+        # One pass through the unrolled iterations for the batch g. This is a
+        # generator: every operator application is yielded as (op, input) and
+        # its result is sent back in, such that the caller decides where and
+        # when the (CPU bound) SIRF projections run.
         h = torch.zeros(g.shape[0:1] + (self.dual_shape), device=g.device)
         f = torch.zeros(g.shape[0:1] + (self.primal_shape), device=g.device)
+        primal_op_layer, dual_op_layer = ops
         
-        if intermediate_values:
-            h_values = []
-            f_values = []
+        h_values = []
+        f_values = []
+        if callable(intermediate_values):
+            # stream the values instead of keeping them
+            def keep(name, values, i, value):
+                intermediate_values(name, i, value.detach(), first)
+        else:
+            def keep(name, values, i, value):
+                if intermediate_values:
+                    values.append(value)
             
         for i in range(self.n_iter):
             ## Dual
             # Apply forward operator to f^(2)
             f_2 = f[:,1:2]
-            if intermediate_values:
-                f_values.append(f)
-            Op_f = self.primal_op_layer(f_2)
+            keep("f", f_values, i, f)
+            Op_f = yield timed(primal_op_layer, "primal_op", i), f_2
             # Apply dual network
-            h = self.dual_nets[i](h, Op_f, g)
+            h = profiled(self._block, "dual_cnn", i, self.dual_nets[i], h, Op_f, g)
             
             ## Primal
             # Apply adjoint operator to h^(1)
             h_1 = h[:,0:1]
-            if intermediate_values:
-                h_values.append(h)
-            OpAdj_h = self.dual_op_layer(h_1)
+            keep("h", h_values, i, h)
+            OpAdj_h = yield timed(dual_op_layer, "dual_op", i), h_1
             # Apply primal network
-            f = self.primal_nets[i](f, OpAdj_h)
+            f = profiled(self._block, "primal_cnn", i, self.primal_nets[i], f, OpAdj_h)
+        
+        return f[:,0:1], f_values, h_values
+
+    def _micro_batch_ops(self, n):
+        # Every micro-batch needs its own operator layers, as staging buffers
+        # cannot be shared between micro-batches that are in flight together
+        while len(self._micro_ops) < n:
+            self._micro_ops.append((self.primal_op_layer.replica(), self.dual_op_layer.replica()))
+        return self._micro_ops[:n]
+
+    def _forward_pipelined(self, g, intermediate_values):
+        # Splits g into micro-batches and runs their projections on a
+        # background thread, while the main thread runs the CNN blocks of the
+        # other micro-batches. This only overlaps forward: the autograd engine
+        # runs the backward of all micro-batches one after another on a single
+        # thread (per device), so there the SIRF projections do not overlap
+        # with the CNN blocks (a pool still runs each of them concurrently).
+        chunks = g.chunk(self.micro_batches)
+        firsts = [sum(len(chunk) for chunk in chunks[:k]) for k in range(len(chunks))]
+        passes = [self._unrolled(chunk, ops, intermediate_values, first)
+                  for chunk, ops, first in zip(chunks, self._micro_batch_ops(len(chunks)), firsts)]
+        results = [None] * len(passes)
+        grad_enabled = torch.is_grad_enabled()
+        
+        def project(op, x):
+            # grad mode is thread local
+            with torch.set_grad_enabled(grad_enabled):
+                return self._project(op, x)
+        
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            in_flight = deque((k, executor.submit(project, *next(p))) for k, p in enumerate(passes))
+            while in_flight:
+                k, future = in_flight.popleft()
+                try:
+                    op, x = passes[k].send(future.result())
+                    in_flight.append((k, executor.submit(project, op, x)))
+                except StopIteration as finished:
+                    results[k] = finished.value
+        
+        f = torch.cat([r[0] for r in results])
+        f_values = [torch.cat(values) for values in zip(*[r[1] for r in results])]
+        h_values = [torch.cat(values) for values in zip(*[r[2] for r in results])]
+        return f, f_values, h_values
+
+    def forward(self, g, intermediate_values = False):
+        # intermediate_values: False, True (f and h of all iterations are
+        # returned in lists) or a callable, which then gets called as
+        # intermediate_values(name, iteration, value, first) with
+        # name "f" or "h", the detached value and the index of its first
+        # sample in g (see SaveIntermediates)
+        
+        if self.micro_batches > 1 and g.shape[0] > 1:
+            f, f_values, h_values = self._forward_pipelined(g, intermediate_values)
+        else:
+            unrolled = self._unrolled(g, (self.primal_op_layer, self.dual_op_layer), intermediate_values)
+            try:
+                op, x = next(unrolled)
+                while True:
+                    op, x = unrolled.send(self._project(op, x))
+            except StopIteration as finished:
+                f, f_values, h_values = finished.value
         
-        if intermediate_values:
-            return f[:,0:1], f_values, h_values
+        if intermediate_values and not callable(intermediate_values):
+            return f, f_values, h_values
 
-        return f[:,0:1]
\ No newline at end of file
+        return f
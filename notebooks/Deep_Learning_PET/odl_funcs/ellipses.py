@@ -10,9 +10,14 @@
 # Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
 
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import torch
 import numpy as np
-from .misc import random_phantom, shepp_logan
+from .misc import random_phantoms, shepp_logan
 
 class EllipsesDataset(torch.utils.data.Dataset):
 
@@ -29,26 +34,32 @@ class EllipsesDataset(torch.utils.data.Dataset):
     mode : `string`
         Type of data: training, validation and testing
     seed : `int`
-        The seed used for the random ellipses
+        The seed used for the random ellipses and the noise. Every index gets
+        its own numpy.random.Generator derived from it, so a sample only
+        depends on seed and index (not on the DataLoader workers).
     """
 
     def __init__(self, fwd_op, image_template, n_samples = 100, mode="train", seed = 1):
         self.fwd_op = fwd_op
         self.image_template = image_template
         self.n_samples = n_samples
+        self.seed = seed
 
         if mode == 'valid':
             self.x_gt = shepp_logan(self.image_template.shape)
-            self.y = self.__get_measured__(self.x_gt)
+            self.y = self.__get_measured__(self.x_gt, np.random.default_rng(np.random.SeedSequence(seed)))
 
         self.primal_op_layer = fwd_op
         self.mode = mode
-        np.random.seed(seed)
 
-    def __get_measured__(self, x_gt):
+    def __rng__(self, index):
+        # independent stream per index, children of the SeedSequence of seed
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(index,)))
+
+    def __get_measured__(self, x_gt, rng):
         # Forward project image then add noise
         y = self.fwd_op(self.image_template.fill(x_gt))
-        y = np.random.poisson(y.as_array()[0])
+        y = rng.poisson(y.as_array()[0])
         return y
 
     def __len__(self):
@@ -58,8 +69,10 @@ class EllipsesDataset(torch.utils.data.Dataset):
     def __getitem__(self, index):
         # Generates one sample of data
         if self.mode == "train":
-            x_gt = random_phantom(self.image_template.shape)
-            y = self.__get_measured__(x_gt)
+            rng = self.__rng__(index)
+            # single sample, DataLoader workers do the parallelisation
+            x_gt = random_phantoms(self.image_template.shape, 1, rng=rng, parallel=False)[0]
+            y = self.__get_measured__(x_gt, rng)
 
         elif self.mode == "valid":
             x_gt = self.x_gt
@@ -68,4 +81,126 @@ class EllipsesDataset(torch.utils.data.Dataset):
         else:
             NotImplementedError
 
-        return x_gt, y
\ No newline at end of file
+        return x_gt, y
+
+
+def _geometry(image_template, sinogram_template):
+    # what the simulated data depend on, apart from mode, seed and n_samples
+    geometry = {"image_shape": list(image_template.shape),
+                "sinogram_shape": list(sinogram_template.shape)}
+    if hasattr(image_template, "voxel_sizes"):
+        geometry["voxel_sizes"] = [float(v) for v in image_template.voxel_sizes()]
+    return geometry
+
+# the EllipsesDataset of a generating process
+_generator = {}
+
+def _init_generator(factory, n_samples, mode, seed):
+    image_template, _, acq_model = factory()
+    _generator["dataset"] = EllipsesDataset(acq_model.forward, image_template, n_samples, mode, seed)
+
+def _generate_shard(directory, shard, start, count):
+    dataset = _generator["dataset"]
+    files = {}
+    for name, item in zip(("x", "y"), dataset[start]):
+        files[name] = "{}_{:05d}.npy".format(name, shard)
+        files[name + "_array"] = np.lib.format.open_memmap(
+            os.path.join(directory, files[name] + ".tmp"), mode="w+",
+            dtype=np.float32, shape=(count,) + item.shape)
+        files[name + "_array"][0] = item
+    for i in range(1, count):
+        files["x_array"][i], files["y_array"][i] = dataset[start + i]
+    for name in ("x", "y"):
+        files.pop(name + "_array").flush()
+        os.replace(os.path.join(directory, files[name] + ".tmp"), os.path.join(directory, files[name]))
+    return {"x": files["x"], "y": files["y"], "n": count}
+
+def generate_ellipses_store(directory, factory, n_samples = 100, mode = "train", seed = 1,
+                            shard_size = 1000, num_workers = 0):
+
+    """ Simulates an EllipsesDataset once and stores it for EllipsesStore
+
+    Phantoms and noisy sinograms are written as float32 .npy shards together
+    with a manifest.json. Nothing is done if the directory already holds a
+    store for the same mode, seed, n_samples and template geometry.
+
+    Parameters
+    ----------
+    directory : `string`
+        Where to write the store
+    factory : `callable`
+        Returns a set up ``(image_template, sinogram_template, acq_model)``
+        triplet. Every worker calls it once, so with ``num_workers > 0`` it
+        needs to be picklable.
+    n_samples, mode, seed :
+        As for `EllipsesDataset`. The "valid" mode only stores one sample.
+    shard_size : `int`
+        Number of samples per file
+    num_workers : `int`
+        Number of processes simulating shards in parallel, 0 simulates in
+        this process
+
+    Returns
+    -------
+    generated : `bool`
+        False if the store was up to date
+    """
+    image_template, sinogram_template, _ = factory()
+    key = {"mode": mode, "seed": seed, "n_samples": n_samples,
+           "geometry": _geometry(image_template, sinogram_template)}
+    manifest_file = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f)["key"] == key:
+                return False
+        os.remove(manifest_file)
+
+    os.makedirs(directory, exist_ok=True)
+    n_stored = n_samples if mode == "train" else 1
+    starts = range(0, n_stored, shard_size)
+    jobs = [(directory, shard, start, min(shard_size, n_stored - start)) for shard, start in enumerate(starts)]
+    if num_workers > 0:
+        with ProcessPoolExecutor(num_workers, initializer=_init_generator,
+                                 initargs=(factory, n_samples, mode, seed)) as executor:
+            shards = list(executor.map(_generate_shard, *zip(*jobs)))
+    else:
+        _init_generator(factory, n_samples, mode, seed)
+        shards = [_generate_shard(*job) for job in jobs]
+
+    manifest = {"key": key, "hash": hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest(),
+                "n_stored": n_stored, "shard_size": shard_size, "shards": shards}
+    # written last, such that an interrupted generation is redone
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    return True
+
+class EllipsesStore(torch.utils.data.Dataset):
+
+    """ Pytorch Dataset reading the samples written by generate_ellipses_store
+
+    The shards are memory-mapped (copy-on-write), so samples are not copied
+    when read and no projections are done.
+
+    Initialisation
+    ----------
+    directory : `string`
+        Directory of the store
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.n_samples = self.manifest["key"]["n_samples"]
+        self.n_stored = self.manifest["n_stored"]
+        self.shard_size = self.manifest["shard_size"]
+        self.x = [np.load(os.path.join(directory, shard["x"]), mmap_mode="c") for shard in self.manifest["shards"]]
+        self.y = [np.load(os.path.join(directory, shard["y"]), mmap_mode="c") for shard in self.manifest["shards"]]
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, index):
+        # the "valid" mode stores a single sample
+        shard, i = divmod(index % self.n_stored, self.shard_size)
+        return self.x[shard][i], self.y[shard][i]
@@ -14,6 +14,11 @@
 
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def _getshapes_2d(center, max_radius, shape):
     """Calculate indices and slices for the bounding box of a disk."""
@@ -131,23 +136,278 @@ def ellipse_phantom(shape, ellipses):
         p[idx][inside] += intensity
     return p
 
-def random_shapes():
-    x_0 = 1 * np.random.rand() - 0.5
-    y_0 = 1 * np.random.rand() - 0.5
-    return [np.random.exponential(0.4),
-            1 * np.random.rand() - 0.5, 1 * np.random.rand() - 0.5,
+def _rotation_matrices(angles):
+    """Rotation matrices for ``(..., 1)`` (2d) or ``(..., 3)`` (3d, Euler
+    angles phi, theta, psi as in ODL) arrays of angles."""
+    if angles.shape[-1] == 1:
+        c, s = np.cos(angles[..., 0]), np.sin(angles[..., 0])
+        return np.stack([np.stack([c, s], -1),
+                         np.stack([-s, c], -1)], -2)
+    cphi, sphi = np.cos(angles[..., 0]), np.sin(angles[..., 0])
+    ctheta, stheta = np.cos(angles[..., 1]), np.sin(angles[..., 1])
+    cpsi, spsi = np.cos(angles[..., 2]), np.sin(angles[..., 2])
+    return np.stack([
+        np.stack([cpsi * cphi - ctheta * sphi * spsi,
+                  cpsi * sphi + ctheta * cphi * spsi,
+                  spsi * stheta], -1),
+        np.stack([-spsi * cphi - ctheta * sphi * cpsi,
+                  -spsi * sphi + ctheta * cphi * cpsi,
+                  cpsi * stheta], -1),
+        np.stack([stheta * sphi, -stheta * cphi, ctheta], -1)], -2)
+
+def _batch_phantoms(shape, params, dtype, odl_boxes, chunk_size, parallel):
+    """Rasterize ``(B, E, 2 + 3 * ndim [+ 2])`` ellipse(oid) parameters."""
+    params = np.asarray(params, dtype=float)
+    batch_size, n_ellipses = params.shape[:2]
+    ndim = len(shape)
+    shape = np.array(shape)
+    params = params.reshape(-1, params.shape[-1])
+
+    intensity = params[:, 0]
+    axes = params[:, 1:1 + ndim]
+    centers = params[:, 1 + ndim:1 + 2 * ndim]
+    mat = _rotation_matrices(params[:, 1 + 2 * ndim:])
+
+    # x^T Q x <= 1 inside, with x relative to the center
+    with np.errstate(divide='ignore'):
+        scales = 1 / np.square(axes)
+    Q = np.einsum('nki,nk,nkj->nij', mat, scales, mat)
+
+    if odl_boxes:
+        # bounding boxes as used by ellipse_phantom
+        max_radius = np.sqrt(np.einsum('nij,nj->ni', np.abs(mat), np.square(axes)))
+        index_mean = shape * (centers + 1.0) / 2.0
+        index_radius = max_radius / 2.0 * shape
+        lower = np.floor(index_mean - index_radius)
+        upper = np.ceil(index_mean + index_radius)
+    else:
+        # tight bounding boxes
+        radius = np.sqrt(np.einsum('nki,nk->ni', np.square(mat), np.square(axes)))
+        lower = np.floor((centers - radius + 1) / 2 * (shape - 1))
+        upper = np.ceil((centers + radius + 1) / 2 * (shape - 1)) + 1
+    lower = np.clip(lower, 0, shape).astype(np.int64)
+    upper = np.clip(upper, 0, shape).astype(np.int64)
+    grids = [np.linspace(-1, 1, n) for n in shape]
+
+    if numba is not None:
+        phantoms = np.zeros((batch_size,) + tuple(shape), dtype=dtype)
+        _rasterizers[ndim, parallel](phantoms, n_ellipses, intensity, centers, Q, lower, upper, *grids)
+        return phantoms
+
+    sample = np.repeat(np.arange(batch_size), n_ellipses)
+    # padding adds nothing
+    used = intensity != 0
+    sample, intensity, centers, Q = sample[used], intensity[used], centers[used], Q[used]
+    lower, upper = lower[used], upper[used]
+    return _vectorized_phantoms(shape, batch_size, sample, intensity, centers, Q,
+                                lower, upper, grids, chunk_size).astype(dtype, copy=False)
+
+if numba is not None:
+    # One thread per image row (slice in 3d), each loops over the ellipses
+    # and the part of its row within their bounding boxes
+
+    def _rasterize_2d(out, n_ellipses, intensity, centers, Q, lower, upper, grid0, grid1):
+        n_rows = out.shape[1]
+        for row in numba.prange(out.shape[0] * n_rows):
+            b, i = row // n_rows, row % n_rows
+            for e in range(b * n_ellipses, (b + 1) * n_ellipses):
+                if intensity[e] == 0 or i < lower[e, 0] or i >= upper[e, 0]:
+                    continue
+                dx = grid0[i] - centers[e, 0]
+                for j in range(lower[e, 1], upper[e, 1]):
+                    dy = grid1[j] - centers[e, 1]
+                    radius = Q[e, 0, 0] * dx ** 2 + Q[e, 1, 1] * dy ** 2 + 2 * Q[e, 0, 1] * dx * dy
+                    if radius <= 1:
+                        out[b, i, j] += intensity[e]
+
+    def _rasterize_3d(out, n_ellipses, intensity, centers, Q, lower, upper, grid0, grid1, grid2):
+        n_slices = out.shape[1]
+        for slice_ in numba.prange(out.shape[0] * n_slices):
+            b, i = slice_ // n_slices, slice_ % n_slices
+            for e in range(b * n_ellipses, (b + 1) * n_ellipses):
+                if intensity[e] == 0 or i < lower[e, 0] or i >= upper[e, 0]:
+                    continue
+                dx = grid0[i] - centers[e, 0]
+                for j in range(lower[e, 1], upper[e, 1]):
+                    dy = grid1[j] - centers[e, 1]
+                    for k in range(lower[e, 2], upper[e, 2]):
+                        dz = grid2[k] - centers[e, 2]
+                        radius = (Q[e, 0, 0] * dx ** 2 + Q[e, 1, 1] * dy ** 2 + Q[e, 2, 2] * dz ** 2
+                                  + 2 * Q[e, 0, 1] * dx * dy + 2 * Q[e, 0, 2] * dx * dz
+                                  + 2 * Q[e, 1, 2] * dy * dz)
+                        if radius <= 1:
+                            out[b, i, j, k] += intensity[e]
+
+    # numba's thread pool does not survive a fork, so code running in
+    # DataLoader workers needs the serial versions
+    _rasterizers = {(ndim, parallel): numba.njit(parallel=parallel)(rasterize)
+                    for ndim, rasterize in ((2, _rasterize_2d), (3, _rasterize_3d))
+                    for parallel in (False, True)}
+
+def _vectorized_phantoms(shape, batch_size, sample, intensity, centers, Q, lower, upper, grids, chunk_size):
+    """Numpy version of the rasterization for when numba is not available.
+
+    Each ellipse is evaluated on the grid points of its bounding box, where
+    the boxes are padded to a common size within chunks of similarly sized
+    ellipses. The values of all points inside are then summed into their
+    phantoms with one bincount.
+    """
+    ndim = len(shape)
+    extent = np.maximum(upper - lower, 0)
+    strides = np.cumprod(np.r_[shape[1:], 1][::-1])[::-1]
+    order = np.argsort(np.prod(extent, axis=1))
+    indices = []
+    values = []
+    start = 0
+    while start < len(order):
+        # grow the chunk while the padded boxes fit into chunk_size
+        stop = start + 1
+        while stop < len(order) and \
+                (stop + 1 - start) * np.prod(extent[order[stop]]) <= chunk_size:
+            stop += 1
+        n = order[start:stop]
+        box = extent[n].max(axis=0)
+
+        offsets = []
+        radius = 0
+        points = sample[n].reshape([-1] + [1] * ndim) * np.prod(shape)
+        for i in range(ndim):
+            box_shape = [-1] + [1] * ndim
+            box_shape[1 + i] = box[i]
+            k = lower[n, i:i + 1] + np.arange(box[i])
+            outside = k >= upper[n, i:i + 1]
+            k = np.minimum(k, shape[i] - 1)
+            offset = (grids[i][k] - centers[n, i:i + 1]).reshape(box_shape)
+            square = Q[n, i, i].reshape([-1] + [1] * ndim) * offset ** 2
+            square[outside.reshape(box_shape)] = np.inf
+            offsets.append(offset)
+            radius = radius + square
+            points = points + (k * strides[i]).reshape(box_shape)
+        for i in range(ndim):
+            for j in range(i + 1, ndim):
+                radius = radius + (2 * Q[n, i, j].reshape([-1] + [1] * ndim) * offsets[i]) * offsets[j]
+        inside = radius <= 1
+        indices.append(points[inside])
+        values.append(np.broadcast_to(intensity[n].reshape([-1] + [1] * ndim), inside.shape)[inside])
+        start = stop
+
+    phantoms = np.bincount(np.concatenate(indices + [np.zeros(0, int)]),
+                           np.concatenate(values + [np.zeros(0)]),
+                           minlength=batch_size * np.prod(shape))
+    return phantoms.reshape((batch_size,) + tuple(shape))
+
+def ellipse_phantoms(shape, params, dtype=np.float64, chunk_size=2**24, parallel=True):
+
+    """Create a batch of phantoms of ellipses in 2d space.
+
+    Batched version of `ellipse_phantom`, giving the same phantoms (up to
+    round-off for pixels on the edge of an ellipse). Runs in parallel with
+    numba if it is installed, and vectorized with numpy otherwise.
+
+    Parameters
+    ----------
+    shape : `tuple`
+        Size of each image
+    params : array-like
+        ``(B, E, 6)`` array with E ellipses for each of the B phantoms, in the
+        format of ``ellipses`` of `ellipse_phantom`. Phantoms with fewer
+        ellipses can be padded with ellipses of ``value`` 0.
+    dtype : numpy dtype
+        Type of the output, e.g. ``np.float32``
+    chunk_size : `int`
+        Upper limit for the number of grid points times ellipses handled at
+        once without numba, which bounds the memory use
+    parallel : `bool`
+        Use numba's thread pool. Switch it off in processes that fork, e.g.
+        in a Dataset used with ``num_workers > 0``.
+
+    Returns
+    -------
+    phantoms : numpy.ndarray
+        ``(B,) + shape`` array
+    """
+    return _batch_phantoms(shape, params, dtype, True, chunk_size, parallel)
+
+def ellipsoid_phantoms(shape, params, dtype=np.float64, chunk_size=2**24, parallel=True):
+
+    """Create a batch of phantoms of ellipsoids in 3d space.
+
+    Parameters
+    ----------
+    shape : `tuple`
+        Size of each volume
+    params : array-like
+        ``(B, E, 10)`` array with E ellipsoids for each of the B phantoms.
+        Each row should contain the entries ::
+
+            'value',
+            'axis_1', 'axis_2', 'axis_3',
+            'center_x', 'center_y', 'center_z',
+            'rotation_phi', 'rotation_theta', 'rotation_psi'
+
+        relative to the reference cube ``[-1, 1]^3``, with the Euler angles
+        in radians.
+    dtype : numpy dtype
+        Type of the output, e.g. ``np.float32``
+    chunk_size : `int`
+        Upper limit for the number of grid points times ellipsoids handled at
+        once without numba, which bounds the memory use
+    parallel : `bool`
+        Use numba's thread pool. Switch it off in processes that fork, e.g.
+        in a Dataset used with ``num_workers > 0``.
+
+    Returns
+    -------
+    phantoms : numpy.ndarray
+        ``(B,) + shape`` array
+    """
+    return _batch_phantoms(shape, params, dtype, False, chunk_size, parallel)
+
+def ellipsoid_phantom(shape, ellipsoids, dtype=np.float64):
+    """Create a phantom of ellipsoids in 3d space, see `ellipsoid_phantoms`."""
+    return ellipsoid_phantoms(shape, [ellipsoids], dtype)[0]
+
+def random_shapes(rng=np.random):
+    # rng: numpy.random.Generator (or the numpy.random module for the global state)
+    x_0 = 1 * rng.random() - 0.5
+    y_0 = 1 * rng.random() - 0.5
+    return [rng.exponential(0.4),
+            1 * rng.random() - 0.5, 1 * rng.random() - 0.5,
             x_0, y_0,
-            np.random.rand() * 2 * np.pi]
+            rng.random() * 2 * np.pi]
 
-def random_phantom(space, n_ellipse=20):
-    n = np.random.poisson(n_ellipse)
-    shapes = [random_shapes() for _ in range(n)]
+def random_phantom(space, n_ellipse=20, rng=np.random):
+    n = rng.poisson(n_ellipse)
+    shapes = [random_shapes(rng) for _ in range(n)]
     for i in range(n):
-        shapes[i][0] = np.random.exponential(0.4)
+        shapes[i][0] = rng.exponential(0.4)
     x = ellipse_phantom(space[1:], shapes)
     x = [x]
     return np.array(x)
 
+def random_phantoms(space, batch_size, n_ellipse=20, rng=np.random, dtype=np.float64, parallel=True):
+    """Batch version of `random_phantom`, returns a ``(B,) + space`` array.
+
+    For the same ``rng`` state this draws the same ellipses as calling
+    `random_phantom` ``batch_size`` times.
+    """
+    params = []
+    for _ in range(batch_size):
+        n = rng.poisson(n_ellipse)
+        shapes = [random_shapes(rng) for _ in range(n)]
+        for i in range(n):
+            shapes[i][0] = rng.exponential(0.4)
+        params.append(shapes)
+    # pad with ellipses that add nothing
+    n_max = max([len(shapes) for shapes in params] + [1])
+    padded = np.zeros((batch_size, n_max, 6))
+    padded[..., 1:3] = 1
+    for b, shapes in enumerate(params):
+        if shapes:
+            padded[b, :len(shapes)] = shapes
+    x = ellipse_phantoms(space[1:], padded, dtype, parallel=parallel)
+    return x[:, None]
+
 def shepp_logan(space):
     rad18 = np.deg2rad(18.0)
     #            value  axisx  axisy     x       y  rotation
@@ -163,4 +423,24 @@ def shepp_logan(space):
                 [1.28, 0.023, 0.046, 0.06, -0.605, 0]]
     x = ellipse_phantom(space[1:], ellipsoids)
     x = [x]
-    return np.array(x)
\ No newline at end of file
+    return np.array(x)
+
+def shepp_logan_3d(space, dtype=np.float64):
+    """3D version of `shepp_logan`, returns an array of shape ``space``.
+
+    Uses the values of the 2D table with the axes and centres of the 3D
+    Shepp-Logan phantom of ODL.
+    """
+    rad18 = np.deg2rad(18.0)
+    #            value  axisx  axisy  axisz     x       y     z  rotation
+    ellipsoids= [[0.55, 0.69, 0.92, 0.81, 0.0, 0.0, 0.0, 0, 0, 0],
+                [0.60, 0.6624, 0.874, 0.78, 0.0, -0.0184, 0.0, 0, 0, 0],
+                [0.50, 0.11, 0.31, 0.22, 0.22, 0.0, 0.0, -rad18, 0, 0],
+                [0.51, 0.16, 0.41, 0.28, -0.22, 0.0, 0.0, rad18, 0, 0],
+                [0.05, 0.21, 0.25, 0.41, 0.0, 0.35, 0.0, 0, 0, 0],
+                [0.11, 0.046, 0.046, 0.05, 0.0, 0.1, 0.0, 0, 0, 0],
+                [0.48, 0.046, 0.046, 0.05, 0.0, -0.1, 0.0, 0, 0, 0],
+                [0.34, 0.046, 0.023, 0.05, -0.08, -0.605, 0.0, 0, 0, 0],
+                [0.14, 0.023, 0.023, 0.02, 0.0, -0.606, 0.0, 0, 0, 0],
+                [1.28, 0.023, 0.046, 0.02, 0.06, -0.605, 0.0, 0, 0, 0]]
+    return ellipsoid_phantom(space, ellipsoids, dtype)
@@ -0,0 +1,299 @@
+# Opt-in timing of the stages of LearnedPrimalDual and the sirf_torch
+# operators (CNN blocks, SIRF projections, host/device transfers), forward
+# and backward, per unrolled iteration. Without an active Profiler the
+# instrumentation costs one global lookup per stage.
+#
+# Usage:
+#   with Profiler() as profiler:
+#       loss = criterion(x_gt, model(y))
+#       loss.backward()
+#   print(profiler.table())
+#   profiler.export_chrome_trace("trace.json")  # chrome://tracing or ui.perfetto.dev
+
+# CCP SyneRBI Synergistic Image Reconstruction Framework (SIRF).
+
+# This is software developed for the Collaborative Computational Project in Synergistic Reconstruction for Biomedical Imaging (http://www.ccpsynerbi.ac.uk/).
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import torch
+
+# the active Profiler, if any
+_profiler = None
+_disabled = contextlib.nullcontext()
+
+
+def stage(name, phase="forward", iteration=None, nbytes=0):
+    """Context manager timing a stage as name, a no-op without active Profiler
+
+    nbytes: the number of bytes the stage copies (e.g. between host and device)
+    """
+    if _profiler is None:
+        return _disabled
+    return _profiler._stage(name, phase, iteration, nbytes)
+
+def profiled(fn, name, iteration, *args):
+    """Returns fn(*args), timed as stage name in forward, and in backward
+    from the gradient arriving at its output to it leaving at its inputs"""
+    if _profiler is None:
+        return fn(*args)
+    return _profiler._profiled(fn, name, iteration, args)
+
+def timed(fn, name, iteration):
+    """Returns fn profiled as stage name (see `profiled`), or fn itself
+    without active Profiler"""
+    if _profiler is None:
+        return fn
+    return functools.partial(profiled, fn, name, iteration)
+
+
+class _Span:
+    __slots__ = ("name", "phase", "iteration", "start", "end", "nbytes", "peak_memory", "thread",
+                 "memory_start", "memory_peak", "cuda_peak_start", "pending")
+
+    def __init__(self, name, phase, iteration, nbytes=0):
+        self.name = name
+        self.phase = phase
+        self.iteration = iteration
+        self.start = None
+        self.end = None
+        self.nbytes = nbytes
+        self.peak_memory = 0
+        self.thread = threading.get_ident()
+        # memory in use at the start, the most seen since and, with CUDA,
+        # torch's (process wide) peak at the start
+        self.memory_start = 0
+        self.memory_peak = 0
+        self.cuda_peak_start = 0
+        # number of inputs the gradient of a backward span still has to leave through
+        self.pending = 0
+
+
+class _Stamp(torch.autograd.Function):
+    # Identity, whose backward records the time the gradient passes by
+    @staticmethod
+    def forward(ctx, x, profiler, span, is_output):
+        ctx.profiler = profiler
+        ctx.span = span
+        ctx.is_output = is_output
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        ctx.profiler._stamp(ctx.span, ctx.is_output)
+        return grad, None, None, None
+
+
+class Profiler:
+    """ Records the stages run while it is active (as context manager)
+
+    For every stage it keeps the wall time, the bytes copied and the peak
+    memory: how far the memory in use (allocated device memory with CUDA,
+    otherwise the resident memory of the process) rose above its value at
+    the start of the stage. The memory is read at the start and end of every
+    stage and every memory_interval seconds in between (by a background
+    thread), so stages much shorter than that can miss a peak; with CUDA,
+    any new high of torch's peak statistics is counted exactly. Stages can
+    nest (e.g. the transfers within an operator), and run on several threads
+    (e.g. with micro_batches), so their times do not add up to the total, and
+    the memory of one thread counts for the stages running on the others.
+    A Profiler can be entered repeatedly (e.g. once per epoch) and collects
+    all stages until reset().
+
+    The backward of a stage ends when its gradients leave through its
+    inputs, so it is not recorded for stages without inputs requiring a
+    gradient (e.g. the first dual CNN block). input_gradients=True makes the
+    first tensor input of such CNN blocks require a gradient, which records
+    them at the cost of computing that gradient.
+    """
+
+    def __init__(self, cuda=None, memory_interval=1e-3, input_gradients=False):
+        self.cuda = torch.cuda.is_available() if cuda is None else cuda
+        self.memory_interval = memory_interval
+        self.input_gradients = input_gradients
+        self.spans = []
+        self.wall_time = 0.
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        # the spans open on any thread, updated by the memory sampler
+        self._active = set()
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        global _profiler
+        if _profiler is not None:
+            raise RuntimeError("Another Profiler is active")
+        _profiler = self
+        self._entered = time.perf_counter()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *args):
+        global _profiler
+        _profiler = None
+        self.wall_time += time.perf_counter() - self._entered
+        self._stop.set()
+        self._sampler.join()
+        with self._lock:
+            # e.g. backward spans whose gradients did not reach all inputs
+            self._active.clear()
+
+    def reset(self):
+        self.spans = []
+        self.wall_time = 0.
+
+    def _memory(self):
+        if self.cuda:
+            return torch.cuda.memory_allocated()
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            # peak resident memory where the current one is not available
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return rss if sys.platform == "darwin" else rss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.memory_interval):
+            memory = self._memory()
+            with self._lock:
+                for span in self._active:
+                    span.memory_peak = max(span.memory_peak, memory)
+
+    def _memory_start(self, span):
+        span.memory_start = span.memory_peak = self._memory()
+        if self.cuda:
+            span.cuda_peak_start = torch.cuda.max_memory_allocated()
+        with self._lock:
+            self._active.add(span)
+
+    def _memory_end(self, span, finished=True):
+        memory = self._memory()
+        with self._lock:
+            if finished:
+                self._active.discard(span)
+            span.memory_peak = max(span.memory_peak, memory)
+        if self.cuda:
+            cuda_peak = torch.cuda.max_memory_allocated()
+            if cuda_peak > span.cuda_peak_start:
+                # a new high, reached during the span
+                span.memory_peak = max(span.memory_peak, cuda_peak)
+        span.peak_memory = max(span.memory_peak - span.memory_start, 0)
+
+    def _open(self, span):
+        self._memory_start(span)
+        self._local.__dict__.setdefault("stack", []).append(span)
+        span.start = time.perf_counter()
+
+    def _close(self, span):
+        span.end = time.perf_counter()
+        self._memory_end(span)
+        stack = self._local.stack
+        stack.pop()
+        if stack:
+            # the peak of a nested span was reached within the enclosing one
+            with self._lock:
+                stack[-1].memory_peak = max(stack[-1].memory_peak, span.memory_peak)
+        self.spans.append(span)
+
+    @contextlib.contextmanager
+    def _stage(self, name, phase, iteration, nbytes):
+        span = _Span(name, phase, iteration, nbytes)
+        self._open(span)
+        try:
+            yield span
+        finally:
+            self._close(span)
+
+    def _profiled(self, fn, name, iteration, args):
+        if not torch.is_grad_enabled():
+            with self._stage(name, "forward", iteration, 0):
+                return fn(*args)
+        backward = _Span(name, "backward", iteration)
+        tensors = [i for i, a in enumerate(args) if isinstance(a, torch.Tensor)]
+        args = list(args)
+        if (self.input_gradients and not any(args[i].requires_grad for i in tensors) and tensors
+                and any(isinstance(a, torch.nn.Module) for a in args)):
+            # e.g. a CNN block in the first iteration, whose backward only
+            # reaches its parameters: end it at the gradient of an input
+            args[tensors[0]] = args[tensors[0]].detach().requires_grad_()
+        for i in tensors:
+            if args[i].requires_grad:
+                args[i] = _Stamp.apply(args[i], self, backward, False)
+                backward.pending += 1
+        with self._stage(name, "forward", iteration, 0):
+            out = fn(*args)
+        return _Stamp.apply(out, self, backward, True)
+
+    def _stamp(self, span, is_output):
+        # the backward of a profiled stage starts when the gradient reaches
+        # its output and ends when the last one leaves through its inputs
+        if is_output:
+            span.thread = threading.get_ident()
+            self._memory_start(span)
+            span.start = time.perf_counter()
+        elif span.start is not None:
+            if span.end is None:
+                self.spans.append(span)
+            span.end = time.perf_counter()
+            span.pending -= 1
+            self._memory_end(span, finished=span.pending <= 0)
+
+    def summary(self, by_iteration=False):
+        """Returns one dict per stage (and phase, and iteration if
+        by_iteration) with its calls, total and mean time (s), share of the
+        profiled wall time, bytes copied and peak memory, slowest first"""
+        rows = {}
+        for span in self.spans:
+            key = (span.name, span.phase, span.iteration if by_iteration else None)
+            row = rows.setdefault(key, dict(stage=span.name, phase=span.phase, iteration=key[2],
+                                            calls=0, time=0., nbytes=0, peak_memory=0))
+            row["calls"] += 1
+            row["time"] += span.end - span.start
+            row["nbytes"] += span.nbytes
+            row["peak_memory"] = max(row["peak_memory"], span.peak_memory)
+        for row in rows.values():
+            row["mean_time"] = row["time"] / row["calls"]
+            row["share"] = row["time"] / self.wall_time if self.wall_time else 0.
+        return sorted(rows.values(), key=lambda row: -row["time"])
+
+    def totals(self):
+        """Returns {"stage/phase": total time (s)}, e.g. to log per epoch"""
+        return {row["stage"] + "/" + row["phase"]: row["time"] for row in self.summary()}
+
+    def table(self, by_iteration=False):
+        """Returns the summary as a printable table"""
+        lines = ["{:24s} {:8s} {:>5s} {:>6s} {:>10s} {:>10s} {:>6s} {:>10s} {:>10s}".format(
+            "stage", "phase", "iter", "calls", "total s", "mean ms", "share", "copied MB", "peak MB")]
+        for row in self.summary(by_iteration):
+            lines.append("{:24s} {:8s} {:>5s} {:6d} {:10.4f} {:10.3f} {:6.1%} {:10.1f} {:10.1f}".format(
+                row["stage"], row["phase"], "" if row["iteration"] is None else str(row["iteration"]),
+                row["calls"], row["time"], 1e3 * row["mean_time"], row["share"],
+                row["nbytes"] / 2**20, row["peak_memory"] / 2**20))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, filename):
+        """Writes the stages in the Chrome trace event format"""
+        threads = {}
+        events = []
+        for span in self.spans:
+            events.append({"name": span.name, "cat": span.phase, "ph": "X",
+                           "ts": 1e6 * (span.start - self._origin), "dur": 1e6 * (span.end - span.start),
+                           "pid": os.getpid(), "tid": threads.setdefault(span.thread, len(threads)),
+                           "args": {"iteration": span.iteration, "bytes": span.nbytes,
+                                    "peak_memory": span.peak_memory}})
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
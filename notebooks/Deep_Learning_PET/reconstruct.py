@@ -0,0 +1,226 @@
+# Reconstructs sinograms with a trained LearnedPrimalDual model (e.g. the
+# trained.torch_model of 4_setup_training.ipynb). The CNN blocks are compiled
+# and use channels_last, and the sinograms are served from a queue that
+# groups them into batches, such that many slices do not each pay the Python
+# dispatch of a whole network.
+#
+# Usage:
+#   python reconstruct.py CHECKPOINT SINOGRAMS.npy OUTPUT.npy [--size_xy 128]
+#                         [--batch_size 16] [--latency_budget 0.5]
+#                         [--compile compile|trace|none]
+# SINOGRAMS.npy holds the sinograms of all slices, i.e. has shape
+# (n_slices, views, tangential positions) or (n_slices, 1, views, tangential positions).
+
+# CCP SyneRBI Synergistic Image Reconstruction Framework (SIRF).
+
+# This is software developed for the Collaborative Computational Project in Synergistic Reconstruction for Biomedical Imaging (http://www.ccpsynerbi.ac.uk/).
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from lpd_net import LearnedPrimalDual
+
+
+def load_model(path, image_template, sinogram_template, acq_model, device="cpu", **kwargs):
+    """Returns the LearnedPrimalDual of a checkpoint, in eval mode
+
+    kwargs are passed to LearnedPrimalDual and need to match the trained model
+    (n_iter, n_primal, n_dual, ...), as only the weights are stored.
+    """
+    model = LearnedPrimalDual(image_template, sinogram_template, acq_model, **kwargs)
+    checkpoint = torch.load(path, map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device).eval()
+
+
+def compile_model(model, mode="compile", channels_last=True):
+    """Compiles the primal and dual CNN blocks of model for inference (in place)
+
+    mode: "compile" (torch.compile, which compiles on the first batches),
+    "trace" (TorchScript, by tracing, for older torch versions) or None.
+    The operators are not compiled, they run in SIRF. Afterwards the model can
+    only be used for inference, and its state_dict keys may change, so load
+    the weights before.
+    """
+    if mode not in ("trace", "compile", None):
+        raise ValueError("Unknown mode " + str(mode))
+    model.eval()
+    device = next(model.parameters()).device
+    if channels_last:
+        model.primal_nets.to(memory_format=torch.channels_last)
+        model.dual_nets.to(memory_format=torch.channels_last)
+    # input shapes of the blocks, h, Op_f and g for the dual ones, f and OpAdj_h for the primal ones
+    dual_shapes = (model.dual_shape, (1,) + model.dual_shape[1:], (1,) + model.dual_shape[1:])
+    primal_shapes = (model.primal_shape, (1,) + model.primal_shape[1:])
+    for nets, shapes in ((model.dual_nets, dual_shapes), (model.primal_nets, primal_shapes)):
+        for i, net in enumerate(nets):
+            if mode == "trace":
+                # the batch size of the example does not matter for convolutions
+                example = tuple(torch.zeros((2,) + shape, device=device) for shape in shapes)
+                with torch.no_grad():
+                    nets[i] = torch.jit.trace(net, example)
+            elif mode == "compile":
+                nets[i] = torch.compile(net, dynamic=True)
+    return model
+
+
+class InferenceEngine:
+    """Serves reconstructions of single sinograms in dynamic batches
+
+    Sinograms submitted from any thread are queued, and a background thread
+    runs them through model in batches of at most max_batch_size. After the
+    first sinogram of a batch arrives, it waits for more for as long as the
+    latency budget (in seconds, from submission to result) allows, given the
+    time the recent batches took.
+
+    Usage:
+        with InferenceEngine(model) as engine:
+            x = engine.submit(y).result()
+            xs = engine.reconstruct(ys)
+            print(engine.report())
+    """
+    def __init__(self, model, max_batch_size=16, latency_budget=0.5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.latency_budget = latency_budget
+        self.device = next(model.parameters()).device
+        self._queue = queue.Queue()
+        self._batch_time = 0.
+        self._stats = dict(n_samples=0, n_batches=0, busy_time=0., latencies=[])
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def submit(self, y):
+        """Queues the sinogram y (a tensor or array without batch dimension)
+        and returns a Future of its reconstruction"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("InferenceEngine is closed")
+            self._queue.put((torch.as_tensor(y, dtype=torch.float32), future, time.perf_counter()))
+        return future
+
+    def reconstruct(self, ys):
+        """Reconstructs all sinograms in ys, returns a numpy array"""
+        futures = [self.submit(y) for y in ys]
+        return np.stack([future.result().numpy() for future in futures])
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + max(self.latency_budget - self._batch_time, 0.)
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.perf_counter(), 0.))
+            except queue.Empty:
+                break
+            if item is None:
+                # finish the batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            ys, futures, submitted = zip(*batch)
+            start = time.perf_counter()
+            try:
+                y = torch.stack(ys).to(self.device)
+                if y.dim() == len(self.model.dual_shape):
+                    # no channel dimension
+                    y = y.unsqueeze(1)
+                with torch.no_grad():
+                    x = self.model(y).cpu()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            # running estimate of the time a batch takes
+            duration = end - start
+            self._batch_time = duration if self._stats["n_batches"] == 0 else 0.8 * self._batch_time + 0.2 * duration
+            self._stats["n_samples"] += len(batch)
+            self._stats["n_batches"] += 1
+            self._stats["busy_time"] += duration
+            self._stats["latencies"].extend(end - t for t in submitted)
+            for future, xi in zip(futures, x):
+                future.set_result(xi)
+
+    def report(self):
+        """Returns a dict with the throughput (samples per second, overall and
+        while busy), the mean batch size and the latencies (mean and 95th
+        percentile, in seconds) so far"""
+        stats = self._stats
+        latencies = np.array(stats["latencies"]) if stats["latencies"] else np.zeros(1)
+        return dict(n_samples=stats["n_samples"],
+                    n_batches=stats["n_batches"],
+                    mean_batch_size=stats["n_samples"] / max(stats["n_batches"], 1),
+                    throughput=stats["n_samples"] / (time.perf_counter() - self._start),
+                    busy_throughput=stats["n_samples"] / max(stats["busy_time"], 1e-12),
+                    mean_latency=float(latencies.mean()),
+                    p95_latency=float(np.percentile(latencies, 95)))
+
+    def close(self):
+        """Finishes the queued sinograms and stops the background thread"""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    from generate_ellipses import thorax_single_slice
+
+    parser = argparse.ArgumentParser(description="Reconstruct sinograms with a trained LearnedPrimalDual")
+    parser.add_argument("checkpoint")
+    parser.add_argument("sinograms")
+    parser.add_argument("output")
+    parser.add_argument("--size_xy", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--latency_budget", type=float, default=0.5)
+    parser.add_argument("--compile", default="compile", choices=["compile", "trace", "none"])
+    # hyperparameters of the trained model, the defaults are those of 4_setup_training.ipynb
+    parser.add_argument("--n_iter", type=int, default=2)
+    parser.add_argument("--n_primal", type=int, default=5)
+    parser.add_argument("--n_dual", type=int, default=5)
+    parser.add_argument("--n_layers", type=int, default=5)
+    parser.add_argument("--n_feature_channels", type=int, default=128)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    image_template, sinogram_template, acq_model = thorax_single_slice(args.size_xy)
+    model = load_model(args.checkpoint, image_template, sinogram_template, acq_model, device,
+                       n_iter=args.n_iter, n_primal=args.n_primal, n_dual=args.n_dual,
+                       n_layers=args.n_layers, n_feature_channels=args.n_feature_channels)
+    compile_model(model, None if args.compile == "none" else args.compile)
+
+    sinograms = np.load(args.sinograms, mmap_mode="r")
+    with InferenceEngine(model, args.batch_size, args.latency_budget) as engine:
+        np.save(args.output, engine.reconstruct(sinograms)[:, 0])
+        report = engine.report()
+    print("{n_samples} slices in {n_batches} batches (mean size {mean_batch_size:.1f}): "
+          "{throughput:.1f} slices/s, latency {mean_latency:.3f} s (95%: {p95_latency:.3f} s)".format(**report))
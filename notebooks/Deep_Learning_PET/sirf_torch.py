@@ -13,79 +13,466 @@
 
 # Based on https://github.com/educating-dip/pet_deep_image_prior/blob/main/src/deep_image_prior/torch_wrapper.py
 
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
 import torch
 
-class _primal_op(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, x, image_template, sinogram_template, sirf_obj):
-        ctx.sirf_obj = sirf_obj
-        ctx.image_template = image_template
-        ctx.sinogram_template = sinogram_template
-        x_np = x.detach().cpu().numpy()
-        x_np = ctx.image_template.fill(x_np)
-        proj_sinogram_np = ctx.sirf_obj.forward(x_np).as_array()
-        proj_sinogram = torch.from_numpy(proj_sinogram_np).requires_grad_().to(x.device)
-        return proj_sinogram.float()
+from profiling import stage
 
-    @staticmethod
-    def backward(ctx, sinogram):
-        sinogram_np = sinogram.detach().cpu().numpy()
-        sinogram_np = ctx.sinogram_template.fill(sinogram_np)
-        grads_np = ctx.sirf_obj.backward(sinogram_np).as_array()
-        grads = torch.from_numpy(grads_np).requires_grad_().to(sinogram.device)
-        return grads.float(), None, None, None, None
+def _torch_shape(shape):
+    # SIRF arrays carry leading singleton dimensions (e.g. (1, H, W) for a 2D
+    # image, (1, 1, V, T) for a single slice sinogram). The torch side uses
+    # (N, C) + these shapes with the leading singletons stripped.
+    shape = tuple(shape)
+    while len(shape) > 2 and shape[0] == 1:
+        shape = shape[1:]
+    return shape
+
+class SerialProjector:
+    """ Projects the items of a stack one after another with a single acquisition model
+
+    Initialisation
+    ----------
+    image_template : `SIRF image data`
+        Image the acquisition model was set up with
+    sinogram_template : `SIRF acquisition data`
+        Sinogram the acquisition model was set up with
+    acq_model : `SIRF acquisition model`
+        The (set up) acquisition model
+    """
 
-class primal_op(torch.nn.Module):
     def __init__(self, image_template, sinogram_template, acq_model):
+        self.image_template = image_template
+        self.sinogram_template = sinogram_template
+        self.acq_model = acq_model
+
+    def forward(self, x, out=None):
+        # x.shape: (B,) + image_template.shape (or anything of the same size)
+        return _project_stack(self.image_template, self.sinogram_template, self.acq_model.forward, x, out)
+
+    def backward(self, y, out=None):
+        # y.shape: (B,) + sinogram_template.shape (or anything of the same size)
+        return _project_stack(self.sinogram_template, self.image_template, self.acq_model.backward, y, out)
+
+    def close(self):
+        pass
+
+def _project_stack(template, out_template, op, stack, out=None):
+    # out: optional preallocated (B, ...) array, the results are cast into it
+    for i, item in enumerate(stack):
+        result = op(template.fill(item.reshape(template.shape))).as_array()
+        if out is None:
+            out = np.empty((len(stack),) + result.shape, dtype=result.dtype)
+        out[i] = result
+    if out is None:
+        # empty stack
+        out = np.empty((0,) + tuple(out_template.shape), dtype=np.float32)
+    return out
+
+# Every worker (thread or process) of a ProjectorPool owns its own
+# (image_template, sinogram_template, acq_model) triplet
+_worker = threading.local()
+
+def _init_worker(factory):
+    _worker.image_template, _worker.sinogram_template, _worker.acq_model = factory()
+
+def _worker_forward(x):
+    return _project_stack(_worker.image_template, _worker.sinogram_template, _worker.acq_model.forward, x)
+
+def _worker_backward(y):
+    return _project_stack(_worker.sinogram_template, _worker.image_template, _worker.acq_model.backward, y)
+
+class ProjectorPool:
+    """ Projects the items of a stack concurrently with a pool of acquisition models
+
+    Initialisation
+    ----------
+    factory : `callable`
+        Called once in every worker without arguments. Has to return a set up
+        ``(image_template, sinogram_template, acq_model)`` triplet, which the
+        worker then owns. For ``kind="process"`` it needs to be picklable,
+        i.e. a function defined at module level.
+    num_workers : `int`
+        Number of workers, and therefore of acquisition model clones
+    kind : `string`
+        ``"thread"`` or ``"process"``. Threads only give a speed-up if the
+        projector releases the GIL, processes always do but pay for copying
+        the arrays between processes.
+    """
+
+    def __init__(self, factory, num_workers=4, kind="thread"):
+        if kind == "thread":
+            executor = ThreadPoolExecutor
+        elif kind == "process":
+            executor = ProcessPoolExecutor
+        else:
+            raise ValueError('kind should be "thread" or "process"')
+        self.num_workers = num_workers
+        self.executor = executor(max_workers=num_workers, initializer=_init_worker, initargs=(factory,))
+
+    def _map(self, fn, stack, out):
+        if len(stack) == 0:
+            # the workers know the output shape
+            return self.executor.submit(fn, stack).result() if out is None else out
+        # one contiguous chunk of items per worker
+        chunks = np.array_split(stack, min(self.num_workers, len(stack)))
+        return np.concatenate(list(self.executor.map(fn, chunks)), out=out)
+
+    def forward(self, x, out=None):
+        return self._map(_worker_forward, x, out)
+
+    def backward(self, y, out=None):
+        return self._map(_worker_backward, y, out)
+
+    def close(self):
+        self.executor.shutdown()
+
+class StagingBuffers:
+    """ Preallocated buffers for moving operator input and output between torch and SIRF
+
+    One host buffer (pinned if CUDA is available) and one device buffer are
+    kept per shape and device, all of them of type ``dtype``. The projector
+    writes its output straight into the host buffer (casting the float64 SIRF
+    arrays on the way), which is then copied to the device without blocking.
+
+    Tensors returned by `to_device` are views of these buffers. They are
+    therefore only valid until the next call for the same shape, which is fine
+    for the `LearnedPrimalDual` layers as they consume them straight away.
+    """
+
+    def __init__(self, dtype=torch.float32):
+        self.dtype = dtype
+        self.pin_memory = torch.cuda.is_available()
+        self.host_buffers = {}
+        self.device_buffers = {}
+        self.copy_events = {}
+
+    def host(self, shape):
+        shape = tuple(shape)
+        if shape not in self.host_buffers:
+            self.host_buffers[shape] = torch.empty(shape, dtype=self.dtype, pin_memory=self.pin_memory)
+        elif shape in self.copy_events:
+            # a non-blocking copy out of this buffer might still be running
+            self.copy_events.pop(shape).synchronize()
+        return self.host_buffers[shape]
+
+    def to_numpy(self, x):
+        x = x.detach()
+        if x.device.type == "cpu" and x.dtype == self.dtype:
+            # no staging needed
+            return x.contiguous().numpy()
+        buffer = self.host(x.shape)
+        buffer.copy_(x, non_blocking=True)
+        if x.is_cuda:
+            torch.cuda.current_stream(x.device).synchronize()
+        return buffer.numpy()
+
+    def to_device(self, buffer, device):
+        if device.type == "cpu":
+            return buffer.view(buffer.shape)
+        key = (tuple(buffer.shape), device)
+        if key not in self.device_buffers:
+            self.device_buffers[key] = torch.empty(buffer.shape, dtype=self.dtype, device=device)
+        out = self.device_buffers[key]
+        out.copy_(buffer, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(device))
+        self.copy_events[tuple(buffer.shape)] = event
+        return out.view(out.shape)
+
+class _sirf_op(torch.nn.Module):
+    # Common part of primal_op and dual_op: owns the projector (and staging
+    # buffers) and moves stacks of items through it
+    def __init__(self, image_template, sinogram_template, acq_model, pool=None, staging=False):
         super().__init__()
         self.image_template = image_template
         self.sinogram_template = sinogram_template
         self.acq_model = acq_model
+        if pool is None:
+            pool = SerialProjector(image_template, sinogram_template, acq_model)
+        self.projector = pool
+        self.staging = StagingBuffers() if staging else None
+        self.image_shape = _torch_shape(image_template.shape)
+        self.sinogram_shape = _torch_shape(sinogram_template.shape)
+
+    def replica(self):
+        # Same operator with the same projector, but its own staging buffers
+        return type(self)(self.image_template, self.sinogram_template, self.acq_model,
+                          self.projector, self.staging is not None)
+
+    def _run(self, fn, x, out_shape, name, phase):
+        # Operator input and output are float32, the (float64) SIRF results
+        # are cast straight into the output array. name and phase label the
+        # stages for profiling.
+        shape = (len(x),) + tuple(out_shape)
+        on_device = x.device.type != "cpu"
+        out = np.empty(shape, dtype=np.float32) if self.staging is None else self.staging.host(shape)
+        with stage(name + ".to_host", phase, nbytes=4 * x.nelement() if on_device else 0):
+            if self.staging is None:
+                x_np = x.detach().cpu().float().numpy()
+            else:
+                x_np = self.staging.to_numpy(x)
+        with stage(name + ".sirf", phase):
+            fn(x_np, out=out if self.staging is None else out.numpy())
+        with stage(name + ".to_device", phase, nbytes=4 * int(np.prod(shape)) if on_device else 0):
+            if self.staging is None:
+                return torch.from_numpy(out).to(x.device)
+            return self.staging.to_device(out, x.device)
+
+    def _project(self, x, phase="forward"):
+        return self._run(self.projector.forward, x, self.sinogram_template.shape, "project", phase)
+
+    def _backproject(self, y, phase="forward"):
+        return self._run(self.projector.backward, y, self.image_template.shape, "backproject", phase)
+
+class _batch_primal_op(torch.autograd.Function):
+    # Projects a whole (B, ...) stack of images in one call
+    @staticmethod
+    def forward(ctx, x, op):
+        ctx.op = op
+        ctx.input_shape = x.shape
+        return op._project(x)
+
+    @staticmethod
+    def backward(ctx, sinogram):
+        return ctx.op._backproject(sinogram, "backward").view(ctx.input_shape), None
+
+class primal_op(_sirf_op):
+    """ Forward projection of a (N, C, ...) batch of images
+
+    If ``pool`` (a `ProjectorPool`) is given, the N*C images are projected
+    concurrently by its workers, otherwise one after another by ``acq_model``.
+    Backward uses the same batching. With ``staging=True`` data is moved
+    through reusable `StagingBuffers` instead of fresh allocations. The
+    output is then a view of such a buffer, overwritten by the next call for
+    the same batch shape: ``clone()`` it if it needs to outlive that call.
+    """
 
     def forward(self, image):
         # x.shape: (N, C, H, W) or (N, C, D, H, W)
-        image_nc_flat = image.view(-1, *image.shape[2:])
-        sinogram_nc_flat = []
-        for x_i in image_nc_flat:
-            sym_sinogram_i = _primal_op.apply(x_i.unsqueeze(0), self.image_template, self.sinogram_template, self.acq_model)
-            sinogram_nc_flat.append(sym_sinogram_i)
-        sinogram = torch.cat(sinogram_nc_flat)
-        return sinogram
-
-class _dual_op(torch.autograd.Function):
-    
+        image_nc_flat = image.reshape(-1, *image.shape[2:])
+        sinogram_nc_flat = _batch_primal_op.apply(image_nc_flat, self)
+        return sinogram_nc_flat.view(*image.shape[:2], *self.sinogram_shape)
+
+class _batch_dual_op(torch.autograd.Function):
+    # Back projects a whole (B, ...) stack of sinograms in one call
     @staticmethod
-    def forward(ctx, sinogram, image_template, sinogram_template, sirf_obj):
-        ctx.sirf_obj = sirf_obj
-        ctx.image_template = image_template
-        ctx.sinogram_template = sinogram_template
-        sinogram_np = sinogram.detach().cpu().numpy()
-        sinogram_np = ctx.sinogram_template.fill(sinogram_np)
-        grads_np = ctx.sirf_obj.backward(sinogram_np).as_array()
-        grads = torch.from_numpy(grads_np).requires_grad_().to(sinogram.device)
-        return grads.float()
-        
+    def forward(ctx, sinogram, op):
+        ctx.op = op
+        ctx.input_shape = sinogram.shape
+        return op._backproject(sinogram)
+
     @staticmethod
     def backward(ctx, x):
-        x_np = x.detach().cpu().numpy()
-        x_np = ctx.image_template.fill(x_np)
-        proj_sinogram_np = ctx.sirf_obj.forward(x_np).as_array()
-        proj_sinogram = torch.from_numpy(proj_sinogram_np).requires_grad_().to(x.device)
-        return proj_sinogram.float(), None, None, None, None
+        return ctx.op._project(x, "backward").view(ctx.input_shape), None
 
-class dual_op(torch.nn.Module):
-    def __init__(self, image_template, sinogram_template, acq_model):
-        super().__init__()
-        self.image_template = image_template
-        self.sinogram_template = sinogram_template
-        self.acq_model = acq_model
+class dual_op(_sirf_op):
+    """ Back projection of a (N, C, ...) batch of sinograms
+
+    See `primal_op` for the meaning of ``pool`` and ``staging`` (and the
+    lifetime of the output with ``staging=True``).
+    """
 
     def forward(self, sinogram):
         # x.shape: (N, C, H, W) or (N, C, D, H, W)
-        sinogram_nc_flat = sinogram.view(-1, *sinogram.shape[2:])
-        image_nc_flat = []
-        for x_i in sinogram_nc_flat:
-            sym_image_i = _dual_op.apply(x_i[None][None], self.image_template, self.sinogram_template, self.acq_model)
-            image_nc_flat.append(sym_image_i)
-        image = torch.cat(image_nc_flat).unsqueeze_(dim=1)
-        return image
\ No newline at end of file
+        sinogram_nc_flat = sinogram.reshape(-1, *sinogram.shape[2:])
+        image_nc_flat = _batch_dual_op.apply(sinogram_nc_flat, self)
+        return image_nc_flat.view(*sinogram.shape[:2], *self.image_shape)
+
+class SystemMatrix:
+    """ Explicit sparse matrix A of an acquisition model, stored as CSR
+
+    Forward projection is y = A x with x and y the flattened image and sinogram.
+    Use `extract_system_matrix` to create one from a SIRF acquisition model.
+    """
+
+    def __init__(self, indptr, indices, data, image_shape, sinogram_shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.image_shape = tuple(image_shape)
+        self.sinogram_shape = tuple(sinogram_shape)
+        self.shape = (int(np.prod(self.sinogram_shape)), int(np.prod(self.image_shape)))
+
+    def save(self, filename):
+        np.savez(filename, indptr=self.indptr, indices=self.indices, data=self.data,
+                 image_shape=self.image_shape, sinogram_shape=self.sinogram_shape)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            return cls(f["indptr"], f["indices"], f["data"], f["image_shape"], f["sinogram_shape"])
+
+    def transpose(self):
+        # CSR of A^T, i.e. CSC of A
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind="stable")
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=self.shape[1]))])
+        return SystemMatrix(indptr, rows[order], self.data[order], self.sinogram_shape, self.image_shape)
+
+    def to_torch(self, device=None, dtype=torch.float32):
+        return torch.sparse_csr_tensor(torch.from_numpy(self.indptr.astype(np.int64)),
+                                       torch.from_numpy(self.indices.astype(np.int64)),
+                                       torch.from_numpy(self.data).to(dtype),
+                                       size=self.shape, device=device)
+
+def _geometry_hash(image_template, sinogram_template, acq_model):
+    # shapes, voxel sizes, the type of acquisition model and the projection
+    # of a uniform image (which changes with e.g. attenuation or normalisation)
+    key = {"image_shape": list(image_template.shape),
+           "sinogram_shape": list(sinogram_template.shape),
+           "acq_model": type(acq_model).__name__}
+    if hasattr(image_template, "voxel_sizes"):
+        key["voxel_sizes"] = [float(v) for v in image_template.voxel_sizes()]
+    ones = np.ones(image_template.shape, dtype=np.float32)
+    projected = acq_model.forward(image_template.fill(ones)).as_array().astype(np.float32)
+    sha = hashlib.sha1(json.dumps(key, sort_keys=True).encode())
+    sha.update(projected.tobytes())
+    return sha.hexdigest()
+
+def extract_system_matrix(image_template, sinogram_template, acq_model, cache_dir=None,
+                          pool=None, batch_size=64, threshold=0.0):
+    """ Extracts the sparse system matrix of an acquisition model
+
+    Column j of the matrix is the projection of the j-th basis image, so this
+    takes one forward projection per voxel. Only sensible for small (e.g.
+    single slice) geometries.
+
+    Parameters
+    ----------
+    image_template, sinogram_template, acq_model :
+        As for `primal_op`
+    cache_dir : `string`
+        If given, the matrix is stored in (and read from) this directory, in a
+        file named after a hash of the geometry
+    pool : `ProjectorPool`
+        Optional pool projecting the basis images concurrently
+    batch_size : `int`
+        Number of basis images projected together
+    threshold : `float`
+        Entries with absolute value not above this are dropped
+
+    Returns
+    -------
+    system_matrix : `SystemMatrix`
+    """
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "system_matrix_{}.npz".format(
+            _geometry_hash(image_template, sinogram_template, acq_model)))
+        if os.path.exists(filename):
+            return SystemMatrix.load(filename)
+
+    projector = pool or SerialProjector(image_template, sinogram_template, acq_model)
+    n_voxels = int(np.prod(image_template.shape))
+    columns = []
+    for start in range(0, n_voxels, batch_size):
+        count = min(batch_size, n_voxels - start)
+        basis = np.zeros((count, n_voxels), dtype=np.float32)
+        basis[np.arange(count), start + np.arange(count)] = 1
+        projected = projector.forward(basis).reshape(count, -1)
+        # transposed: rows of A^T
+        index, row = np.nonzero(np.abs(projected) > threshold)
+        columns.append((start + index, row, projected[index, row].astype(np.float32)))
+    col, row, data = (np.concatenate(c) for c in zip(*columns))
+
+    # entries are sorted by column, so this is the CSR of A^T
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(col, minlength=n_voxels))])
+    system_matrix = SystemMatrix(indptr, row, data, sinogram_template.shape,
+                                 image_template.shape).transpose()
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        system_matrix.save(filename)
+    return system_matrix
+
+class _sparse_matmul(torch.autograd.Function):
+    # x: (B, N) -> (B, M) with the (M, N) CSR matrix A, and A^T in backward
+    @staticmethod
+    def forward(ctx, x, A, At):
+        ctx.At = At
+        with stage("sparse_matmul", "forward"):
+            return (A @ x.t()).t()
+
+    @staticmethod
+    def backward(ctx, y):
+        with stage("sparse_matmul", "backward"):
+            return (ctx.At @ y.t()).t(), None, None
+
+class _sparse_op(torch.nn.Module):
+    # Common part of sparse_primal_op and sparse_dual_op, keeping a copy of
+    # the matrix (and its transpose) on every device it is used on
+    staging = None
+
+    def __init__(self, system_matrix):
+        super().__init__()
+        self.system_matrix = system_matrix
+        self.transposed = system_matrix.transpose()
+        self.image_shape = _torch_shape(system_matrix.image_shape)
+        self.sinogram_shape = _torch_shape(system_matrix.sinogram_shape)
+        self.matrices = {}
+
+    def replica(self):
+        return self
+
+    def _matrices(self, device):
+        if device not in self.matrices:
+            self.matrices[device] = (self.system_matrix.to_torch(device), self.transposed.to_torch(device))
+        return self.matrices[device]
+
+class sparse_primal_op(_sparse_op):
+    """ Forward projection of a (N, C, ...) batch of images with a `SystemMatrix`
+
+    Drop-in replacement for `primal_op` that runs entirely on the device of
+    its input.
+    """
+
+    def forward(self, image):
+        A, At = self._matrices(image.device)
+        image_nc_flat = image.reshape(-1, A.shape[1])
+        sinogram_nc_flat = _sparse_matmul.apply(image_nc_flat, A, At)
+        return sinogram_nc_flat.view(*image.shape[:2], *self.sinogram_shape)
+
+class sparse_dual_op(_sparse_op):
+    """ Back projection of a (N, C, ...) batch of sinograms with a `SystemMatrix`
+
+    Drop-in replacement for `dual_op` that runs entirely on the device of
+    its input.
+    """
+
+    def forward(self, sinogram):
+        A, At = self._matrices(sinogram.device)
+        sinogram_nc_flat = sinogram.reshape(-1, A.shape[0])
+        image_nc_flat = _sparse_matmul.apply(sinogram_nc_flat, At, A)
+        return image_nc_flat.view(*sinogram.shape[:2], *self.image_shape)
+
+def check_system_matrix(system_matrix, image_template, sinogram_template, acq_model, n_tests=3, seed=0):
+    """ Compares a `SystemMatrix` with the acquisition model it was extracted from
+
+    Returns the largest relative errors of the forward and back projections
+    of random images and sinograms, and of the adjointness test
+    <A x, y> = <x, A^T y> of the sparse operators.
+    """
+    rng = np.random.default_rng(seed)
+    fwd, bwd = sparse_primal_op(system_matrix), sparse_dual_op(system_matrix)
+    errors = {"forward": 0.0, "backward": 0.0, "adjoint": 0.0}
+    for _ in range(n_tests):
+        x = rng.random(image_template.shape, dtype=np.float32)
+        y = rng.random(sinogram_template.shape, dtype=np.float32)
+        x_torch = torch.from_numpy(x).reshape(1, 1, -1)
+        y_torch = torch.from_numpy(y).reshape(1, 1, -1)
+        Ax = fwd(x_torch).reshape(-1).numpy()
+        Aty = bwd(y_torch).reshape(-1).numpy()
+
+        Ax_sirf = acq_model.forward(image_template.fill(x)).as_array().ravel()
+        Aty_sirf = acq_model.backward(sinogram_template.fill(y)).as_array().ravel()
+        errors["forward"] = max(errors["forward"], float(np.linalg.norm(Ax - Ax_sirf) / np.linalg.norm(Ax_sirf)))
+        errors["backward"] = max(errors["backward"], float(np.linalg.norm(Aty - Aty_sirf) / np.linalg.norm(Aty_sirf)))
+        inner_y = np.dot(Ax.astype(np.float64), y.ravel())
+        inner_x = np.dot(x.ravel().astype(np.float64), Aty)
+        errors["adjoint"] = max(errors["adjoint"], float(abs(inner_y - inner_x) / abs(inner_y)))
+    return errors
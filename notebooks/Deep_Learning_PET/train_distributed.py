@@ -0,0 +1,163 @@
+# Trains LearnedPrimalDual with data parallelism over several processes on
+# CPU nodes (torch.distributed with the gloo backend), the training loop of
+# 4_setup_training.ipynb otherwise. Every process (rank) sets up its own
+# acquisition model and projects its own share of the ellipses samples,
+# DistributedDataParallel averages the gradients, and only rank 0 validates
+# and writes the checkpoint (trained_distributed.torch_model) and the data
+# log (results_distributed.npy).
+#
+# Usage, with N processes on one host:
+#   python train_distributed.py --nproc N [--epochs 10] [--n_samples 100] [--batch_size 2]
+# or with torchrun (e.g. over several hosts):
+#   torchrun --nproc_per_node N train_distributed.py [...]
+# The throughput (samples per second over all ranks) is printed per epoch,
+# such that runs with different N can be compared.
+
+# CCP SyneRBI Synergistic Image Reconstruction Framework (SIRF).
+
+# This is software developed for the Collaborative Computational Project in Synergistic Reconstruction for Biomedical Imaging (http://www.ccpsynerbi.ac.uk/).
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import functools
+import os
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from lpd_net import LearnedPrimalDual
+from odl_funcs.ellipses import EllipsesDataset, EllipsesStore
+
+
+def train(rank, world_size, args, factory):
+    """Training loop of one rank
+
+    factory: picklable callable returning a set up
+    (image_template, sinogram_template, acq_model), called once per rank
+    """
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        _train(rank, world_size, args, factory)
+    finally:
+        dist.destroy_process_group()
+
+def _train(rank, world_size, args, factory):
+    # share the cores between the ranks instead of every rank using all of them
+    torch.set_num_threads(max((os.cpu_count() or 1) // world_size, 1))
+    torch.manual_seed(args.seed)
+    image_template, sinogram_template, acq_model = factory()
+
+    if args.store:
+        train_dataset = EllipsesStore(args.store)
+    else:
+        train_dataset = EllipsesDataset(acq_model.forward, image_template, mode="train",
+                                        n_samples=args.n_samples, seed=args.seed)
+    # every rank gets its own share of the samples, reshuffled per epoch
+    sampler = DistributedSampler(train_dataset, world_size, rank, shuffle=True, seed=args.seed)
+    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, sampler=sampler,
+                                  num_workers=args.num_workers)
+
+    model = LearnedPrimalDual(image_template, sinogram_template, acq_model, n_iter=args.n_iter,
+                              n_primal=args.n_primal, n_dual=args.n_dual, n_layers=args.n_layers,
+                              n_feature_channels=args.n_feature_channels)
+    # same initial weights everywhere (DDP broadcasts those of rank 0 as well)
+    ddp_model = DistributedDataParallel(model)
+    criterion = torch.nn.MSELoss(reduction='sum')
+    optimizer = torch.optim.Adam(ddp_model.parameters(), lr=args.lr, betas=(0.99, 0.999))
+
+    if rank == 0:
+        valid_dataset = EllipsesDataset(acq_model.forward, image_template, mode="valid", seed=args.seed)
+        x_gt_valid, y_valid = (torch.from_numpy(np.asarray(a)).float()[None] for a in valid_dataset[0])
+        data_log = {"valid_loss": [], "valid_image": [], "loss": [], "throughput": []}
+        min_valid_loss = np.inf
+
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch)
+        model.train()
+        start = time.perf_counter()
+        n_samples = torch.zeros(1)
+        losses = []
+        for x_gt, y in train_dataloader:
+            x_gt, y = x_gt.float(), y.float()
+            x = ddp_model(y)
+            loss = criterion(x_gt, x)
+            optimizer.zero_grad()
+            # DDP all-reduces (averages) the gradients during backward
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(ddp_model.parameters(), max_norm=1)
+            optimizer.step()
+            n_samples += len(y)
+            losses.append(loss.item())
+        # throughput over all ranks, limited by the slowest one
+        elapsed = torch.tensor([time.perf_counter() - start])
+        dist.all_reduce(n_samples)
+        dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)
+        throughput = n_samples.item() / elapsed.item()
+
+        if rank == 0:
+            model.eval()
+            with torch.no_grad():
+                x_valid = model(y_valid)
+            loss_valid = criterion(x_gt_valid, x_valid).item()
+            # training losses of the batches of rank 0
+            data_log["loss"].extend(losses)
+            data_log["valid_loss"].append(loss_valid)
+            data_log["valid_image"].append(x_valid[0, 0].numpy())
+            data_log["throughput"].append(throughput)
+            print("Epoch {}: validation loss {:.2f}, {:.2f} samples/s on {} ranks".format(
+                epoch, loss_valid, throughput, world_size), flush=True)
+            if loss_valid < min_valid_loss:
+                min_valid_loss = loss_valid
+                torch.save({'model_state_dict': model.state_dict(),
+                            'optimizer_state_dict': optimizer.state_dict(),
+                            }, os.path.join(args.output, 'trained_distributed.torch_model'))
+            np.save(os.path.join(args.output, 'results_distributed'), data_log)
+
+def _spawned(rank, world_size, args, factory):
+    # entry point of the processes started by --nproc
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    train(rank, world_size, args, factory)
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Data parallel training of LearnedPrimalDual")
+    parser.add_argument("--nproc", type=int, default=0,
+                        help="number of processes to start on this host (not with torchrun)")
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument("--output", default=".")
+    parser.add_argument("--store", help="directory of an ellipses store (see generate_ellipses.py)")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--n_samples", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=2, help="per rank")
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--lr", type=float, default=5e-4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--size_xy", type=int, default=128)
+    parser.add_argument("--n_iter", type=int, default=2)
+    parser.add_argument("--n_primal", type=int, default=5)
+    parser.add_argument("--n_dual", type=int, default=5)
+    parser.add_argument("--n_layers", type=int, default=5)
+    parser.add_argument("--n_feature_channels", type=int, default=128)
+    return parser
+
+def main(args, factory):
+    if args.nproc > 0:
+        mp.spawn(_spawned, args=(args.nproc, args, factory), nprocs=args.nproc)
+    else:
+        # started by torchrun, which sets the rank and world size
+        train(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]), args, factory)
+
+
+if __name__ == "__main__":
+    from generate_ellipses import thorax_single_slice
+
+    args = parser().parse_args()
+    main(args, functools.partial(thorax_single_slice, args.size_xy))
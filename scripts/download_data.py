@@ -0,0 +1,15 @@
+#! /usr/bin/env python3
+# Downloads specified data for the SIRF-Exercises (with parallel, resumable
+# downloads and a shared cache), as well as creating Python scripts such that
+# the exercises know where the data is. Same options as download_data.sh,
+# see lib/sirf_exercises/download.py or run with -h.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib'))
+
+from sirf_exercises.download import main
+
+if __name__ == '__main__':
+    main()
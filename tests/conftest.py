@@ -0,0 +1,13 @@
+# Checks of the sirf_exercises modules and the deep learning exercise code
+# against NumPy stand-ins for SIRF (and CIL), so SIRF is not needed.
+#
+# Usage (from the top of the repository):
+#   python -m pytest -q tests
+
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in (os.path.join(_root, 'lib'), os.path.join(_root, 'notebooks', 'Deep_Learning_PET')):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
@@ -0,0 +1,103 @@
+# NumPy stand-ins for SIRF data containers and acquisition models
+
+import numpy
+
+
+class Data:
+    '''Image or acquisition data (views on the second to last axis)'''
+
+    def __init__(self, array, voxel_sizes=None, views=None):
+        self.array = numpy.array(array, dtype=numpy.float32)
+        self._voxel_sizes = voxel_sizes or (1.,) * self.array.ndim
+        # the views of the full data, for a subset
+        self.views = views
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def as_array(self):
+        return self.array.copy()
+
+    def fill(self, values):
+        self.array[...] = values.array if isinstance(values, Data) else values
+        return self
+
+    def get_uniform_copy(self, value=1):
+        return Data(numpy.full_like(self.array, value), self._voxel_sizes)
+
+    def clone(self):
+        return Data(self.array, self._voxel_sizes)
+
+    def voxel_sizes(self):
+        return self._voxel_sizes
+
+    def get_subset(self, views):
+        return Data(self.array[..., list(views), :], views=list(views))
+
+
+class MatrixModel:
+    '''
+    Acquisition model y = A x (+ additive) with a dense random matrix A, with
+    subsets of views as sirf.STIR (every num_subsets-th view, 0 elsewhere).
+    '''
+
+    def __init__(self, image_shape, data_shape, seed=0, additive=None, views=None, matrix=None):
+        self.image_shape = tuple(image_shape)
+        self.data_shape = tuple(data_shape)
+        if matrix is None:
+            rng = numpy.random.default_rng(seed)
+            matrix = rng.random(self.data_shape + (int(numpy.prod(image_shape)),))
+            # voxels outside the field of view
+            matrix[..., :2] = 0
+        self.matrix = matrix
+        self.additive = additive
+        self.num_subsets = 1
+        self.subset_num = 0
+        self.calls = 0
+
+    def for_views(self, template):
+        '''The model of the views of template (as returned by get_subset of the full data)'''
+        views = template.views
+        return MatrixModel(self.image_shape, template.shape, matrix=self.matrix[..., views, :, :],
+                           additive=None if self.additive is None else self.additive[..., views, :])
+
+    def _mask(self):
+        views = numpy.arange(self.data_shape[-2]) % self.num_subsets == self.subset_num
+        return numpy.broadcast_to(views[:, None], self.data_shape)
+
+    def forward(self, image):
+        self.calls += 1
+        y = self.matrix.reshape(-1, self.matrix.shape[-1]) @ image.array.ravel().astype(numpy.float64)
+        y = y.reshape(self.data_shape)
+        if self.additive is not None:
+            y = y + self.additive
+        return Data(y * self._mask())
+
+    def backward(self, data):
+        self.calls += 1
+        y = (data.array * self._mask()).ravel().astype(numpy.float64)
+        return Data((self.matrix.reshape(-1, self.matrix.shape[-1]).T @ y).reshape(self.image_shape))
+
+
+def reference_osem(model, data, initial, num_subsets, num_iterations):
+    '''OSEM as in the DIY_OSEM notebook, with the dense matrix of model (a MatrixModel)'''
+    A = model.matrix.reshape(model.data_shape + (-1,))
+    x = numpy.array(initial, dtype=numpy.float64).ravel()
+    additive = 0 if model.additive is None else model.additive
+    for _ in range(num_iterations):
+        for subset_num in range(num_subsets):
+            A_s = A[..., subset_num::num_subsets, :, :].reshape(-1, x.size)
+            y_s = data[..., subset_num::num_subsets, :].ravel()
+            b_s = (numpy.broadcast_to(additive, model.data_shape)[..., subset_num::num_subsets, :]).ravel()
+            sensitivity = A_s.T @ numpy.ones_like(y_s)
+            update = A_s.T @ (y_s / (A_s @ x + b_s))
+            x = x * numpy.divide(update, sensitivity, out=numpy.zeros_like(x), where=sensitivity > 0)
+    return x.reshape(model.image_shape)
+
+
+def single_slice(image_shape=(1, 6, 6), sinogram_shape=(1, 1, 8, 10)):
+    '''(image_template, sinogram_template, acq_model) of a single slice, as the
+    factory of a sirf_torch.ProjectorPool (the same model in every worker)'''
+    return (Data(numpy.zeros(image_shape)), Data(numpy.zeros(sinogram_shape)),
+            MatrixModel(image_shape, sinogram_shape))
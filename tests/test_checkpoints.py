@@ -0,0 +1,33 @@
+import os
+
+import torch
+
+from checkpoints import CheckpointManager
+
+
+def test_snapshots_and_rotation(tmp_path):
+    directory = str(tmp_path)
+    model = torch.nn.Linear(3, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+    checkpoints = CheckpointManager(directory, keep_last=2, keep_best=1)
+    weights = []
+    for epoch, metric in enumerate([3., 1., 2., 4., 5.]):
+        model(torch.ones(1, 3)).sum().backward()
+        optimizer.step()
+        weights.append(model.weight.detach().clone())
+        checkpoints.save(epoch, model, optimizer, {"loss": [metric]}, metric=metric)
+        # the snapshot, not the live weights, are written
+        with torch.no_grad():
+            model.weight.fill_(-1)
+    checkpoints.close()
+    assert sorted(os.listdir(directory)) == ["checkpoint_000001.torch_model", "checkpoint_000003.torch_model",
+                                             "checkpoint_000004.torch_model", "checkpoints.json"]
+
+    resumed = CheckpointManager(directory)
+    assert resumed.latest() == resumed.filename(4) and resumed.best() == resumed.filename(1)
+    state = resumed.load(model, optimizer)
+    assert state["epoch"] == 4 and state["data_log"] == {"loss": [5.]}
+    torch.testing.assert_close(model.weight.detach(), weights[4])
+    resumed.load(model, filename=resumed.best())
+    torch.testing.assert_close(model.weight.detach(), weights[1])
+    resumed.close()
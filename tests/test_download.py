@@ -0,0 +1,122 @@
+import functools
+import hashlib
+import http.server
+import os
+import re
+import threading
+import zipfile
+
+import numpy
+import pytest
+
+from sirf_exercises import download
+
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    # http.server without support for ranged requests, unless ranges is a list
+    # (of the requested ranges)
+    ranges = None
+
+    def do_GET(self):
+        with open(self.translate_path(self.path), 'rb') as f:
+            content = f.read()
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if self.ranges is None or not match:
+            start, end = 0, len(content)
+            self.send_response(200)
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(content)
+            self.ranges.append((start, end))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(content)))
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        self.wfile.write(content[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'ranges'])
+def server(request, tmp_path):
+    served = tmp_path / 'served'
+    served.mkdir()
+    handler = type('Handler', (RangeHandler,), dict(ranges=[] if request.param else None))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                            functools.partial(handler, directory=str(served)))
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(httpd.server_address[1]), served, handler
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _serve(served, name, content):
+    (served / name).write_bytes(content)
+    return hashlib.md5(content).hexdigest()
+
+
+def test_fetch(server, tmp_path):
+    url, served, handler = server
+    content = numpy.random.default_rng(0).bytes(10000)
+    md5 = _serve(served, 'file.bin', content)
+    cache = str(tmp_path / 'cache')
+    filename = download.fetch(url + 'file.bin', md5, cache, n_threads=4, chunk_size=1000)
+    assert filename == os.path.join(cache, 'md5', md5)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    if handler.ranges is not None:
+        assert len(handler.ranges) == 11  # the size, then 10 chunks
+    # from the cache
+    os.remove(str(served / 'file.bin'))
+    assert download.fetch(url + 'file.bin', md5, cache) == filename
+
+
+def test_resume(server, tmp_path):
+    url, served, handler = server
+    if handler.ranges is None:
+        pytest.skip('needs ranged requests')
+    content = numpy.random.default_rng(1).bytes(5000)
+    md5 = _serve(served, 'file.bin', content)
+    cache = str(tmp_path / 'cache')
+    os.makedirs(os.path.join(cache, 'partial'))
+    # an interrupted download with the first 2 chunks done
+    partial = download._Partial(os.path.join(cache, 'partial', md5), len(content), 1000)
+    with open(partial.filename, 'r+b') as f:
+        f.write(content[:2000])
+    partial.done(0)
+    partial.done(1)
+    filename = download.fetch(url + 'file.bin', md5, cache, chunk_size=1000)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert sorted(handler.ranges)[1:] == [(start, start + 1000) for start in range(2000, 5000, 1000)]
+
+
+def test_md5_mismatch(server, tmp_path):
+    url, served, _ = server
+    _serve(served, 'file.bin', b'corrupted')
+    md5 = hashlib.md5(b'original').hexdigest()
+    cache = str(tmp_path / 'cache')
+    with pytest.raises(RuntimeError):
+        download.fetch(url + 'file.bin', md5, cache, chunk_size=4)
+    assert not os.path.exists(os.path.join(cache, 'md5', md5))
+    assert not os.path.exists(os.path.join(cache, 'partial', md5))
+
+
+def test_download_mirror(server, tmp_path, monkeypatch):
+    url, served, _ = server
+    archive = tmp_path / 'data.zip'
+    with zipfile.ZipFile(str(archive), 'w') as z:
+        for i in range(5):
+            z.writestr('NEMA/file{}.txt'.format(i), 'content {}'.format(i))
+    md5 = _serve(served, 'data.zip', archive.read_bytes())
+    monkeypatch.setitem(download.DATASETS, 'PET', [dict(filename='data.zip', url='http://invalid/', md5=md5,
+                                                       destination=('PET', 'mMR'), extract=True)])
+    data_path, lib_dir = tmp_path / 'data', tmp_path / 'lib'
+    lib_dir.mkdir()
+    download.download(['PET'], str(data_path), cache_dir=str(tmp_path / 'cache'), mirror=url,
+                      n_threads=2, lib_dir=str(lib_dir))
+    for i in range(5):
+        assert (data_path / 'PET' / 'mMR' / 'NEMA' / 'file{}.txt'.format(i)).read_text() == 'content {}'.format(i)
+    assert (lib_dir / 'data_path.py').read_text() == "data_path = '{}'\n".format(os.path.realpath(str(data_path)))
@@ -0,0 +1,99 @@
+import numpy
+import pytest
+
+from sirf_exercises.interfile import DataCatalog, InterfileData, read_header
+
+IMAGE_HEADER = '''!INTERFILE  :=
+name of data file := image.v
+!GENERAL DATA :=
+imagedata byte order := LITTLEENDIAN
+!number format := float
+!number of bytes per pixel := 4
+number of dimensions := 3
+!matrix size [1] := 7
+!matrix size [2] := 6
+!matrix size [3] := 5
+data offset in bytes [1] := 0
+!END OF INTERFILE :=
+'''
+
+# 2 timing positions, 3 segments of 4 views, 3, 2 and 2 sinograms and 8 bins
+SINOGRAM_HEADER = '''!INTERFILE  :=
+name of data file := sinogram.s
+imagedata byte order := BIGENDIAN
+!number format := float
+!number of bytes per pixel := 4
+number of dimensions := 5
+matrix axis label [5] := timing positions
+!matrix size [5] := 2
+matrix axis label [4] := segment
+!matrix size [4] := 3
+matrix axis label [3] := view
+!matrix size [3] := 4
+matrix axis label [2] := axial coordinate
+!matrix size [2] := { 3, 2,2}
+matrix axis label [1] := tangential coordinate
+!matrix size [1] := 8
+minimum ring difference per segment := { -1, -4, 2}
+maximum ring difference per segment := { 1, -2, 4}
+data offset in bytes[1] := 16
+!END OF INTERFILE :=
+'''
+
+SEGMENT_SHAPES = [(4, 3, 8), (4, 2, 8), (4, 2, 8)]
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    image = numpy.arange(5 * 6 * 7, dtype='<f4').reshape(5, 6, 7)
+    image.tofile(str(tmp_path / 'image.v'))
+    (tmp_path / 'image.hv').write_text(IMAGE_HEADER)
+    sinogram = numpy.arange(2 * sum(numpy.prod(s) for s in SEGMENT_SHAPES), dtype='>f4')
+    with open(str(tmp_path / 'sinogram.s'), 'wb') as f:
+        f.write(b'\0' * 16)
+        sinogram.tofile(f)
+    (tmp_path / 'sinogram.hs').write_text(SINOGRAM_HEADER)
+    return tmp_path
+
+
+def test_header_keys(data_dir):
+    header = read_header(str(data_dir / 'image.hv'))
+    assert header['matrix size[1]'] == '7'
+    assert header['name of data file'] == 'image.v'
+
+
+def test_image(data_dir):
+    image = InterfileData(str(data_dir / 'image.hv'))
+    assert not image.is_projection_data and image.shape == (5, 6, 7)
+    numpy.testing.assert_array_equal(image.array, numpy.arange(210).reshape(5, 6, 7))
+    assert image[2, 3, 4] == 2 * 42 + 3 * 7 + 4
+
+
+def test_segments(data_dir):
+    sinogram = InterfileData(str(data_dir / 'sinogram.hs'))
+    assert sinogram.num_segments == 3 and sinogram.shape == tuple(SEGMENT_SHAPES)
+    assert sinogram.ring_differences == [(-1, 1), (-4, -2), (2, 4)]
+    with pytest.raises(ValueError):
+        sinogram.array  # the segments have different shapes
+    with pytest.raises(IndexError):
+        sinogram.segment(3)
+    sizes = [int(numpy.prod(s)) for s in SEGMENT_SHAPES]
+    start = 0
+    for timing_position in range(2):
+        for segment, shape in enumerate(SEGMENT_SHAPES):
+            expected = numpy.arange(start, start + sizes[segment]).reshape(shape)
+            numpy.testing.assert_array_equal(sinogram.segment(segment, timing_position), expected)
+            start += sizes[segment]
+
+
+def test_catalog(data_dir):
+    (data_dir / 'sub').mkdir()
+    (data_dir / 'sub' / 'broken.hv').write_text('!INTERFILE :=\n')
+    catalog = DataCatalog(str(data_dir))
+    assert catalog.find() == ['image.hv', 'sinogram.hs']
+    assert catalog.find('sino') == catalog.find(kind='sinogram') == ['sinogram.hs']
+    assert list(catalog.errors) == ['sub/broken.hv']
+    assert catalog.open('image.hv').shape == (5, 6, 7)
+    # the second catalog uses the cache file
+    cached = DataCatalog(str(data_dir))
+    assert cached.entries == catalog.entries
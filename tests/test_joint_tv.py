@@ -0,0 +1,105 @@
+import numpy
+import pytest
+
+from sirf_exercises.joint_tv import smooth_joint_tv, smooth_joint_tv_gradient
+
+
+def _differences(a, axes, voxel_sizes):
+    # forward differences with Neumann boundaries, as CIL's GradientOperator
+    out = []
+    for axis in axes:
+        d = numpy.zeros_like(a)
+        head = [slice(None)] * a.ndim
+        tail = list(head)
+        head[axis] = slice(0, -1)
+        tail[axis] = slice(1, None)
+        d[tuple(head)] = (a[tuple(tail)] - a[tuple(head)]) / voxel_sizes[axis]
+        out.append(d)
+    return out
+
+
+def _adjoint(qs, axes, voxel_sizes):
+    total = 0
+    for q, axis in zip(qs, axes):
+        p = -q / voxel_sizes[axis]
+        head = [slice(None)] * q.ndim
+        tail = list(head)
+        head[axis] = slice(1, None)
+        tail[axis] = slice(0, -1)
+        p[tuple(head)] += q[tuple(tail)] / voxel_sizes[axis]
+        total = total + p
+    return total
+
+
+CASES = [((5, 6, 7), (0, 1, 2), (1., 1., 1.)),
+         ((1, 9, 10), (1, 2), (1., 1., 1.)),
+         ((12, 11), (0, 1), (2., 0.5))]
+
+
+def _images(shape, complex_):
+    rng = numpy.random.default_rng(0)
+    u, v = rng.random(shape), rng.random(shape)
+    if complex_:
+        u = u + 1j * rng.random(shape)
+        v = v + 1j * rng.random(shape)
+    return u, v
+
+
+@pytest.mark.parametrize('complex_', [False, True])
+@pytest.mark.parametrize('shape, axes, voxel_sizes', CASES)
+def test_matches_reference(shape, axes, voxel_sizes, complex_):
+    u, v = _images(shape, complex_)
+    lambda_par, eta = 0.3, 1e-2
+    Du, Dv = _differences(u, axes, voxel_sizes), _differences(v, axes, voxel_sizes)
+    magnitude = numpy.sqrt(lambda_par * sum(abs(d) ** 2 for d in Du) +
+                           (1 - lambda_par) * sum(abs(d) ** 2 for d in Dv) + eta ** 2)
+    value = smooth_joint_tv(u, v, eta, lambda_par, axes, voxel_sizes)
+    assert value == pytest.approx(magnitude.sum(), rel=1e-10)
+    for axis, (D, weight) in enumerate(((Du, lambda_par), (Dv, 1 - lambda_par))):
+        reference = _adjoint([weight * d / magnitude for d in D], axes, voxel_sizes)
+        gradient = smooth_joint_tv_gradient(u, v, eta, lambda_par, axis, axes, voxel_sizes)
+        assert gradient.dtype == reference.dtype
+        # the inverse magnitude is kept in a float32 workspace
+        numpy.testing.assert_allclose(gradient, reference, rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('complex_', [False, True])
+def test_gradient_finite_differences(complex_):
+    # for complex images, the gradient is d/d(real part) + i d/d(imaginary part)
+    u, v = _images((4, 5, 6), complex_)
+    lambda_par, eta, step = 0.4, 1e-1, 1e-6
+    for axis in (0, 1):
+        gradient = smooth_joint_tv_gradient(u, v, eta, lambda_par, axis)
+        for index in [(0, 0, 0), (2, 3, 1), (3, 4, 5)]:
+            for part in ((1, 1j) if complex_ else (1,)):
+                x = [u.copy(), v.copy()]
+                x[axis][index] += step
+                x[axis][index] += (part - 1) * step
+                difference = (smooth_joint_tv(x[0], x[1], eta, lambda_par) -
+                              smooth_joint_tv(u, v, eta, lambda_par)) / step
+                expected = gradient[index].real if part == 1 else gradient[index].imag
+                assert difference == pytest.approx(expected, abs=1e-5)
+
+
+def test_float32_workspace():
+    u, v = (a.astype(numpy.float32) for a in _images((3, 8, 9), False))
+    out = numpy.empty_like(u)
+    work = numpy.empty(u.shape, dtype=numpy.float32)
+    result = smooth_joint_tv_gradient(u, v, 1e-2, 0.5, 0, out=out, work=work)
+    assert result is out
+    reference = smooth_joint_tv_gradient(u.astype(float), v.astype(float), 1e-2, 0.5, 0)
+    numpy.testing.assert_allclose(out, reference, rtol=1e-4, atol=1e-5)
+
+
+def test_smooth_joint_tv_class():
+    pytest.importorskip('cil')
+    from cil.framework import BlockDataContainer, ImageGeometry
+    from sirf_exercises.joint_tv import SmoothJointTV
+    geometry = ImageGeometry(voxel_num_x=9, voxel_num_y=8)
+    u, v = geometry.allocate('random'), geometry.allocate('random')
+    x = BlockDataContainer(u, v)
+    function = SmoothJointTV(eta=1e-2, axis=1, lambda_par=0.5)
+    gradient = function.gradient(x)
+    numpy.testing.assert_allclose(gradient[0].as_array(), 0)
+    numpy.testing.assert_allclose(gradient[1].as_array(), smooth_joint_tv_gradient(
+        u.as_array(), v.as_array(), 1e-2, 0.5, 1), rtol=1e-5)
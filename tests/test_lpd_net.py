@@ -0,0 +1,56 @@
+import numpy
+import pytest
+import torch
+
+from lpd_net import LearnedPrimalDual
+from reconstruct import InferenceEngine
+from standins import single_slice
+
+
+def _model(**kwargs):
+    torch.manual_seed(0)
+    model = LearnedPrimalDual(*single_slice(), n_iter=3, n_primal=3, n_dual=3, n_layers=2,
+                              n_feature_channels=4, **kwargs)
+    # the default initialisation (identity blocks) does not test much
+    for parameter in model.parameters():
+        torch.nn.init.normal_(parameter, std=0.1)
+    return model
+
+
+def _run(model):
+    g = torch.from_numpy(numpy.random.default_rng(1).random((5, 1, 8, 10), dtype=numpy.float32))
+    out = model(g)
+    out.square().sum().backward()
+    return out.detach(), [parameter.grad for parameter in model.parameters()]
+
+
+@pytest.mark.parametrize("kwargs", [dict(micro_batches=2), dict(checkpointing=True), dict(staging=True),
+                                    dict(micro_batches=3, checkpointing=True, staging=True)])
+def test_variants_match(kwargs):
+    out, grads = _run(_model())
+    other_out, other_grads = _run(_model(**kwargs))
+    torch.testing.assert_close(other_out, out)
+    for grad, other_grad in zip(grads, other_grads):
+        torch.testing.assert_close(other_grad, grad, rtol=1e-4, atol=1e-5)
+
+
+def test_moved_model():
+    model = _model(staging=True)
+    g = torch.rand(2, 1, 8, 10)
+    with torch.no_grad():
+        expected = model(g)
+        torch.testing.assert_close(model.to("cpu").float()(g), expected)
+
+
+def test_inference_engine():
+    model = _model().eval()
+    sinograms = numpy.random.default_rng(2).random((7, 8, 10), dtype=numpy.float32)
+    with torch.no_grad():
+        expected = model(torch.from_numpy(sinograms).unsqueeze(1)).numpy()
+    with InferenceEngine(model, max_batch_size=3, latency_budget=0.05) as engine:
+        result = engine.reconstruct(sinograms)
+        report = engine.report()
+    numpy.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+    assert report["n_samples"] == 7 and report["n_batches"] >= 3
+    with pytest.raises(RuntimeError):
+        engine.submit(sinograms[0])
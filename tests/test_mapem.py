@@ -0,0 +1,95 @@
+import numpy
+import pytest
+
+from sirf_exercises.mapem import (Neighbourhood, NeighbourWeights, bowsher_weights,
+                                  de_pierro_regularisation, de_pierro_update)
+
+
+def _reference_regularisation(image, weights):
+    # dePierroReg of the MAPEM_Bowsher notebook, with the dense index and
+    # weight matrices (voxels in Fortran order)
+    index = weights.neighbourhood.index_matrix()
+    dense = weights.dense()
+    flat = image.ravel(order='F').astype(numpy.float64)
+    reg = 0.5 * numpy.sum(dense * (flat[index] + flat[:, None]), axis=1) / numpy.sum(dense, axis=1)
+    return reg.reshape(image.shape, order='F')
+
+
+SHAPES = [((6, 7, 8), 3), ((9, 10), 3), ((1, 8, 8), 3), ((1, 8, 8), 5), ((2, 9, 7), 5)]
+
+
+def _random_weights(nhood, rng):
+    return NeighbourWeights.from_dense(
+        nhood, rng.random((int(numpy.prod(nhood.shape)), nhood.n_neighbours)) * (rng.random((1, nhood.n_neighbours)) < 0.6))
+
+
+@pytest.mark.parametrize('shape, size', SHAPES)
+def test_regularisation_matches_dense(shape, size):
+    rng = numpy.random.default_rng(0)
+    image = rng.random(shape).astype(numpy.float32)
+    nhood = Neighbourhood(shape, size)
+    for weights in (NeighbourWeights.uniform(nhood), _random_weights(nhood, rng)):
+        reg = de_pierro_regularisation(image, weights)
+        assert numpy.isfinite(reg).all()
+        numpy.testing.assert_allclose(reg, _reference_regularisation(image, weights), rtol=1e-5)
+
+
+@pytest.mark.parametrize('shape, size', SHAPES)
+def test_update(shape, size):
+    rng = numpy.random.default_rng(1)
+    image = rng.random(shape).astype(numpy.float32)
+    image_EM = rng.random(shape).astype(numpy.float32)
+    weights = NeighbourWeights.uniform(Neighbourhood(shape, size))
+    beta = 0.3
+    a = 1 - beta * _reference_regularisation(image, weights)
+    reference = 2 * image_EM / (numpy.sqrt(a * a + 4 * beta * image_EM) + a + 0.00001)
+    # in place into image_EM, as allowed
+    out = de_pierro_update(image, image_EM.copy(), beta, weights)
+    numpy.testing.assert_allclose(out, reference, rtol=1e-5)
+    with pytest.raises(ValueError):
+        de_pierro_update(image, image_EM, beta, weights, out=image)
+
+
+def test_neighbourhood_numbering():
+    nhood = Neighbourhood((4, 5, 6))
+    assert nhood.n_neighbours == 27
+    numpy.testing.assert_array_equal(nhood.offsets[nhood.centre], 0)
+    # the first axis varies slowest
+    numpy.testing.assert_array_equal(nhood.offsets[1], [-1, -1, 0])
+    with pytest.raises(ValueError):
+        Neighbourhood((4, 5, 6), size=4)
+
+
+def _differences(image, nhood):
+    # (voxels in Fortran order, n_neighbours) absolute differences to the neighbours
+    flat = image.ravel(order='F')
+    return numpy.abs(flat[nhood.index_matrix()] - flat[:, None])
+
+
+@pytest.mark.parametrize('shape, size', SHAPES)
+def test_bowsher_selects_most_similar(shape, size):
+    # single plane images wrap onto themselves, so there are ties: compare
+    # the differences of the selected neighbours, not their numbers
+    rng = numpy.random.default_rng(2)
+    image = rng.random(shape).astype(numpy.float32)
+    nhood = Neighbourhood(shape, size)
+    k = 4
+    weights = bowsher_weights(image, k, nhood)
+    neighbours = weights.neighbours.reshape(-1, k, order='F')
+    assert ((neighbours >= 0) & (neighbours < nhood.n_neighbours)).all()
+    assert not (neighbours == nhood.centre).any()
+    differences = _differences(image, nhood)
+    selected = numpy.sort(numpy.take_along_axis(differences, neighbours, axis=1), axis=1)
+    smallest = numpy.sort(numpy.delete(differences, nhood.centre, axis=1), axis=1)[:, :k]
+    numpy.testing.assert_array_equal(selected, smallest)
+    reg = de_pierro_regularisation(image, weights)
+    assert numpy.isfinite(reg).all()
+    numpy.testing.assert_allclose(reg, _reference_regularisation(image, weights), rtol=1e-5)
+
+
+def test_bowsher_matches_kcl():
+    # without ties, the same neighbours as kcl.Prior.BowshserWeights
+    image = numpy.random.default_rng(3).random((5, 6, 7)).astype(numpy.float32)
+    nhood = Neighbourhood(image.shape)
+    numpy.testing.assert_array_equal(bowsher_weights(image, 5, nhood).neighbours,
+                                     bowsher_weights(image, 5, nhood, match_kcl=True).neighbours)
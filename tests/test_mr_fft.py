@@ -0,0 +1,39 @@
+import numpy
+import pytest
+
+from sirf_exercises import mr_fft
+
+
+def _complex(shape, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(numpy.complex64)
+
+
+@pytest.mark.parametrize('shape, axes', [((64, 8, 128), (0, 2)), ((33, 4, 17), (0, 2)),
+                                         ((10, 5, 12, 9), (1, 2, 3))])
+def test_centred_transforms(shape, axes):
+    kdata = _complex(shape)
+    shifted = numpy.fft.ifftshift(kdata, axes=axes)
+    for transform, reference in ((mr_fft.centred_ifft, numpy.fft.ifftn), (mr_fft.centred_fft, numpy.fft.fftn)):
+        expected = numpy.fft.fftshift(reference(shifted, axes=axes), axes=axes)
+        result = transform(kdata, axes)
+        assert result.dtype == numpy.complex64
+        numpy.testing.assert_allclose(result, expected, rtol=0, atol=1e-5 * abs(expected).max())
+
+
+def test_overwrite():
+    kdata = _complex((16, 4, 10))
+    expected = mr_fft.centred_ifft(kdata, (0, 2))
+    result = mr_fft.centred_ifft(kdata, (0, 2), overwrite=True)
+    assert numpy.shares_memory(result, kdata)
+    numpy.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-7)
+
+
+def test_coil_combination():
+    images, csm = _complex((6, 8, 10)), _complex((6, 8, 10), seed=1)
+    expected = numpy.sqrt((abs(images.astype(numpy.complex128)) ** 2).sum(1))
+    numpy.testing.assert_allclose(mr_fft.rss(images), expected, rtol=1e-5)
+    expected = (csm.conj() * images).sum(1) / (abs(csm) ** 2).sum(1)
+    numpy.testing.assert_allclose(mr_fft.csm_combine(images, csm), expected, rtol=1e-4, atol=1e-6)
+    with pytest.raises(ValueError):
+        mr_fft.csm_combine(images, csm[:, :4])
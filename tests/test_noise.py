@@ -0,0 +1,45 @@
+import numpy
+import pytest
+
+from sirf_exercises.noise import poisson_noise
+from standins import Data
+
+
+@pytest.fixture
+def data():
+    return numpy.random.default_rng(0).random((3, 40, 50), dtype=numpy.float32) * 5
+
+
+def test_independent_of_threads(data):
+    # the streams belong to the chunks, not to the threads
+    serial = poisson_noise(data, 0.5, seed=3, chunk_size=1000, n_threads=1)
+    parallel = poisson_noise(data, 0.5, seed=3, chunk_size=1000, n_threads=7)
+    assert serial.dtype == numpy.float32
+    numpy.testing.assert_array_equal(serial, parallel)
+    assert not numpy.array_equal(serial, poisson_noise(data, 0.5, seed=4, chunk_size=1000))
+
+
+def test_statistics(data):
+    noisy = poisson_noise(data, 0.5, seed=1)
+    counts = noisy / 0.5
+    numpy.testing.assert_array_equal(counts, numpy.round(counts))
+    assert abs(noisy.mean() - data.mean()) < 0.02 * data.mean()
+    counts = poisson_noise(data, 0.5, seed=1, rescale=False)
+    numpy.testing.assert_array_equal(counts * numpy.float32(0.5), noisy)
+
+
+def test_container_and_absolute_value(data):
+    noisy = poisson_noise(Data(data[0]), seed=numpy.random.default_rng(2))
+    assert isinstance(noisy, Data)
+    assert noisy.shape == data[0].shape
+    numpy.testing.assert_array_equal(poisson_noise(-data, seed=1), poisson_noise(data, seed=1))
+
+
+def test_out(data):
+    out = numpy.empty(data.shape, dtype=numpy.float32)
+    assert poisson_noise(data, seed=1, out=out) is out
+    numpy.testing.assert_array_equal(out, poisson_noise(data, seed=1))
+    for wrong in (numpy.empty(data.shape), numpy.empty(data.shape[::-1], dtype=numpy.float32).T,
+                  numpy.empty(data.shape[1:], dtype=numpy.float32)):
+        with pytest.raises(ValueError):
+            poisson_noise(data, out=wrong)
@@ -0,0 +1,68 @@
+import os
+
+import numpy
+import pytest
+
+from sirf_exercises import osem
+from standins import Data, MatrixModel, reference_osem
+
+IMAGE_SHAPE = (1, 6, 6)
+DATA_SHAPE = (1, 2, 8, 10)
+
+
+@pytest.fixture
+def problem():
+    osem._sensitivity_cache.clear()
+    model = MatrixModel(IMAGE_SHAPE, DATA_SHAPE, additive=0.1)
+    truth = Data(numpy.random.default_rng(1).random(IMAGE_SHAPE))
+    return model, truth, model.forward(truth)
+
+
+@pytest.mark.parametrize('num_subsets', [1, 4])
+def test_matches_reference(problem, num_subsets):
+    model, truth, data = problem
+    recon = osem.EMReconstructor(model, data, num_subsets=num_subsets)
+    image = recon.reconstruct(truth.get_uniform_copy(1), 5)
+    reference = reference_osem(model, data.array, numpy.ones(IMAGE_SHAPE), num_subsets, 5)
+    numpy.testing.assert_allclose(image.as_array(), reference, rtol=1e-4, atol=1e-6)
+    # no NaNs outside the field of view, and the model's subsets restored
+    assert not numpy.isnan(image.as_array()).any()
+    assert (model.num_subsets, model.subset_num) == (1, 0)
+
+
+def test_sensitivities_computed_once(problem, tmp_path):
+    model, truth, data = problem
+    osem.EMReconstructor(model, data, num_subsets=4, image=truth)
+    model.calls = 0
+    # neither the sensitivities nor their key are computed again
+    osem.EMReconstructor(model, data, num_subsets=4, image=truth)
+    assert model.calls == 0
+    # but are written to disk when asked to, after the fact
+    osem.EMReconstructor(model, data, num_subsets=4, cache_dir=str(tmp_path), image=truth)
+    files = os.listdir(str(tmp_path))
+    assert len(files) == 1 and files[0].startswith('sensitivity_')
+    assert model.calls == 0
+    # and read from there in a new session
+    osem._sensitivity_cache.clear()
+    osem._key_cache.clear()
+    other = MatrixModel(IMAGE_SHAPE, DATA_SHAPE, additive=0.1)
+    sensitivities = osem.subset_sensitivities(other, truth, data, 4, str(tmp_path))
+    assert other.calls == 1  # only the projection of sensitivity_key
+    assert sensitivities.shape == (4,) + IMAGE_SHAPE
+
+
+def test_key_depends_on_model(problem):
+    model, truth, data = problem
+    other = MatrixModel(IMAGE_SHAPE, DATA_SHAPE, seed=5, additive=0.1)
+    assert osem.sensitivity_key(model, truth, data, 4) != osem.sensitivity_key(other, truth, data, 4)
+    assert osem.sensitivity_key(model, truth, data, 4) != osem.sensitivity_key(model, truth, data, 2)
+
+
+def test_callback_stops(problem):
+    model, truth, data = problem
+    seen = []
+    recon = osem.EMReconstructor(model, data, num_subsets=4)
+    recon.reconstruct(truth.get_uniform_copy(1), 10,
+                      callback=lambda iteration, subset_num, x: seen.append((iteration, subset_num)) or
+                      (iteration, subset_num) == (1, 2))
+    assert seen[-1] == (1, 2) and len(seen) == 7
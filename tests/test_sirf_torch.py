@@ -0,0 +1,83 @@
+import numpy
+import pytest
+import torch
+
+import sirf_torch
+from standins import single_slice as factory
+
+IMAGE_SHAPE = (1, 6, 6)
+SINOGRAM_SHAPE = (1, 1, 8, 10)
+
+
+@pytest.fixture
+def pool():
+    pool = sirf_torch.ProjectorPool(factory, num_workers=3)
+    yield pool
+    pool.close()
+
+
+def _random(shape, seed=0):
+    return torch.from_numpy(numpy.random.default_rng(seed).random(shape, dtype=numpy.float32))
+
+
+def test_pool_matches_serial(pool):
+    serial = sirf_torch.SerialProjector(*factory())
+    images = _random((5,) + IMAGE_SHAPE).numpy()
+    sinograms = _random((5,) + SINOGRAM_SHAPE).numpy()
+    numpy.testing.assert_array_equal(pool.forward(images), serial.forward(images))
+    numpy.testing.assert_array_equal(pool.backward(sinograms), serial.backward(sinograms))
+    out = numpy.empty((5,) + SINOGRAM_SHAPE, dtype=numpy.float32)
+    assert pool.forward(images, out=out) is out
+    numpy.testing.assert_allclose(out, serial.forward(images), rtol=1e-6)
+    for projector in (pool, serial):
+        assert projector.forward(images[:0]).shape == (0,) + SINOGRAM_SHAPE
+        assert projector.backward(sinograms[:0]).shape == (0,) + IMAGE_SHAPE
+    with pytest.raises(ValueError):
+        sirf_torch.ProjectorPool(factory, kind="fibre")
+
+
+@pytest.mark.parametrize("use_pool, staging", [(False, False), (True, False), (False, True)])
+def test_operators_adjoint(pool, use_pool, staging):
+    image_template, sinogram_template, acq_model = factory()
+    primal = sirf_torch.primal_op(image_template, sinogram_template, acq_model, pool if use_pool else None, staging)
+    dual = sirf_torch.dual_op(image_template, sinogram_template, acq_model, pool if use_pool else None, staging)
+    x = _random((2, 3, 6, 6)).requires_grad_()
+    y = _random((2, 3, 8, 10), seed=1).requires_grad_()
+    Ax, Aty = primal(x), dual(y)
+    assert Ax.shape == y.shape and Aty.shape == x.shape
+    matrix = torch.from_numpy(acq_model.matrix.reshape(80, 36).astype(numpy.float32))
+    torch.testing.assert_close(Ax, (x.detach().reshape(6, 36) @ matrix.T).reshape(y.shape))
+    torch.testing.assert_close((Ax * y.detach()).sum(), (x.detach() * Aty).sum())
+    # the gradients are the adjoint operators
+    (Ax * y.detach()).sum().backward()
+    torch.testing.assert_close(x.grad, Aty.detach())
+    (Aty * x.detach()).sum().backward()
+    torch.testing.assert_close(y.grad, Ax.detach())
+
+
+def test_system_matrix(tmp_path):
+    image_template, sinogram_template, acq_model = factory()
+    system_matrix = sirf_torch.extract_system_matrix(image_template, sinogram_template, acq_model,
+                                                     cache_dir=str(tmp_path), batch_size=5)
+    assert system_matrix.shape == (80, 36)
+    # the voxels outside the field of view have empty columns
+    assert len(system_matrix.data) == 80 * 34
+    errors = sirf_torch.check_system_matrix(system_matrix, image_template, sinogram_template, acq_model)
+    assert max(errors.values()) < 1e-5
+    # from the cache, with only the projection for the geometry hash
+    acq_model.calls = 0
+    cached = sirf_torch.extract_system_matrix(image_template, sinogram_template, acq_model, cache_dir=str(tmp_path))
+    assert acq_model.calls == 1
+    numpy.testing.assert_array_equal(cached.data, system_matrix.data)
+
+    x = _random((2, 3, 6, 6)).requires_grad_()
+    sparse_x = x.detach().clone().requires_grad_()
+    y = _random((2, 3, 8, 10), seed=1)
+    primal = sirf_torch.primal_op(image_template, sinogram_template, acq_model)
+    (primal(x) * y).sum().backward()
+    sparse = sirf_torch.sparse_primal_op(system_matrix)(sparse_x)
+    (sparse * y).sum().backward()
+    torch.testing.assert_close(sparse, primal(x).detach())
+    torch.testing.assert_close(sparse_x.grad, x.grad)
+    torch.testing.assert_close(sirf_torch.sparse_dual_op(system_matrix)(y),
+                               sirf_torch.dual_op(image_template, sinogram_template, acq_model)(y))
@@ -0,0 +1,58 @@
+import numpy
+import pytest
+
+from sirf_exercises import streaming
+from sirf_exercises.noise import poisson_noise
+from standins import Data, MatrixModel, reference_osem
+
+IMAGE_SHAPE = (2, 5, 5)
+# (TOF bins, sinograms, views, tangential positions)
+DATA_SHAPE = (1, 3, 20, 7)
+
+
+@pytest.fixture
+def problem(tmp_path):
+    full = MatrixModel(IMAGE_SHAPE, DATA_SHAPE)
+    additive = numpy.full(DATA_SHAPE, 0.1, dtype=numpy.float32)
+    truth = Data(numpy.random.default_rng(1).random(IMAGE_SHAPE))
+    data = Data(full.forward(truth).array + additive)
+    measured = streaming.to_memmap(data, str(tmp_path / 'measured.npy'), chunk_views=6)
+    stored = streaming.open_memmap(str(tmp_path / 'additive.npy'), DATA_SHAPE, 'w+')
+    stored[...] = additive
+    return full, truth, data, measured, stored
+
+
+def test_view_chunks():
+    assert streaming.view_chunks(10, 4) == [slice(0, 4), slice(4, 8), slice(8, 10)]
+    chunks = streaming.view_chunks(20, 2, subset_num=1, num_subsets=4)
+    numpy.testing.assert_array_equal(numpy.concatenate(chunks), numpy.arange(1, 20, 4))
+    assert max(len(c) for c in chunks) == 2
+
+
+@pytest.mark.parametrize('num_subsets', [1, 4])
+def test_matches_in_memory_osem(problem, num_subsets):
+    full, truth, data, measured, additive = problem
+    model = streaming.SIRFViewModel(full.for_views, data, truth, max_models=3)
+    image = streaming.reconstruct(model, measured, numpy.ones(IMAGE_SHAPE), 3, num_subsets,
+                                  additive=additive, chunk_views=3)
+    reference_model = MatrixModel(IMAGE_SHAPE, DATA_SHAPE, matrix=full.matrix, additive=numpy.array(additive))
+    reference = reference_osem(reference_model, data.array, numpy.ones(IMAGE_SHAPE), num_subsets, 3)
+    numpy.testing.assert_allclose(image, reference, rtol=1e-5, atol=1e-6 * reference.max())
+    # the set up models of at most max_models chunks are kept
+    assert len(model._models) <= 3
+
+
+def test_expectation(problem, tmp_path):
+    full, truth, data, measured, additive = problem
+    model = streaming.SIRFViewModel(full.for_views, data, truth)
+    out = streaming.open_memmap(str(tmp_path / 'expectation.npy'), DATA_SHAPE, 'w+')
+    streaming.expectation(model, truth.as_array(), out, additive, chunk_views=4)
+    numpy.testing.assert_allclose(out, data.array, rtol=1e-5)
+
+
+def test_add_noise(problem, tmp_path):
+    _, _, _, measured, _ = problem
+    out = streaming.open_memmap(str(tmp_path / 'noisy.npy'), DATA_SHAPE, 'w+')
+    noisy = streaming.add_noise(measured, out, seed=1, chunk_size=50)
+    assert noisy is out
+    numpy.testing.assert_array_equal(noisy, poisson_noise(numpy.array(measured), seed=1, chunk_size=50))
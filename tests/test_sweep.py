@@ -0,0 +1,47 @@
+import os
+
+import numpy
+import pytest
+
+from sirf_exercises.sweep import Sweep, parameter_grid, parameter_key
+
+
+def factory():
+    # module level, such that worker processes can use it
+    image = numpy.random.default_rng(0).random((5, 6))
+
+    def reconstruct(params):
+        if params['beta'] < 0:
+            raise ValueError('negative beta')
+        return image * params['beta'] + params['w']
+
+    return reconstruct
+
+
+def test_grid_and_key():
+    grid = parameter_grid(beta=[0.1, 1], w=['a', 'b', 'c'])
+    assert len(grid) == 6 and grid[1] == dict(beta=0.1, w='b')
+    assert parameter_key(dict(beta=1, w=2)) == parameter_key(dict(w=2, beta=1))
+    assert parameter_key(dict(beta=1, w=2)) != parameter_key(dict(beta=1, w=3))
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_run_and_resume(tmp_path, processes):
+    grid = parameter_grid(beta=[0.5, 1, -1], w=[0, 2])
+    sweep = Sweep(factory, str(tmp_path), metrics={'mean': numpy.mean}, processes=processes,
+                  mp_context='spawn')
+    ran = []
+    results = sweep.run(grid, callback=ran.append)
+    assert len(ran) == len(grid)
+    assert [r['params'] for r in results] == grid
+    assert ['error' in r for r in results] == [False] * 4 + [True] * 2
+    reconstruct = factory()
+    for params, result in zip(grid[:4], results):
+        numpy.testing.assert_allclose(sweep.image(params), reconstruct(params))
+        assert result['metrics']['mean'] == pytest.approx(reconstruct(params).mean())
+    assert len(os.listdir(str(tmp_path))) == 8
+    # only the failed configurations run again
+    ran = []
+    again = sweep.run(grid, callback=ran.append)
+    assert sorted(r['key'] for r in ran) == sorted(r['key'] for r in results[4:])
+    assert again[:4] == results[:4]